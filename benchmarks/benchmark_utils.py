@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the benchmark scripts
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import dask
+import datetime as dt
+import os
+import pandas as pd
+import platform
+import pyarrow
+import subprocess
+
+
+def git_revision():
+    """The ``git describe`` of the working tree the benchmarks are run from, None if it isn't a git repo"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=here, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report_metadata():
+    """Where and with what a benchmark report was made, so reports can be compared across commits"""
+    return {
+        'revision': git_revision(),
+        'created_at': dt.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'versions': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'pyarrow': pyarrow.__version__,
+            'dask': dask.__version__,
+        },
+    }
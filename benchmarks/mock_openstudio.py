@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in for OpenStudio that writes realistic simulation outputs without running EnergyPlus
+
+It reads the ``in.osw`` in the simulation directory, waits, and writes ``out.osw``, ``run/data_point_out.json`` and
+``run/enduse_timeseries.csv`` made from the test simulations in ``buildstockbatch/test/test_results``, with the
+building id, upgrade and timeseries reporting frequency of the ``in.osw``. That lets the runners be benchmarked end
+to end on a plain Linux box. It plugs in at the places the runners start OpenStudio:
+
+* ``openstudio``: :func:`install` writes an ``openstudio`` executable, put its directory first on ``PATH``. This is
+  what ``AwsBatch.run_job`` calls.
+* ``singularity``: :func:`install` also writes a ``singularity`` executable that runs the simulation in the
+  directory bound to ``/var/simdata/openstudio``, for ``EagleBatch.run_building``.
+* docker: :func:`patch_docker` makes ``docker.client.from_env`` return a :class:`MockDockerClient` for
+  ``LocalDockerBatch``. :func:`install` writes a ``sitecustomize.py`` that does that in new python processes when
+  ``MOCK_OPENSTUDIO_DOCKER`` is set.
+
+:func:`mock_environ` has the environment variables to use all three.
+
+The delay is set with the ``MOCK_OPENSTUDIO_DELAY`` environment variable, in seconds, or ``mean,stdev`` to draw it
+from a normal distribution. ``MOCK_OPENSTUDIO_FAIL_RATE`` is the fraction of simulations that fail.
+
+Usage, like the OpenStudio CLI::
+
+    python benchmarks/mock_openstudio.py run -w in.osw
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import argparse
+import datetime as dt
+import functools
+import json
+import os
+import pandas as pd
+import pathlib
+import random
+import shlex
+import stat
+import sys
+import time
+
+TEST_RESULTS_DIR = pathlib.Path(__file__).resolve().parent.parent / 'buildstockbatch' / 'test' / 'test_results'
+CONTAINER_SIM_DIR = '/var/simdata/openstudio'
+RESAMPLE_FREQS = {
+    'Daily': 'D',
+    'Monthly': 'M',
+    'RunPeriod': 'Y',
+}
+
+
+def get_delay():
+    """Seconds to wait before writing the outputs, from ``MOCK_OPENSTUDIO_DELAY``"""
+    delay = os.environ.get('MOCK_OPENSTUDIO_DELAY', '0')
+    if ',' in delay:
+        mean, stdev = map(float, delay.split(','))
+        return max(random.gauss(mean, stdev), 0)
+    return float(delay)
+
+
+@functools.lru_cache(maxsize=None)
+def _template_bldg_ids(upgrade_id):
+    # Test simulations that succeeded and have a timeseries
+    return sorted(
+        int(x.parent.parent.name[4:])
+        for x in (TEST_RESULTS_DIR / 'simulations_job0' / f'up{upgrade_id:02d}').glob('bldg*/run/data_point_out.json')
+        if (TEST_RESULTS_DIR / 'simulation_output' / 'timeseries' / f'up{upgrade_id:02d}' /
+            f'{x.parent.parent.name}.parquet').exists()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _read_template(template_dir, filename):
+    with open(pathlib.Path(template_dir, filename), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=None)
+def _read_template_timeseries(upgrade_id, template_bldg_id):
+    return pd.read_parquet(
+        TEST_RESULTS_DIR / 'simulation_output' / 'timeseries' / f'up{upgrade_id:02d}' /
+        f'bldg{template_bldg_id:07d}.parquet'
+    )
+
+
+def make_timeseries(upgrade_id, template_bldg_id, reporting_frequency='Hourly', timesteps_per_hr=6):
+    """Timeseries of a test simulation at the reporting frequency of the ``TimeseriesCSVExport`` measure"""
+    ts_df = _read_template_timeseries(upgrade_id, template_bldg_id).copy()
+    time_cols = ['Time', 'TimeDST', 'TimeUTC']
+    value_cols = [x for x in ts_df.columns if x not in time_cols]
+    for col in time_cols:
+        ts_df[col] = pd.to_datetime(ts_df[col])
+    if reporting_frequency == 'Timestep':
+        # Spread each hour over its timesteps
+        offsets = pd.to_timedelta(
+            [(i - timesteps_per_hr + 1) * 60 // timesteps_per_hr for i in range(timesteps_per_hr)], unit='min'
+        )
+        ts_df = ts_df.loc[ts_df.index.repeat(timesteps_per_hr)].reset_index(drop=True)
+        step_offsets = offsets[ts_df.index % timesteps_per_hr]
+        for col in time_cols:
+            ts_df[col] = ts_df[col] + step_offsets
+        ts_df[value_cols] = ts_df[value_cols] / timesteps_per_hr
+    elif reporting_frequency in RESAMPLE_FREQS:
+        # Sum the hours ending in each period, labeled by the time at the end of the period
+        periods = (ts_df['Time'] - pd.Timedelta(seconds=1)).dt.to_period(RESAMPLE_FREQS[reporting_frequency])
+        ts_df = ts_df.groupby(periods.values).agg(
+            {col: ('last' if col in time_cols else 'sum') for col in ts_df.columns}
+        ).reset_index(drop=True)
+    return ts_df
+
+
+def simulate(sim_dir, measures_only=False, delay=None, fail_rate=None):
+    """Read ``in.osw`` in ``sim_dir`` and write the outputs of a simulation of it
+
+    :param sim_dir: simulation directory with an ``in.osw``
+    :param measures_only: only run the model measures, write ``out.osw`` but no simulation outputs
+    :param delay: seconds to wait, defaults to :func:`get_delay`
+    :param fail_rate: fraction of simulations that fail, defaults to ``MOCK_OPENSTUDIO_FAIL_RATE`` or 0
+    :return: completed status, ``Success`` or ``Fail``
+    """
+    sim_dir = pathlib.Path(sim_dir)
+    started_at = dt.datetime.utcnow()
+    with open(sim_dir / 'in.osw', 'r', encoding='utf-8') as f:
+        in_osw = json.load(f)
+    steps = {x['measure_dir_name']: x.get('arguments', {}) for x in in_osw['steps']}
+    building_id = int(steps['BuildExistingModel']['building_id'])
+    upgrade_id = 1 if 'ApplyUpgrade' in steps else 0
+    template_bldg_ids = _template_bldg_ids(upgrade_id)
+    template_bldg_id = template_bldg_ids[(building_id - 1) % len(template_bldg_ids)]
+    template_dir = TEST_RESULTS_DIR / 'simulations_job0' / f'up{upgrade_id:02d}' / f'bldg{template_bldg_id:07d}'
+
+    time.sleep(get_delay() if delay is None else delay)
+    if fail_rate is None:
+        fail_rate = float(os.environ.get('MOCK_OPENSTUDIO_FAIL_RATE', '0'))
+    completed_status = 'Fail' if random.random() < fail_rate else 'Success'
+
+    run_dir = sim_dir / 'run'
+    run_dir.mkdir(exist_ok=True)
+    if completed_status == 'Success' and not measures_only:
+        dpout = json.loads(_read_template(template_dir, 'run/data_point_out.json'))
+        dpout['BuildExistingModel']['building_id'] = building_id
+        if upgrade_id:
+            dpout['ApplyUpgrade'].update(steps['ApplyUpgrade'])
+            dpout['ApplyUpgrade']['applicable'] = True
+        with open(run_dir / 'data_point_out.json', 'w', encoding='utf-8') as f:
+            json.dump(dpout, f, indent=2)
+
+        if 'TimeseriesCSVExport' in steps:
+            ts_df = make_timeseries(
+                upgrade_id,
+                template_bldg_id,
+                steps['TimeseriesCSVExport'].get('reporting_frequency', 'Hourly'),
+                int(steps.get('ResidentialSimulationControls', {}).get('timesteps_per_hr', 6))
+            )
+            ts_df.to_csv(run_dir / 'enduse_timeseries.csv', index=False, date_format='%Y/%m/%d %H:%M:%S')
+
+    out_osw = json.loads(_read_template(template_dir, 'out.osw'))
+    template_results = {x['measure_dir_name']: x.get('result', {}) for x in out_osw['steps']}
+    out_osw.update({
+        'id': in_osw.get('id'),
+        'created_at': in_osw.get('created_at'),
+        'started_at': started_at.strftime('%Y%m%dT%H%M%SZ'),
+        'completed_at': dt.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
+        'updated_at': dt.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'),
+        'completed_status': completed_status,
+        'steps': [{**x, 'result': template_results.get(x['measure_dir_name'], {})} for x in in_osw['steps']],
+    })
+    with open(sim_dir / 'out.osw', 'w', encoding='utf-8') as f:
+        json.dump(out_osw, f, indent=2)
+    return completed_status
+
+
+def run_singularity(args, script):
+    """Run the simulation a ``singularity exec ... bash`` command from ``EagleBatch.run_building`` would"""
+    binds = {}
+    pwd = None
+    i = 0
+    while i < len(args):
+        if args[i] == '-B':
+            src, dst = args[i + 1].split(':')[:2]
+            binds[dst] = src
+            i += 2
+        elif args[i] == '--pwd':
+            pwd = args[i + 1]
+            i += 2
+        else:
+            i += 1
+    sim_dir = binds[pwd or CONTAINER_SIM_DIR]
+    for line in script.splitlines():
+        cmd = shlex.split(line)
+        if cmd and cmd[0] == 'openstudio':
+            return simulate(sim_dir, measures_only='--measures_only' in cmd)
+    raise ValueError('No openstudio command in the singularity script')
+
+
+class MockDockerClient:
+    """Stand-in for the docker client ``LocalDockerBatch`` gets from ``docker.client.from_env``"""
+
+    def __init__(self, *args, **kwargs):
+        self.containers = self
+        self.images = self
+
+    def ping(self):
+        return True
+
+    def info(self):
+        return {'NCPU': os.cpu_count()}
+
+    def pull(self, *args, **kwargs):
+        pass
+
+    def run(self, image, args, volumes=None, **kwargs):
+        sim_dir = next(src for src, bind in (volumes or {}).items() if bind['bind'].rstrip('/') == CONTAINER_SIM_DIR)
+        status = simulate(sim_dir, measures_only='--measures_only' in args)
+        return f'mock openstudio {" ".join(args)}: {status}\n'.encode('utf-8')
+
+
+def patch_docker():
+    """Make the docker client in this process a :class:`MockDockerClient`"""
+    import docker
+    docker.client.from_env = MockDockerClient
+    docker.DockerClient.from_env = MockDockerClient
+    docker.from_env = MockDockerClient
+
+
+SITECUSTOMIZE = """import os
+if os.environ.get('MOCK_OPENSTUDIO_DOCKER'):
+    import mock_openstudio
+    mock_openstudio.patch_docker()
+"""
+
+
+def install(bin_dir):
+    """Write ``openstudio`` and ``singularity`` executables and a ``sitecustomize.py`` that run this mock
+
+    :param bin_dir: directory to write them to
+    :return: ``bin_dir``
+    """
+    bin_dir = pathlib.Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name in ('openstudio', 'singularity'):
+        filename = bin_dir / name
+        with open(filename, 'w') as f:
+            f.write(f'#!/bin/sh\nexec {shlex.quote(sys.executable)} {shlex.quote(__file__)} --as {name} "$@"\n')
+        filename.chmod(filename.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    with open(bin_dir / 'sitecustomize.py', 'w') as f:
+        f.write(SITECUSTOMIZE)
+    return str(bin_dir)
+
+
+def mock_environ(bin_dir, delay=None, fail_rate=None):
+    """Environment variables that make new processes use the mock installed in ``bin_dir`` by :func:`install`"""
+    pythonpath = [str(bin_dir), os.path.dirname(os.path.abspath(__file__))]
+    if os.environ.get('PYTHONPATH'):
+        pythonpath.append(os.environ['PYTHONPATH'])
+    env = {
+        'PATH': os.pathsep.join([str(bin_dir), os.environ.get('PATH', '')]),
+        'PYTHONPATH': os.pathsep.join(pythonpath),
+        'MOCK_OPENSTUDIO_DOCKER': '1',
+    }
+    if delay is not None:
+        env['MOCK_OPENSTUDIO_DELAY'] = str(delay)
+    if fail_rate is not None:
+        env['MOCK_OPENSTUDIO_FAIL_RATE'] = str(fail_rate)
+    return env
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:2] == ['--as', 'singularity']:
+        run_singularity(argv[2:], sys.stdin.read())
+        return 0
+    if argv[:2] == ['--as', 'openstudio']:
+        argv = argv[2:]
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--bundle')
+    parser.add_argument('--bundle_path')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('-w', '--workflow', required=True)
+    run_parser.add_argument('--measures_only', action='store_true')
+    run_parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+    sim_dir = os.path.dirname(os.path.abspath(args.workflow))
+    status = simulate(sim_dir, measures_only=args.measures_only)
+    return 0 if status == 'Success' else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+End to end throughput of ``LocalDockerBatch`` with a mock OpenStudio
+
+Runs a whole local project, from sampling and OSW generation through the simulations, cleanup, archiving and
+postprocessing, with :mod:`mock_openstudio` standing in for the docker container. The simulations take
+``--delay`` seconds, so what is left is the orchestration overhead. Reports simulations per second per core.
+
+``mock_openstudio`` also has ``openstudio`` and ``singularity`` stand-ins for ``AwsBatch.run_job`` and
+``EagleBatch.run_job_batch``, which need s3 and the Eagle filesystem layout to run, so they aren't run here.
+
+Usage::
+
+    python benchmarks/orchestration_throughput.py --buildings 200 --upgrades 1 --delay 0.5 -j 4
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+import yaml
+import zipfile
+
+from benchmark_utils import report_metadata
+import mock_openstudio
+
+REPO_DIR = pathlib.Path(__file__).resolve().parent.parent
+TEST_DIR = REPO_DIR / 'buildstockbatch' / 'test'
+
+
+def make_project(project_dir, n_buildings, n_upgrades, reporting_frequency='Hourly'):
+    """Write a local project for the test buildstock with ``n_buildings`` sampled buildings
+
+    :return: project filename
+    """
+    project_dir = pathlib.Path(project_dir)
+    buildstock_dir = project_dir / 'openstudio_buildstock'
+    shutil.copytree(TEST_DIR / 'test_inputs' / 'test_openstudio_buildstock', buildstock_dir)
+    (buildstock_dir / 'project_resstock_national' / 'housing_characteristics').mkdir(parents=True)
+
+    # Repeat the test buildstock.csv to get enough buildings
+    with open(TEST_DIR / 'buildstock.csv', 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    with open(project_dir / 'buildstock.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for bldg_id, row in zip(range(1, n_buildings + 1), itertools.cycle(rows)):
+            writer.writerow([bldg_id] + row[1:])
+
+    with zipfile.ZipFile(project_dir / 'weather.zip', 'w') as zf:
+        for epw_filename in set(row[header.index('Location Weather Filename')] for row in rows):
+            zf.writestr(epw_filename, '')
+
+    cfg = {
+        'schema_version': '0.3',
+        'buildstock_directory': str(buildstock_dir),
+        'project_directory': 'project_resstock_national',
+        'output_directory': str(project_dir / 'output'),
+        'weather_files_path': str(project_dir / 'weather.zip'),
+        'sampler': {
+            'type': 'precomputed',
+            'args': {
+                'sample_file': str(project_dir / 'buildstock.csv')
+            }
+        },
+        'workflow_generator': {
+            'type': 'residential_default',
+            'args': {
+                'timeseries_csv_export': {
+                    'reporting_frequency': reporting_frequency,
+                    'include_enduse_subcategories': True
+                },
+                'simulation_output': {
+                    'include_enduse_subcategories': True
+                },
+            }
+        },
+        'baseline': {
+            'n_buildings_represented': 80000000,
+        },
+        'upgrades': [
+            {
+                'upgrade_name': f'Upgrade{i}',
+                'options': [{'option': 'Infiltration|11.25 ACH50'}]
+            } for i in range(1, n_upgrades + 1)
+        ],
+    }
+    project_filename = project_dir / 'project.yml'
+    with open(project_filename, 'w') as f:
+        yaml.dump(cfg, f)
+    return str(project_filename)
+
+
+def run_benchmark(n_buildings, n_upgrades, delay, n_jobs, reporting_frequency='Hourly'):
+    """Run a local project with the mock OpenStudio and time each stage
+
+    :return: report dict
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bin_dir = mock_openstudio.install(os.path.join(tmpdir, 'bin'))
+        project_filename = make_project(os.path.join(tmpdir, 'project'), n_buildings, n_upgrades, reporting_frequency)
+        with patch.dict(os.environ, mock_openstudio.mock_environ(bin_dir, delay=delay)):
+            mock_openstudio.patch_docker()
+            from buildstockbatch.localdocker import LocalDockerBatch
+
+            stages = {}
+            tick = time.perf_counter()
+            batch = LocalDockerBatch(project_filename)
+            batch.run_batch(n_jobs=n_jobs)
+            stages['run_batch'] = time.perf_counter() - tick
+
+            tick = time.perf_counter()
+            with patch.object(LocalDockerBatch, 'get_dask_client'):
+                batch.process_results()
+            stages['process_results'] = time.perf_counter() - tick
+
+    n_sims = n_buildings * (n_upgrades + 1)
+    return {
+        **report_metadata(),
+        'parameters': {
+            'buildings': n_buildings,
+            'upgrades': n_upgrades,
+            'delay_s': delay,
+            'n_jobs': n_jobs,
+            'reporting_frequency': reporting_frequency,
+        },
+        'simulations': n_sims,
+        'stages_s': stages,
+        'sims_per_second': n_sims / stages['run_batch'],
+        'sims_per_second_per_core': n_sims / stages['run_batch'] / n_jobs,
+        # Fraction of the time the cores weren't running a (mock) simulation
+        'overhead_fraction': 1 - n_sims * delay / (stages['run_batch'] * n_jobs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--buildings', type=int, default=50, help='number of buildings (default: 50)')
+    parser.add_argument('--upgrades', type=int, default=1, help='number of upgrades besides baseline (default: 1)')
+    parser.add_argument('--delay', type=float, default=0.5, help='seconds each simulation takes (default: 0.5)')
+    parser.add_argument('-j', '--n-jobs', type=int, default=os.cpu_count(),
+                        help='parallel simulations (default: all cores)')
+    parser.add_argument('--reporting-frequency', default='Hourly', help='timeseries frequency (default: Hourly)')
+    parser.add_argument('--output', help='json file to write the report to')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.buildings, args.upgrades, args.delay, args.n_jobs, args.reporting_frequency)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps({k: report[k] for k in ('parameters', 'stages_s', 'sims_per_second',
+                                             'sims_per_second_per_core', 'overhead_fraction')}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
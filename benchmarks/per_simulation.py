@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks of the code that runs once for every simulation
+
+Times ``create_osw``, ``make_sim_dir``, ``cleanup_sim_dir`` and ``read_simulation_outputs`` on their own and one
+after another the way the runners call them, on the simulation outputs under ``buildstockbatch/test/test_results``.
+``flatten_datapoint_jsons`` is timed for a job of ``JOB_SIZE`` simulations, ``combine_results`` flattens their
+outputs a job at a time. Python allocations during one call of each are tracked with
+tracemalloc (memory allocated by arrow isn't seen by tracemalloc).
+
+With ``--baseline`` the results are compared to a report from an earlier run and the script exits with an error
+when a case is slower or allocates more than the thresholds allow. A case is only slower when both the median
+and the best of its repetitions are, and it's timed again to confirm it, two runs of the same code are often a
+few tens of percent apart.
+
+Usage::
+
+    python benchmarks/per_simulation.py --output baseline.json
+    python benchmarks/per_simulation.py --baseline baseline.json --time-threshold 0.5 --memory-threshold 0.1
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import argparse
+from fsspec.implementations.local import LocalFileSystem
+import json
+import os
+import pandas as pd
+import pathlib
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from benchmark_utils import report_metadata
+from buildstockbatch import postprocessing
+from buildstockbatch.base import BuildStockBatchBase
+
+TEST_RESULTS_DIR = pathlib.Path(__file__).resolve().parent.parent / 'buildstockbatch' / 'test' / 'test_results'
+CFG = {
+    'workflow_generator': {
+        'type': 'residential_default',
+        'args': {
+            'timeseries_csv_export': {
+                'reporting_frequency': 'Hourly',
+                'include_enduse_subcategories': True
+            },
+            'simulation_output': {
+                'include_enduse_subcategories': True
+            },
+        }
+    },
+    'baseline': {
+        'n_buildings_represented': 80000000,
+    },
+    'upgrades': [{
+        'upgrade_name': 'Upgrade1',
+        'options': [
+            {'option': 'Infiltration|11.25 ACH50'}
+        ]
+    }],
+}
+N_DATAPOINTS = 1000
+JOB_SIZE = 100  # simulations in a results_job*.json.gz
+
+
+def copy_into(src_dir, dst_dir):
+    """Copy the files in ``src_dir`` into ``dst_dir``, replacing the ones already there"""
+    for dirpath, _, filenames in os.walk(src_dir):
+        dst_path = os.path.join(dst_dir, os.path.relpath(dirpath, src_dir))
+        os.makedirs(dst_path, exist_ok=True)
+        for filename in filenames:
+            shutil.copy2(os.path.join(dirpath, filename), dst_path)
+
+
+def make_fixture_sim_dir(sim_dir, building_id=1, upgrade_id=0):
+    """Copy the outputs of a test simulation to ``sim_dir`` with the enduse_timeseries.csv it was made from"""
+    src_dir = TEST_RESULTS_DIR / 'simulations_job0' / f'up{upgrade_id:02d}' / f'bldg{building_id:07d}'
+    shutil.copytree(src_dir, sim_dir)
+    ts_df = pd.read_parquet(
+        TEST_RESULTS_DIR / 'simulation_output' / 'timeseries' / f'up{upgrade_id:02d}' / f'bldg{building_id:07d}.parquet'
+    )
+    ts_df.to_csv(os.path.join(sim_dir, 'run', 'enduse_timeseries.csv'), index=False)
+
+
+def make_cases(workdir):
+    """The benchmark cases, a dict of names to functions that take no arguments"""
+    fs = LocalFileSystem()
+    sims_dir = os.path.join(workdir, 'simulations')
+    ts_dir = os.path.join(workdir, 'simulation_output', 'timeseries')
+    fixture_sim_dir = os.path.join(workdir, 'fixture')
+    make_fixture_sim_dir(fixture_sim_dir)
+    os.makedirs(os.path.join(ts_dir, 'up00'))
+    job_dpouts = [postprocessing.read_simulation_outputs(fs, [], fixture_sim_dir, 0, 1)] * JOB_SIZE
+    cleanup_kwargs = BuildStockBatchBase.get_cleanup_sim_dir_kwargs(CFG)
+
+    def run_sequence():
+        sim_id, sim_dir = BuildStockBatchBase.make_sim_dir(1, None, sims_dir, overwrite_existing=True)
+        osw = BuildStockBatchBase.create_osw(CFG, N_DATAPOINTS, sim_id, 1, None)
+        with open(os.path.join(sim_dir, 'in.osw'), 'w') as f:
+            json.dump(osw, f, indent=4)
+        # stand in for the simulation
+        copy_into(fixture_sim_dir, sim_dir)
+        BuildStockBatchBase.cleanup_sim_dir(sim_dir, fs, ts_dir, 0, 1, **cleanup_kwargs)
+        return postprocessing.read_simulation_outputs(fs, [], sim_dir, 0, 1)
+
+    return {
+        'create_osw': lambda: BuildStockBatchBase.create_osw(CFG, N_DATAPOINTS, 'bldg0000001up01', 1, 0),
+        'make_sim_dir': lambda: BuildStockBatchBase.make_sim_dir(1, 0, sims_dir, overwrite_existing=True),
+        'cleanup_sim_dir': lambda: BuildStockBatchBase.cleanup_sim_dir(
+            fixture_sim_dir, fs, ts_dir, 0, 1, **cleanup_kwargs
+        ),
+        'read_simulation_outputs': lambda: postprocessing.read_simulation_outputs(fs, [], fixture_sim_dir, 0, 1),
+        'flatten_datapoint_jsons': lambda: postprocessing.flatten_datapoint_jsons([], job_dpouts),
+        'sequence': run_sequence,
+    }
+
+
+def measure(func, repeat, number=None):
+    """Time ``func`` and track its allocations
+
+    :return: dict with the median ``time_per_call_s`` and the best ``min_time_per_call_s`` of ``repeat``
+        repetitions and the ``peak_alloc_bytes`` and ``retained_alloc_bytes`` of Python memory during one call
+    """
+    func()  # warm up caches and imports
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    times = timer.repeat(repeat=repeat, number=number)
+
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = func()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return {
+        'time_per_call_s': statistics.median(times) / number,
+        'min_time_per_call_s': min(times) / number,
+        'calls_per_repetition': number,
+        'peak_alloc_bytes': peak - before,
+        'retained_alloc_bytes': after - before,
+    }
+
+
+def is_slower(result, base, threshold):
+    """Whether both the median and the best time of a case are slower than the baseline by more than threshold"""
+    return all(
+        base[metric] > 0 and result[metric] > base[metric] * (1 + threshold)
+        for metric in ('time_per_call_s', 'min_time_per_call_s') if metric in base
+    )
+
+
+def find_regressions(report, baseline, time_threshold, memory_threshold):
+    """List the cases that got slower or allocate more than the baseline by more than the thresholds"""
+    regressions = []
+    for name, result in report['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None:
+            continue
+        for metric, threshold in (('time_per_call_s', time_threshold), ('peak_alloc_bytes', memory_threshold)):
+            if threshold is None:
+                continue
+            if metric == 'time_per_call_s':
+                if not is_slower(result, base, threshold):
+                    continue
+            elif base[metric] <= 0 or result[metric] <= base[metric] * (1 + threshold):
+                continue
+            regressions.append(
+                f'{name} {metric}: {result[metric]:.6g} vs {base[metric]:.6g} in {baseline["revision"]} '
+                f'({result[metric] / base[metric] - 1:+.0%}, threshold {threshold:+.0%})'
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--repeat', type=int, default=15,
+                        help='repetitions to time each case (default: 15)')
+    parser.add_argument('--number', type=int, help='calls per repetition (default: enough to take 0.2 s)')
+    parser.add_argument('--cases', nargs='+', help='only run these cases')
+    parser.add_argument('--output', help='json file to write the report to')
+    parser.add_argument('--baseline', help='json report from an earlier run to compare to')
+    parser.add_argument('--time-threshold', type=float, default=1.0,
+                        help='fraction slower than the baseline that counts as a regression (default: 1.0)')
+    parser.add_argument('--memory-threshold', type=float, default=0.2,
+                        help='fraction more peak allocation than the baseline that counts as a regression '
+                             '(default: 0.2)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    report = {**report_metadata(), 'cases': {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = make_cases(workdir)
+        for name in args.cases or cases.keys():
+            result = measure(cases[name], args.repeat, args.number)
+            base = baseline['cases'].get(name) if baseline else None
+            if base is not None and args.time_threshold is not None and \
+                    is_slower(result, base, args.time_threshold):
+                # Time it again before calling it a regression, keep the faster measurement
+                retry = measure(cases[name], args.repeat, args.number)
+                result = min(result, retry, key=lambda r: r['min_time_per_call_s'])
+            report['cases'][name] = result
+            print(
+                f'{name:>24s}: {result["time_per_call_s"] * 1e3:9.3f} ms/call, '
+                f'peak {result["peak_alloc_bytes"] / 2**10:9.1f} KiB, '
+                f'retained {result["retained_alloc_bytes"] / 2**10:7.1f} KiB'
+            )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if baseline:
+        regressions = find_regressions(report, baseline, args.time_threshold, args.memory_threshold)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions), file=sys.stderr)
+            sys.exit(1)
+        print(f'No regressions compared to {baseline["revision"]}')
+
+
+if __name__ == '__main__':
+    main()
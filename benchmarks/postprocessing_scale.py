@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scale benchmark of postprocessing on synthetic simulation results
+
+Generates ``results_job*.json.gz`` files and per-building timeseries parquet files shaped like the ones the
+simulation workers write, for N buildings, M upgrades and K output columns at a chosen reporting frequency, on the
+local filesystem. Then runs the postprocessing stages on them:
+
+* ``combine``: :func:`buildstockbatch.postprocessing.combine_results`
+* ``upload``: copies the parquet files to a local directory the same way
+  :func:`buildstockbatch.postprocessing.upload_results` uploads them to s3
+* ``cleanup``: :func:`buildstockbatch.postprocessing.remove_intermediate_files`
+
+Each stage runs in a fresh process so the wall time, peak RSS and bytes written are its own. The report is written
+as json and can be compared to a report from another commit.
+
+Usage::
+
+    python benchmarks/postprocessing_scale.py --buildings 1000 --upgrades 2 --columns 100 --freq 15min \\
+        --output report.json --compare baseline_report.json
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import argparse
+import dask
+import datetime as dt
+from fsspec.implementations.local import LocalFileSystem
+import gzip
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import pathlib
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmark_utils import report_metadata
+from buildstockbatch import postprocessing
+
+STAGES = ('combine', 'upload', 'cleanup')
+CHARACTERISTICS = {
+    'county': [f'County {i}' for i in range(20)],
+    'geometry_building_type_recs': ['Single-Family Detached', 'Single-Family Attached', 'Multi-Family'],
+    'vintage': ['<1950', '1950s', '1960s', '1970s', '1980s', '1990s', '2000s', '2010s'],
+    'heating_fuel': ['Electricity', 'Natural Gas', 'Fuel Oil', 'Propane'],
+}
+
+
+def generate_results(results_dir, n_buildings, n_upgrades, n_columns, freq='H', buildings_per_job=100, seed=0):
+    """Write synthetic simulation results to ``results_dir/simulation_output``
+
+    :param results_dir: results directory of the synthetic project
+    :param n_buildings: number of buildings
+    :param n_upgrades: number of upgrades, in addition to the baseline
+    :param n_columns: number of output columns, both in the annual results and the timeseries
+    :param freq: reporting frequency of the timeseries as a pandas offset alias, None to not write timeseries
+    :param buildings_per_job: number of buildings in each ``results_job*.json.gz``
+    :param seed: random seed
+    :return: project configuration for :func:`buildstockbatch.postprocessing.combine_results`
+    """
+    rng = np.random.default_rng(seed)
+    sim_output_dir = pathlib.Path(results_dir) / 'simulation_output'
+    sim_output_dir.mkdir(parents=True, exist_ok=True)
+    fs = LocalFileSystem()
+    characteristics = {
+        bldg_id: {k: rng.choice(v) for k, v in CHARACTERISTICS.items()}
+        for bldg_id in range(1, n_buildings + 1)
+    }
+    started_at = dt.datetime(2020, 1, 1)
+
+    if freq is not None:
+        time_index = pd.date_range('2007-01-01', '2008-01-01', freq=freq, inclusive='right')
+    sims = [(upgrade_id, bldg_id) for upgrade_id in range(n_upgrades + 1) for bldg_id in range(1, n_buildings + 1)]
+    for job_id, i in enumerate(range(0, len(sims), buildings_per_job), 1):
+        dpouts = []
+        for upgrade_id, bldg_id in sims[i:i + buildings_per_job]:
+            dpout = {
+                'ApplyUpgrade': {
+                    'upgrade_name': f'Upgrade {upgrade_id}' if upgrade_id else None,
+                    'applicable': True if upgrade_id else None,
+                },
+                'BuildExistingModel': {**characteristics[bldg_id], 'units_represented': 1},
+                'SimulationOutputReport': {
+                    'applicable': True,
+                    **{f'output_{j:04d}_kwh': x for j, x in enumerate(rng.random(n_columns) * 1000)}
+                },
+            }
+            sim_started_at = started_at + dt.timedelta(minutes=int(rng.integers(0, 60 * 24)))
+            dpout['started_at'] = sim_started_at.strftime('%Y%m%dT%H%M%SZ')
+            dpout['completed_at'] = (sim_started_at + dt.timedelta(minutes=3)).strftime('%Y%m%dT%H%M%SZ')
+            dpout['completed_status'] = 'Success'
+            dpout['upgrade'] = upgrade_id
+            dpout['building_id'] = bldg_id
+            dpouts.append(dpout)
+
+            if freq is not None:
+                ts_dir = sim_output_dir / 'timeseries' / f'up{upgrade_id:02d}'
+                ts_dir.mkdir(parents=True, exist_ok=True)
+                ts_df = pd.DataFrame(
+                    rng.random((len(time_index), n_columns)),
+                    columns=[f'output_{j:04d}_kwh' for j in range(n_columns)]
+                )
+                ts_df.insert(0, 'TimeUTC', time_index + pd.Timedelta(hours=6))
+                ts_df.insert(0, 'TimeDST', time_index)
+                ts_df.insert(0, 'Time', time_index)
+                postprocessing.write_dataframe_as_parquet(ts_df, fs, str(ts_dir / f'bldg{bldg_id:07d}.parquet'))
+
+        with gzip.open(sim_output_dir / f'results_job{job_id}.json.gz', 'wt', encoding='utf-8') as f:
+            json.dump(dpouts, f)
+
+    return {
+        'upgrades': [{'upgrade_name': f'Upgrade {i}'} for i in range(1, n_upgrades + 1)],
+        'baseline': {'n_buildings_represented': n_buildings},
+        'postprocessing': {},
+    }
+
+
+def upload_to_local(results_dir, dest_dir):
+    """Copy the parquet files like :func:`buildstockbatch.postprocessing.upload_results` uploads them to s3"""
+    parquet_dir = pathlib.Path(results_dir) / 'parquet'
+    all_files = [x.relative_to(parquet_dir) for x in parquet_dir.rglob('*.parquet')]
+
+    def upload_file(filepath):
+        dest = pathlib.Path(dest_dir) / filepath
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(parquet_dir / filepath, dest)
+
+    dask.compute(map(dask.delayed(upload_file), all_files))
+
+
+def _files_by_name(dirs):
+    files = {}
+    for d in dirs:
+        for dirpath, _, filenames in os.walk(d):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.stat(path)
+                files[path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def _peak_rss_bytes():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _run_stage(stage, results_dir, upload_dir, cfg, do_timeseries, scheduler, queue):
+    watched_dirs = [results_dir, upload_dir]
+    files_before = _files_by_name(watched_dirs)
+    with dask.config.set(scheduler=scheduler):
+        tick = time.perf_counter()
+        if stage == 'combine':
+            postprocessing.combine_results(LocalFileSystem(), results_dir, cfg, do_timeseries=do_timeseries)
+        elif stage == 'upload':
+            upload_to_local(results_dir, upload_dir)
+        elif stage == 'cleanup':
+            postprocessing.remove_intermediate_files(LocalFileSystem(), results_dir)
+        wall_time = time.perf_counter() - tick
+    files_after = _files_by_name(watched_dirs)
+    queue.put({
+        'stage': stage,
+        'wall_time_s': wall_time,
+        'peak_rss_bytes': _peak_rss_bytes(),
+        'bytes_written': sum(
+            size for path, (size, mtime) in files_after.items() if files_before.get(path) != (size, mtime)
+        ),
+        'bytes_removed': sum(size for path, (size, _) in files_before.items() if path not in files_after),
+    })
+
+
+def run_stage(stage, results_dir, upload_dir, cfg, do_timeseries=True, scheduler='threads'):
+    """Run a postprocessing stage in a new process and measure it
+
+    :return: dict with the ``wall_time_s``, ``peak_rss_bytes``, ``bytes_written`` and ``bytes_removed`` of the stage
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(
+        target=_run_stage, args=(stage, results_dir, upload_dir, cfg, do_timeseries, scheduler, queue)
+    )
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f'The {stage} stage failed with exit code {proc.exitcode}')
+    return queue.get()
+
+
+def run_benchmark(n_buildings, n_upgrades, n_columns, freq, buildings_per_job=100, repeat=1, scheduler='threads',
+                  workdir=None):
+    """Generate synthetic results and run the postprocessing stages on them ``repeat`` times
+
+    :return: report dict
+    """
+    runs = []
+    generate_times = []
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+            results_dir = os.path.join(tmpdir, 'results')
+            upload_dir = os.path.join(tmpdir, 'upload')
+            tick = time.perf_counter()
+            cfg = generate_results(results_dir, n_buildings, n_upgrades, n_columns, freq, buildings_per_job, seed=i)
+            generate_times.append(time.perf_counter() - tick)
+            runs.append([
+                run_stage(stage, results_dir, upload_dir, cfg, freq is not None, scheduler) for stage in STAGES
+            ])
+
+    stages = []
+    for j, stage in enumerate(STAGES):
+        stage_runs = [run[j] for run in runs]
+        stages.append({
+            'stage': stage,
+            'wall_time_s': min(x['wall_time_s'] for x in stage_runs),
+            'peak_rss_bytes': max(x['peak_rss_bytes'] for x in stage_runs),
+            'bytes_written': max(x['bytes_written'] for x in stage_runs),
+            'bytes_removed': max(x['bytes_removed'] for x in stage_runs),
+        })
+    return {
+        **report_metadata(),
+        'parameters': {
+            'buildings': n_buildings,
+            'upgrades': n_upgrades,
+            'columns': n_columns,
+            'freq': freq,
+            'buildings_per_job': buildings_per_job,
+            'repeat': repeat,
+            'scheduler': scheduler,
+        },
+        'generate_time_s': min(generate_times),
+        'stages': stages,
+    }
+
+
+def format_report(report, baseline=None):
+    """Format a report as a table, with the ratios to a baseline report if there is one"""
+    metrics = ('wall_time_s', 'peak_rss_bytes', 'bytes_written')
+    lines = [f"revision {report['revision']}: " + ', '.join(f'{k}={v}' for k, v in report['parameters'].items())]
+    if baseline is not None:
+        lines.append(f"compared to revision {baseline['revision']}")
+        if baseline['parameters'] != report['parameters']:
+            lines.append('WARNING: the parameters are different')
+    lines.append(f"{'stage':<10s}" + ''.join(f'{x:>26s}' for x in metrics))
+    baseline_stages = {x['stage']: x for x in baseline['stages']} if baseline is not None else {}
+    for stage in report['stages']:
+        line = f"{stage['stage']:<10s}"
+        for metric in metrics:
+            value = stage[metric]
+            cell = f'{value:.2f} s' if metric == 'wall_time_s' else f'{value / 2**20:.1f} MiB'
+            baseline_stage = baseline_stages.get(stage['stage'])
+            if baseline_stage and baseline_stage[metric]:
+                cell += f' ({value / baseline_stage[metric]:.2f}x)'
+            line += f'{cell:>26s}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--buildings', type=int, default=100, help='number of buildings (default: 100)')
+    parser.add_argument('--upgrades', type=int, default=1, help='number of upgrades besides baseline (default: 1)')
+    parser.add_argument('--columns', type=int, default=50, help='number of output columns (default: 50)')
+    parser.add_argument('--freq', default='H', help='timeseries reporting frequency as a pandas offset alias, '
+                                                    '"none" for no timeseries (default: H)')
+    parser.add_argument('--buildings-per-job', type=int, default=100,
+                        help='simulations in each results_job*.json.gz (default: 100)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times to run the stages, the best wall time is reported (default: 1)')
+    parser.add_argument('--scheduler', default='threads', choices=['threads', 'processes', 'synchronous'],
+                        help='dask scheduler (default: threads)')
+    parser.add_argument('--workdir', help='directory to write the synthetic project in (default: system temp)')
+    parser.add_argument('--output', help='json file to write the report to')
+    parser.add_argument('--compare', help='json report from another run to compare to')
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.buildings,
+        args.upgrades,
+        args.columns,
+        None if args.freq.lower() == 'none' else args.freq,
+        buildings_per_job=args.buildings_per_job,
+        repeat=args.repeat,
+        scheduler=args.scheduler,
+        workdir=args.workdir,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(format_report(report, baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of converting a simulation's enduse_timeseries.csv to parquet
+
+Compares the pandas conversion cleanup_sim_dir used to do (read the header, read the file again with date parsing
+inference, convert to arrow, write) with the arrow csv reader in
+:func:`buildstockbatch.postprocessing.read_enduse_timeseries_csv`.
+
+Usage::
+
+    python benchmarks/timeseries_csv_conversion.py --rows 35040 --columns 200 --repeat 5
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import argparse
+from fsspec.implementations.local import LocalFileSystem
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import timeit
+
+from buildstockbatch import postprocessing
+
+
+def write_synthetic_timeseries_csv(filename, n_rows, n_columns, seed=0):
+    """Write an enduse_timeseries.csv shaped like the ones ResStock writes"""
+    rng = np.random.default_rng(seed)
+    time_index = pd.date_range('2007-01-01', periods=n_rows + 1, freq=pd.Timedelta(days=365) / n_rows)[1:]
+    df = pd.DataFrame(
+        rng.random((n_rows, n_columns)) * 10,
+        columns=[f'fuel_use_electricity_enduse_{i}_kwh' for i in range(n_columns)]
+    )
+    df.insert(0, 'TimeUTC', time_index + pd.Timedelta(hours=7))
+    df.insert(0, 'TimeDST', time_index)
+    df.insert(0, 'Time', time_index)
+    df.to_csv(filename, index=False, date_format='%Y/%m/%d %H:%M:%S')
+
+
+def convert_pandas(fs, csv_filename, parquet_filename):
+    possible_time_cols = ['time', 'Time', 'TimeDST', 'TimeUTC']
+    cols = pd.read_csv(csv_filename, index_col=False, nrows=0).columns.tolist()
+    actual_time_cols = [c for c in cols if c in possible_time_cols]
+    tsdf = pd.read_csv(csv_filename, parse_dates=actual_time_cols)
+    postprocessing.write_dataframe_as_parquet(tsdf, fs, parquet_filename)
+
+
+def convert_arrow(fs, csv_filename, parquet_filename):
+    tbl, _ = postprocessing.read_enduse_timeseries_csv(csv_filename)
+    postprocessing.write_table_as_parquet(tbl, fs, parquet_filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('--rows', type=int, default=8760, help='timesteps in the timeseries (default: 8760)')
+    parser.add_argument('--columns', type=int, default=100, help='value columns in the timeseries (default: 100)')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run each conversion (default: 5)')
+    args = parser.parse_args()
+
+    fs = LocalFileSystem()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csv_filename = os.path.join(tmpdir, 'enduse_timeseries.csv')
+        write_synthetic_timeseries_csv(csv_filename, args.rows, args.columns)
+        print(f'{args.rows} rows x {args.columns} columns, {os.path.getsize(csv_filename) / 2**20:.1f} MiB csv')
+        times = {}
+        for name, convert in (('pandas', convert_pandas), ('arrow', convert_arrow)):
+            parquet_filename = os.path.join(tmpdir, f'{name}.parquet')
+            times[name] = min(timeit.repeat(
+                lambda: convert(fs, csv_filename, parquet_filename),
+                repeat=args.repeat,
+                number=1
+            ))
+            print(f'{name:>8s}: {times[name]:.3f} s (best of {args.repeat})')
+        pd.testing.assert_frame_equal(
+            pd.read_parquet(os.path.join(tmpdir, 'pandas.parquet')),
+            pd.read_parquet(os.path.join(tmpdir, 'arrow.parquet')),
+            check_dtype=False
+        )
+    print(f' speedup: {times["pandas"] / times["arrow"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,12 +10,13 @@ This class contains the object & methods that allow for usage of the library wit
 :license: BSD-3
 """
 import argparse
+import asyncio
 from awsretry import AWSRetry
 import base64
 import boto3
 from botocore.exceptions import ClientError
 import collections
-import csv
+from concurrent.futures import ThreadPoolExecutor
 from fsspec.implementations.local import LocalFileSystem
 import gzip
 import hashlib
@@ -30,7 +31,6 @@ import pathlib
 import random
 from s3fs import S3FileSystem
 import shutil
-import subprocess
 import tarfile
 import tempfile
 import re
@@ -40,12 +40,18 @@ import zipfile
 
 from buildstockbatch.localdocker import DockerBatchBase
 from buildstockbatch.base import ValidationError
+from buildstockbatch.executor import run_process, SimulationExecutor
 from buildstockbatch.aws.awsbase import AwsJobBase
 from buildstockbatch import postprocessing
+from buildstockbatch.scheduling import batch_simulations, RuntimeWatchdog, TIMEOUT_STATUS
 from ..utils import log_error_details, get_project_configuration
 
 logger = logging.getLogger(__name__)
 
+# Array jobs aren't made shorter than this when the simulation runtimes can be predicted
+MIN_PREDICTED_JOB_MINUTES = 20
+MIN_JOB_MEMORY_MB = 512
+
 
 def upload_file_to_s3(*args, **kwargs):
     s3 = boto3.client('s3')
@@ -1709,6 +1715,10 @@ class AwsBatch(DockerBatchBase):
     def weather_dir(self):
         return self._weather_dir
 
+    @property
+    def batching_cfg(self):
+        return self.cfg['aws'].get('batching', {})
+
     @property
     def container_repo(self):
         repo_name = self.docker_image
@@ -1777,7 +1787,7 @@ class AwsBatch(DockerBatchBase):
         sns_env = AwsSNS(self.job_identifier, self.cfg['aws'], self.boto3_session)
         sns_env.clean()
 
-    def run_batch(self):
+    def run_batch(self, rerun_missing=False):
         """
         Run a batch of simulations using AWS Batch
 
@@ -1785,10 +1795,35 @@ class AwsBatch(DockerBatchBase):
             - perform the sampling
             - package and upload the assets, including weather
             - kick off a batch simulation on AWS
+
+        :param rerun_missing: instead of sampling, only run the simulations in the existing buildstock.csv that are
+            missing from the results on S3 or failed, defaults to False
+        :type rerun_missing: bool, optional
         """
 
-        # Generate buildstock.csv
-        buildstock_csv_filename = self.sampler.run_sampling()
+        first_job_num = 0
+        if rerun_missing:
+            buildstock_csv_filename = self.sampler.csv_path
+            if not os.path.isfile(buildstock_csv_filename):
+                raise FileNotFoundError(f'{buildstock_csv_filename} of the earlier run doesn\'t exist')
+            sim_output_dir = f"{self.s3_bucket}/{self.s3_bucket_prefix}/results/simulation_output"
+            fs = S3FileSystem()
+            df = pd.read_csv(buildstock_csv_filename, index_col=0)
+            missing_sims = postprocessing.find_missing_simulations(
+                fs, sim_output_dir, self.get_all_sims(df.index.tolist())
+            )
+            if not missing_sims:
+                logger.info('All the simulations have results, there is nothing to rerun.')
+                return
+            logger.info('Rerunning {} simulations'.format(len(missing_sims)))
+            first_job_num = max(
+                [int(re.search(r'results_job(\d+)\.json\.gz', x).group(1))
+                 for x in fs.glob(f'{sim_output_dir}/results_job*.json.gz')],
+                default=-1
+            ) + 1
+        else:
+            # Generate buildstock.csv
+            buildstock_csv_filename = self.sampler.run_sampling()
 
         # Compress and upload assets to S3
         with tempfile.TemporaryDirectory(prefix='bsb_') as tmpdir, tempfile.TemporaryDirectory(prefix='bsb_') as tmp_weather_dir:  # noqa: E501
@@ -1848,27 +1883,48 @@ class AwsBatch(DockerBatchBase):
             n_sims_per_job = max(n_sims_per_job, 2)
             logger.debug('Number of simulations per array job = {}'.format(n_sims_per_job))
 
-            baseline_sims = zip(building_ids, itertools.repeat(None))
-            upgrade_sims = itertools.product(building_ids, range(len(self.cfg.get('upgrades', []))))
-            all_sims = list(itertools.chain(baseline_sims, upgrade_sims))
-            random.shuffle(all_sims)
-            all_sims_iter = iter(all_sims)
+            all_sims = missing_sims if rerun_missing else self.get_all_sims(building_ids)
+
+            # Group the simulations in each job by weather file so each job downloads fewer of them and balance
+            # their predicted runtimes
+            batching_cfg = self.batching_cfg
+            if batching_cfg.get('group_by_weather', True):
+                epws_by_building = self.get_epws_by_building(
+                    buildstock_csv_filename,
+                    os.path.join(self.buildstock_dir, 'resources', 'options_lookup.tsv')
+                )
+            else:
+                epws_by_building = None
+            n_batches = math.ceil(len(all_sims) / n_sims_per_job)
+            runtime_model = self.get_runtime_model()
+            sim_cost = None if runtime_model is None else runtime_model.sim_cost(df)
+            if sim_cost is not None:
+                # Don't make the jobs so short that starting the container and downloading the inputs is most of it
+                predicted_runtime = sum(map(sim_cost, all_sims))
+                n_batches = max(1, min(n_batches, math.floor(predicted_runtime / (MIN_PREDICTED_JOB_MINUTES * 60))))
+                logger.debug('Predicted simulation time = {:.1f} hours in {} array jobs'.format(
+                    predicted_runtime / 3600, n_batches
+                ))
+            batches = batch_simulations(
+                all_sims,
+                n_batches,
+                epws_by_building=epws_by_building,
+                keep_buildings_together=batching_cfg.get('keep_buildings_together', False),
+                sim_cost=sim_cost
+            )
 
             os.makedirs(tmppath / 'jobs')
 
             logger.info('Queueing jobs')
-            for i in itertools.count(0):
-                batch = list(itertools.islice(all_sims_iter, n_sims_per_job))
-                if not batch:
-                    break
+            for i, batch in enumerate(batches):
                 job_json_filename = tmppath / 'jobs' / 'job{:05d}.json'.format(i)
                 with open(job_json_filename, 'w') as f:
                     json.dump({
-                        'job_num': i,
+                        'job_num': first_job_num + i,
                         'n_datapoints': n_datapoints,
                         'batch': batch,
                     }, f, indent=4)
-            array_size = i
+            array_size = len(batches)
             logger.debug('Array size = {}'.format(array_size))
 
             # Compress job jsons
@@ -1928,11 +1984,19 @@ class AwsBatch(DockerBatchBase):
         )
 
         job_env_cfg = self.cfg['aws'].get('job_environment', {})
+        memory = job_env_cfg.get('memory')
+        if memory is None:
+            if runtime_model is not None and runtime_model.peak_memory_mb:
+                # The simulations in a job run one at a time, leave some room above the most a pilot one used
+                memory = max(MIN_JOB_MEMORY_MB, math.ceil(runtime_model.peak_memory_mb * 1.25 / 256) * 256)
+                logger.info(f'Using {memory} MiB of memory per job from the calibrated peak memory')
+            else:
+                memory = 1024
         batch_env.create_job_definition(
             image_url,
             command=['python3.8', '-m', 'buildstockbatch.aws.aws'],
             vcpus=job_env_cfg.get('vcpus', 1),
-            memory=job_env_cfg.get('memory', 1024),
+            memory=memory,
             env_vars=env_vars
         )
 
@@ -1957,6 +2021,11 @@ class AwsBatch(DockerBatchBase):
 
         logger.info('Batch job submitted. Check your email to subscribe to notifications.')
 
+    def get_all_sims(self, building_ids):
+        baseline_sims = zip(building_ids, itertools.repeat(None))
+        upgrade_sims = itertools.product(building_ids, range(len(self.cfg.get('upgrades', []))))
+        return list(itertools.chain(baseline_sims, upgrade_sims))
+
     @classmethod
     def run_job(cls, job_id, bucket, prefix, job_name, region):
         """
@@ -1990,35 +2059,19 @@ class AwsBatch(DockerBatchBase):
         with tarfile.open(jobs_file_path, 'r') as tar_f:
             jobs_d = json.load(tar_f.extractfile(f'jobs/job{job_id:05d}.json'), encoding='utf-8')
         logger.debug('Number of simulations = {}'.format(len(jobs_d['batch'])))
+        # Jobs that rerun missing simulations are numbered after the ones that already wrote results
+        job_num = jobs_d.get('job_num', job_id)
 
         logger.debug('Getting weather files')
         weather_dir = sim_dir / 'weather'
         os.makedirs(weather_dir, exist_ok=True)
 
-        # Make a lookup of which parameter points to the weather file from options_lookup.tsv
-        with open(sim_dir / 'lib' / 'resources' / 'options_lookup.tsv', 'r', encoding='utf-8') as f:
-            tsv_reader = csv.reader(f, delimiter='\t')
-            next(tsv_reader)  # skip headers
-            param_name = None
-            epws_by_option = {}
-            for row in tsv_reader:
-                row_has_epw = [x.endswith('.epw') for x in row[2:]]
-                if sum(row_has_epw):
-                    if row[0] != param_name and param_name is not None:
-                        raise RuntimeError(f'The epw files are specified in options_lookup.tsv under more than one parameter type: {param_name}, {row[0]}')  # noqa: E501
-                    epw_filename = row[row_has_epw.index(True) + 2].split('=')[1]
-                    param_name = row[0]
-                    option_name = row[1]
-                    epws_by_option[option_name] = epw_filename
-
-        # Look through the buildstock.csv to find the appropriate location and epw
-        epws_to_download = set()
-        building_ids = [x[0] for x in jobs_d['batch']]
-        with open(sim_dir / 'lib' / 'housing_characteristics' / 'buildstock.csv', 'r', encoding='utf-8') as f:
-            csv_reader = csv.DictReader(f)
-            for row in csv_reader:
-                if int(row['Building']) in building_ids:
-                    epws_to_download.add(epws_by_option[row[param_name]])
+        # Find the weather files these simulations need
+        epws_by_building = cls.get_epws_by_building(
+            sim_dir / 'lib' / 'housing_characteristics' / 'buildstock.csv',
+            sim_dir / 'lib' / 'resources' / 'options_lookup.tsv'
+        )
+        epws_to_download = set(epws_by_building[x[0]] for x in jobs_d['batch'])
 
         # Download the epws needed for these simulations
         for epw_filename in epws_to_download:
@@ -2033,9 +2086,45 @@ class AwsBatch(DockerBatchBase):
         fs = S3FileSystem()
         local_fs = LocalFileSystem()
         reporting_measures = cfg.get('reporting_measures', [])
-        dpouts = []
+        results_columns = cfg.get('postprocessing', {}).get('columns')
+        finished_sims_dir = sim_dir.parent / 'finished_simulations'
         simulation_output_tar_filename = sim_dir.parent / 'simulation_outputs.tar.gz'
-        with tarfile.open(str(simulation_output_tar_filename), 'w:gz') as simout_tar:
+
+        def postprocess_sim(sim_id, building_id, upgrade_id, finished_sim_dir, timed_out=False):
+            # Clean Up simulation directory, a simulation that timed out is left as it is
+            if not timed_out:
+                cls.cleanup_sim_dir(
+                    finished_sim_dir,
+                    fs,
+                    f"{bucket}/{prefix}/results/simulation_output/timeseries",
+                    upgrade_id,
+                    building_id,
+                    **cls.get_cleanup_sim_dir_kwargs(cfg)
+                )
+
+            # Read data_point_out.json
+            dpout = postprocessing.read_simulation_outputs(
+                local_fs, reporting_measures, str(finished_sim_dir), upgrade_id, building_id, columns=results_columns
+            )
+            if timed_out:
+                dpout['completed_status'] = TIMEOUT_STATUS
+
+            # Add the rest of the simulation outputs to the tar archive
+            logger.info('Archiving simulation outputs')
+            simout_tar.add(str(finished_sim_dir), sim_id)
+            shutil.rmtree(finished_sim_dir)
+            return dpout
+
+        # If it's turned on, simulations that run much longer than the ones before them are killed so the job can
+        # move on
+        watchdog = RuntimeWatchdog.from_cfg(cfg.get('aws', {}).get('simulation_timeout'))
+
+        # The simulation outputs are cleaned up, read and archived in a background thread while the next
+        # simulation runs. There is one thread so they're archived in order.
+        with tarfile.open(str(simulation_output_tar_filename), 'w:gz') as simout_tar, \
+                ThreadPoolExecutor(max_workers=1) as postprocess_pool, \
+                SimulationExecutor(max_workers=1) as sim_executor:
+            dpout_futures = []
             for building_id, upgrade_idx in jobs_d['batch']:
                 upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
                 sim_id = f'bldg{building_id:07d}up{upgrade_id:02d}'
@@ -2046,61 +2135,46 @@ class AwsBatch(DockerBatchBase):
                     json.dump(osw, f, indent=4)
 
                 # Run Simulation
+                timeout = None if watchdog is None else watchdog.timeout(upgrade_id)
+                timed_out = False
                 with open(sim_dir / 'os_stdout.log', 'w') as f_out:
+                    logger.debug('Running {}'.format(sim_id))
+                    tick = time.time()
                     try:
-                        logger.debug('Running {}'.format(sim_id))
-                        subprocess.run(
-                            ['openstudio', 'run', '-w', 'in.osw'],
-                            check=True,
-                            stdout=f_out,
-                            stderr=subprocess.STDOUT,
-                            cwd=str(sim_dir)
-                        )
-                    except subprocess.CalledProcessError:
-                        logger.debug(f'Simulation failed: see {sim_id}/os_stdout.log')
-
-                # Clean Up simulation directory
-                cls.cleanup_sim_dir(
-                    sim_dir,
-                    fs,
-                    f"{bucket}/{prefix}/results/simulation_output/timeseries",
-                    upgrade_id,
-                    building_id
-                )
+                        returncode = sim_executor.submit(
+                            run_process, ['openstudio', 'run', '-w', 'in.osw'], stdout=f_out, cwd=sim_dir,
+                            timeout=timeout
+                        ).result()
+                    except asyncio.TimeoutError:
+                        logger.warning(f'Killed {sim_id} after {timeout / 60:.1f} minutes')
+                        timed_out = True
+                    else:
+                        if watchdog is not None:
+                            watchdog.record(upgrade_id, time.time() - tick)
+                        if returncode != 0:
+                            logger.debug(f'Simulation failed: see {sim_id}/os_stdout.log')
 
-                # Read data_point_out.json
-                dpout = postprocessing.read_simulation_outputs(
-                    local_fs, reporting_measures, str(sim_dir), upgrade_id, building_id
-                )
-                dpouts.append(dpout)
-
-                # Add the rest of the simulation outputs to the tar archive
-                logger.info('Archiving simulation outputs')
-                for dirpath, dirnames, filenames in os.walk(sim_dir):
-                    if dirpath == str(sim_dir):
-                        for dirname in set(dirnames).intersection(asset_dirs):
-                            dirnames.remove(dirname)
-                    for filename in filenames:
-                        abspath = os.path.join(dirpath, filename)
-                        relpath = os.path.relpath(abspath, sim_dir)
-                        simout_tar.add(abspath, os.path.join(sim_id, relpath))
-
-                # Clear directory for next simulation
+                # Move the simulation outputs out of the way so the next simulation can start
                 logger.debug('Clearing out simulation directory')
+                finished_sim_dir = finished_sims_dir / sim_id
+                os.makedirs(finished_sim_dir)
                 for item in set(os.listdir(sim_dir)).difference(asset_dirs):
-                    if os.path.isdir(item):
-                        shutil.rmtree(item)
-                    elif os.path.isfile(item):
-                        os.remove(item)
+                    os.rename(sim_dir / item, finished_sim_dir / item)
+                dpout_futures.append(
+                    postprocess_pool.submit(
+                        postprocess_sim, sim_id, building_id, upgrade_id, finished_sim_dir, timed_out
+                    )
+                )
+            dpouts = [f.result() for f in dpout_futures]
 
         # Upload simulation outputs tarfile to s3
         fs.put(
             str(simulation_output_tar_filename),
-            f'{bucket}/{prefix}/results/simulation_output/simulations_job{job_id}.tar.gz'
+            f'{bucket}/{prefix}/results/simulation_output/simulations_job{job_num}.tar.gz'
         )
 
         # Upload aggregated dpouts as a json file
-        with fs.open(f'{bucket}/{prefix}/results/simulation_output/results_job{job_id}.json.gz', 'wb') as f1:
+        with fs.open(f'{bucket}/{prefix}/results/simulation_output/results_job{job_num}.json.gz', 'wb') as f1:
             with gzip.open(f1, 'wt', encoding='utf-8') as f2:
                 json.dump(dpouts, f2)
 
@@ -2166,6 +2240,11 @@ def main():
             help='Only validate the project YAML file and references. Nothing is executed',
             action='store_true'
         )
+        parser.add_argument(
+            '--rerun-missing',
+            help='Only rerun the simulations of an earlier run that are missing or failed',
+            action='store_true'
+        )
         args = parser.parse_args()
 
         # validate the project, and in case of the --validateonly flag return True if validation passes
@@ -2179,7 +2258,7 @@ def main():
         else:
             batch.build_image()
             batch.push_image()
-            batch.run_batch()
+            batch.run_batch(rerun_missing=args.rerun_missing)
 
 
 if __name__ == '__main__':
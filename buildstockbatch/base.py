@@ -31,6 +31,7 @@ from buildstockbatch import (
     postprocessing
 )
 from buildstockbatch.exc import SimulationExists, ValidationError
+from buildstockbatch.scheduling import RuntimeModel, select_pilot_sims
 from buildstockbatch.utils import path_rel_to_file, get_project_configuration
 
 logger = logging.getLogger(__name__)
@@ -108,6 +109,117 @@ class BuildStockBatchBase(object):
                     logger.debug('Extracting weather files to: {}'.format(self.weather_dir))
                     zf.extractall(self.weather_dir)
 
+    @staticmethod
+    def get_epws_by_building(buildstock_csv_filename, options_lookup_filename):
+        """Find the weather file each building is simulated with
+
+        The parameter whose options point to the weather files is found in ``options_lookup.tsv``.
+
+        :param buildstock_csv_filename: sampled buildstock.csv
+        :type buildstock_csv_filename: str
+        :param options_lookup_filename: options_lookup.tsv in the buildstock resources
+        :type options_lookup_filename: str
+        :return: epw filename by building id, empty if no parameter has weather files
+        :rtype: dict
+        """
+        # Make a lookup of which parameter points to the weather file from options_lookup.tsv
+        with open(options_lookup_filename, 'r', encoding='utf-8') as f:
+            tsv_reader = csv.reader(f, delimiter='\t')
+            next(tsv_reader)  # skip headers
+            param_name = None
+            epws_by_option = {}
+            for row in tsv_reader:
+                row_has_epw = [x.endswith('.epw') for x in row[2:]]
+                if sum(row_has_epw):
+                    if row[0] != param_name and param_name is not None:
+                        raise RuntimeError(f'The epw files are specified in options_lookup.tsv under more than one parameter type: {param_name}, {row[0]}')  # noqa: E501
+                    epw_filename = row[row_has_epw.index(True) + 2].split('=')[1]
+                    param_name = row[0]
+                    option_name = row[1]
+                    epws_by_option[option_name] = epw_filename
+        if param_name is None:
+            return {}
+
+        # Look through the buildstock.csv to find the appropriate location and epw
+        with open(buildstock_csv_filename, 'r', encoding='utf-8') as f:
+            csv_reader = csv.DictReader(f)
+            return {int(row['Building']): epws_by_option[row[param_name]] for row in csv_reader}
+
+    @property
+    def batching_cfg(self):
+        """``batching`` configuration of the runner"""
+        return {}
+
+    @property
+    def calibration_filename(self):
+        """Calibration file written by :meth:`run_pilot`, next to the project file"""
+        return os.path.splitext(self.project_filename)[0] + '_calibration.json'
+
+    def get_runtime_model(self):
+        """Load the runtime model in the ``batching`` configuration, or else the pilot's calibration file
+
+        :return: runtime model, None if there isn't one
+        :rtype: RuntimeModel
+        """
+        if 'runtime_model' in self.batching_cfg:
+            runtime_model_filename = self.path_rel_to_projectfile(self.batching_cfg['runtime_model'])
+        elif os.path.exists(self.calibration_filename):
+            runtime_model_filename = self.calibration_filename
+        else:
+            return None
+        runtime_model = RuntimeModel.load(
+            runtime_model_filename,
+            self.batching_cfg.get('runtime_model_features', [])
+        )
+        logger.info(f'Predicting simulation runtimes from {runtime_model_filename}')
+        return runtime_model
+
+    def run_pilot(self, n_sims):
+        """Run a few simulations to calibrate the runtime and memory of the rest
+
+        The simulations are spread over the upgrades and the ``batching.runtime_model_features`` of the buildings.
+        Their runtimes and peak memory are saved as a :class:`~buildstockbatch.scheduling.RuntimeModel` in
+        :attr:`calibration_filename`, which the batch uses when it's run.
+
+        :param n_sims: number of simulations to run
+        :type n_sims: int
+        :return: the fitted runtime model
+        :rtype: RuntimeModel
+        """
+        buildstock_csv_filename = self.sampler.run_sampling()
+        df = pd.read_csv(buildstock_csv_filename, index_col=0)
+        features = self.batching_cfg.get('runtime_model_features', [])
+        sims = select_pilot_sims(
+            df, n_sims, len(self.cfg.get('upgrades', [])), features, skip_baseline=self.skip_baseline_sims
+        )
+        logger.info(f'Running {len(sims)} pilot simulations')
+        measurements_df = pd.DataFrame.from_records(
+            self.run_pilot_sims(sims, len(df)),
+            columns=['building_id', 'upgrade', 'completed_status', 'runtime_s', 'peak_memory_mb']
+        )
+        runtime_model = RuntimeModel.fit(measurements_df, df, features)
+        runtime_model.save(self.calibration_filename)
+        n_success = (measurements_df['completed_status'] == 'Success').sum()
+        logger.info(
+            f'{n_success} of {len(sims)} pilot simulations succeeded, median runtime '
+            f'{runtime_model.runtimes.get((), float("nan")) / 60:.1f} minutes, '
+            f'peak memory {runtime_model.peak_memory_mb} MiB. Wrote {self.calibration_filename}'
+        )
+        return runtime_model
+
+    def run_pilot_sims(self, sims, n_datapoints):
+        """Run the pilot simulations
+
+        :param sims: ``(building_id, upgrade_idx)`` of each simulation
+        :type sims: list
+        :param n_datapoints: number of buildings in the sample
+        :type n_datapoints: int
+        :return: dicts of ``building_id``, ``upgrade``, ``completed_status``, ``runtime_s`` and ``peak_memory_mb``,
+            which is None where it can't be measured
+        :rtype: list
+        """
+        raise NotImplementedError
+
     @property
     def weather_dir(self):
         raise NotImplementedError
@@ -155,7 +267,19 @@ class BuildStockBatchBase(object):
         return sim_id, sim_dir
 
     @staticmethod
-    def cleanup_sim_dir(sim_dir, dest_fs, simout_ts_dir, upgrade_id, building_id):
+    def get_cleanup_sim_dir_kwargs(cfg):
+        """Keyword arguments for :meth:`cleanup_sim_dir` from the project configuration
+
+        :param cfg: project configuration
+        :type cfg: dict
+        :return: keyword arguments
+        :rtype: dict
+        """
+        postprocessing_cfg = cfg.get('postprocessing', {})
+        return {'dedupe_timestamps': postprocessing_cfg.get('deduplicate_timestamps', False)}
+
+    @staticmethod
+    def cleanup_sim_dir(sim_dir, dest_fs, simout_ts_dir, upgrade_id, building_id, dedupe_timestamps=False):
         """Clean up the output directory for a single simulation.
 
         :param sim_dir: simulation directory
@@ -168,28 +292,37 @@ class BuildStockBatchBase(object):
         :type upgrade_id: int
         :param building_id: building id from buildstock.csv
         :type building_id: int
+        :param dedupe_timestamps: replace the time columns with an index into a shared time axis, defaults to False
+        :type dedupe_timestamps: bool, optional
         """
 
         # Convert the timeseries data to parquet
         # and copy it to the results directory
         timeseries_filepath = os.path.join(sim_dir, 'run', 'enduse_timeseries.csv')
         schedules_filepath = os.path.join(sim_dir, 'generated_files', 'schedules.csv')
+        tbl = None
         if os.path.isfile(timeseries_filepath):
-            # Find the time columns present in the enduse_timeseries file
-            possible_time_cols = ['time', 'Time', 'TimeDST', 'TimeUTC']
-            cols = pd.read_csv(timeseries_filepath, index_col=False, nrows=0).columns.tolist()
-            actual_time_cols = [c for c in cols if c in possible_time_cols]
-            if not actual_time_cols:
-                logger.error(f'Did not find any time column ({possible_time_cols}) in enduse_timeseries.csv.')
-                raise RuntimeError(f'Did not find any time column ({possible_time_cols}) in enduse_timeseries.csv.')
-            tsdf = pd.read_csv(timeseries_filepath, parse_dates=actual_time_cols)
+            try:
+                tbl, actual_time_cols = postprocessing.read_enduse_timeseries_csv(timeseries_filepath)
+            except RuntimeError as ex:
+                logger.error(str(ex))
+                raise
+        if tbl is not None:
             if os.path.isfile(schedules_filepath):
+                # Schedules are inputs that are often the same for many buildings. Store each distinct schedule once
+                # and reference it from the timeseries with the schedule row each timestep used, which is shifted
+                # for daylight saving time.
                 schedules = pd.read_csv(schedules_filepath)
-                schedules.rename(columns=lambda x: f'schedules_{x}', inplace=True)
-                schedules['TimeDST'] = tsdf['Time']
-                tsdf = tsdf.merge(schedules, how='left', on='TimeDST')
-            postprocessing.write_dataframe_as_parquet(
-                tsdf,
+                schedules_id = postprocessing.write_deduplicated_table(
+                    schedules, dest_fs, f'{simout_ts_dir}/schedules'
+                )
+                tbl = postprocessing.add_schedules_reference(tbl, schedules_id, len(schedules))
+            if dedupe_timestamps:
+                tbl = postprocessing.dedupe_timeseries_timestamps(
+                    tbl, actual_time_cols, dest_fs, f'{simout_ts_dir}/time_axes'
+                )
+            postprocessing.write_table_as_parquet(
+                tbl,
                 dest_fs,
                 f'{simout_ts_dir}/up{upgrade_id:02d}/bldg{building_id:07d}.parquet'
             )
@@ -544,6 +677,8 @@ class BuildStockBatchBase(object):
         fs = LocalFileSystem()
         if not skip_combine:
             postprocessing.combine_results(fs, self.results_dir, self.cfg, do_timeseries=do_timeseries)
+            if 'sqlite' in self.cfg.get('postprocessing', {}):
+                postprocessing.write_results_sqlite(self.results_dir, self.cfg, do_timeseries=do_timeseries)
 
         aws_conf = self.cfg.get('postprocessing', {}).get('aws', {})
         if 's3' in aws_conf or force_upload:
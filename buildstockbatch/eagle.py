@@ -11,30 +11,41 @@ This class contains the object & methods that allow for usage of the library wit
 """
 
 import argparse
+import asyncio
+import contextlib
 from dask.distributed import Client, LocalCluster
 import datetime as dt
+import fcntl
+import functools
 from fsspec.implementations.local import LocalFileSystem
 import gzip
+import hashlib
 import itertools
-from joblib import delayed, Parallel
+from joblib import cpu_count
 import json
 import logging
 import math
+import multiprocessing
 import os
 import pandas as pd
 import pathlib
-import random
 import re
 import requests
+import resource
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import yaml
 
 from buildstockbatch.base import BuildStockBatchBase, SimulationExists
-from buildstockbatch.utils import log_error_details, get_error_details, ContainerRuntime
+from buildstockbatch.executor import run_process, SimulationExecutor
+from buildstockbatch.scheduling import available_memory_mb, batch_simulations, order_longest_first, PeakMemorySampler, \
+    predict_makespan, run_admitted, NODE_MEMORY_FRACTION, PREDICTED_WALLTIME_FACTOR, RuntimeModel, RuntimeWatchdog, \
+    TIMEOUT_STATUS, WorkQueue
+from buildstockbatch.utils import log_error_details, get_error_details, ContainerRuntime, run_pipelined
 from buildstockbatch import postprocessing
 
 logger = logging.getLogger(__name__)
@@ -50,7 +61,11 @@ class EagleBatch(BuildStockBatchBase):
 
     sys_image_dir = '/shared-projects/buildstock/singularity_images'
     hpc_name = 'eagle'
-    min_sims_per_job = 36 * 2
+    cores_per_node = 36
+    min_sims_per_job = cores_per_node * 2
+    work_queue_chunk_size = 8
+    # Most of a work queue job's wall time that is kept for finishing the last claimed simulations and saving results
+    work_queue_max_margin_fraction = 0.25
 
     local_scratch = pathlib.Path('/tmp/scratch')
     local_project_dir = local_scratch / 'project'
@@ -87,12 +102,131 @@ class EagleBatch(BuildStockBatchBase):
         assert(os.path.isdir(results_dir))
         return results_dir
 
+    @property
+    def batching_cfg(self):
+        return self.cfg[self.hpc_name].get('batching', {})
+
+    @property
+    def work_queue_dir(self):
+        return os.path.join(self.output_dir, 'work_queue')
+
+    @property
+    def runtime_model_filename(self):
+        return os.path.join(self.output_dir, 'runtime_model.json')
+
     @staticmethod
     def clear_and_copy_dir(src, dst):
         if os.path.exists(dst):
             shutil.rmtree(dst, ignore_errors=True)
         shutil.copytree(src, dst)
 
+    @staticmethod
+    def path_fingerprint(path):
+        """Hash of the relative names, sizes and modification times of a file or the files in a directory
+
+        Reading the contents to hash them would take as long as copying them, so it's a stand in for that.
+
+        :param path: file or directory
+        :return: hex digest, None if the path doesn't exist
+        """
+        if path is None:
+            return None
+        path = pathlib.Path(path)
+        if path.is_file():
+            files = [path]
+        elif path.is_dir():
+            files = sorted(x for x in path.rglob('*') if x.is_file())
+        else:
+            return None
+        h = hashlib.sha256()
+        for filename in files:
+            st = filename.stat()
+            h.update(f'{filename.relative_to(path).as_posix()}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode('utf-8'))
+        return h.hexdigest()
+
+    @classmethod
+    @contextlib.contextmanager
+    def stage_to_local_scratch(cls, items):
+        """Copy files and directories to local scratch, skipping the ones that are already there
+
+        What was copied is kept in a manifest in local scratch, along with the fingerprint of its source from
+        :meth:`path_fingerprint`. A source is only copied when its fingerprint is different from the one in the
+        manifest, so jobs of the same project that run one after another on a node only copy once.
+
+        Jobs on the same node hold a shared "in use" lock on local scratch while they run. The manifest is checked
+        and the copies are made under a separate copy lock that's only held while copying, so a job that adds
+        inputs, like more weather files, doesn't wait for the other jobs to finish. Only a job that has to replace
+        inputs that are already there waits for the in use lock to itself, so it doesn't replace the inputs of a
+        job that's still running, and then checks the manifest again.
+
+        :param items: (source, destination) pairs, the source is a file or a directory
+        :type items: list[tuple]
+        """
+        os.makedirs(cls.local_scratch, exist_ok=True)
+        manifest_filename = cls.local_scratch / 'staged.json'
+        fingerprints = [(src, dst, cls.path_fingerprint(src)) for src, dst in items]
+
+        def read_manifest():
+            try:
+                with open(manifest_filename, 'r') as f:
+                    return json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return {}
+
+        def to_copy():
+            manifest = read_manifest()
+            return [
+                (src, dst, fingerprint) for src, dst, fingerprint in fingerprints
+                if fingerprint is None or manifest.get(str(dst)) != fingerprint or not os.path.exists(dst)
+            ]
+
+        def copy(items_to_copy):
+            # Take what's being copied out of the manifest first, so a copy that's interrupted isn't taken as done
+            manifest = read_manifest()
+            for _, dst, _ in items_to_copy:
+                manifest.pop(str(dst), None)
+            with open(manifest_filename, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            for src, dst, fingerprint in items_to_copy:
+                logger.debug(f'Copying {src} to {dst}')
+                if src is not None and os.path.isdir(src):
+                    cls.clear_and_copy_dir(src, dst)
+                else:
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    shutil.copy2(src, dst)
+                if fingerprint is not None:
+                    manifest[str(dst)] = fingerprint
+            with open(manifest_filename, 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+        with open(cls.local_scratch / 'staged.lock', 'a') as in_use_lock, \
+                open(cls.local_scratch / 'staged_copy.lock', 'a') as copy_lock:
+            fcntl.flock(in_use_lock, fcntl.LOCK_SH)
+            try:
+                fcntl.flock(copy_lock, fcntl.LOCK_EX)
+                try:
+                    items_to_copy = to_copy()
+                    if any(os.path.exists(dst) for _, dst, _ in items_to_copy):
+                        # Replacing inputs another job may be using, wait until no other job is running. The copy
+                        # lock isn't held while waiting so the others can still stage what they add.
+                        logger.info('Waiting for the other jobs on the node to replace the inputs in local scratch')
+                        fcntl.flock(copy_lock, fcntl.LOCK_UN)
+                        fcntl.flock(in_use_lock, fcntl.LOCK_EX)
+                        fcntl.flock(copy_lock, fcntl.LOCK_EX)
+                        copy(to_copy())
+                        fcntl.flock(in_use_lock, fcntl.LOCK_SH)
+                    elif items_to_copy:
+                        copy(items_to_copy)
+                    else:
+                        logger.debug('The inputs are already in local scratch')
+                finally:
+                    fcntl.flock(copy_lock, fcntl.LOCK_UN)
+                yield
+            finally:
+                fcntl.flock(in_use_lock, fcntl.LOCK_UN)
+
     @property
     def singularity_image_url(self):
         return 'https://s3.amazonaws.com/openstudio-builds/{ver}/OpenStudio-{ver}.{sha}-Singularity.simg'.format(
@@ -144,13 +278,12 @@ class EagleBatch(BuildStockBatchBase):
             self._get_weather_files()
         return weather_dir
 
-    def run_batch(self, sampling_only=False):
-
+    def prepare_output_dir(self):
         # Create simulation_output dir
         sim_out_ts_dir = pathlib.Path(self.output_dir) / 'results' / 'simulation_output' / 'timeseries'
         os.makedirs(sim_out_ts_dir, exist_ok=True)
         for i in range(0, len(self.cfg.get('upgrades', [])) + 1):
-            os.makedirs(sim_out_ts_dir / f'up{i:02d}')
+            os.makedirs(sim_out_ts_dir / f'up{i:02d}', exist_ok=True)
 
         # create destination_dir and copy housing_characteristics into it
         logger.debug("Copying housing characteristics")
@@ -163,6 +296,9 @@ class EagleBatch(BuildStockBatchBase):
         )
         logger.debug("Housing characteristics copied.")
 
+    def run_batch(self, sampling_only=False):
+        self.prepare_output_dir()
+
         # run sampling
         buildstock_csv_filename = self.sampler.run_sampling()
 
@@ -177,8 +313,64 @@ class EagleBatch(BuildStockBatchBase):
         df = pd.read_csv(buildstock_csv_filename, index_col=0)
 
         # find out how many buildings there are to simulate
-        building_ids = df.index.tolist()
-        n_datapoints = len(building_ids)
+        all_sims = self.get_all_sims(df.index.tolist())
+        self.write_job_jsons(all_sims, buildstock_csv_filename, df, self.get_n_sims_per_job(len(df)))
+
+        # now queue them
+        jobids = self.queue_jobs()
+
+        # queue up post-processing to run after all the simulation jobs are complete
+        if not get_bool_env_var('MEASURESONLY'):
+            self.queue_post_processing(jobids)
+
+    def rerun_missing(self, hipri=False):
+        """Queue jobs for only the simulations of an earlier run that are missing or failed
+
+        The simulations expected from buildstock.csv and the upgrades are checked against the results the jobs
+        wrote. The ones that still need to run are batched into new jobs, numbered after the existing ones, so
+        their results end up in the same results directory, and postprocessing is queued after them.
+
+        :return: the slurm job ids, empty if nothing needs to run again
+        :rtype: list
+        """
+        for dirname in ('parquet', 'results_csvs'):
+            if os.path.exists(os.path.join(self.results_dir, dirname)):
+                raise FileExistsError(
+                    f'{os.path.join(self.results_dir, dirname)} already exists, the simulations have been '
+                    'postprocessed. Please delete it before rerunning the missing simulations.'
+                )
+
+        buildstock_csv_filename = self.sampler.csv_path
+        df = pd.read_csv(buildstock_csv_filename, index_col=0)
+        all_sims = self.get_all_sims(df.index.tolist())
+        missing_sims = postprocessing.find_missing_simulations(
+            LocalFileSystem(),
+            os.path.join(self.results_dir, 'simulation_output'),
+            all_sims
+        )
+        if not missing_sims:
+            logger.info('All {} simulations have results, there is nothing to rerun.'.format(len(all_sims)))
+            return []
+        logger.info('Rerunning {} of {} simulations'.format(len(missing_sims), len(all_sims)))
+
+        jobjson_re = re.compile(r'job(\d+).json')
+        last_job_num = max(
+            [int(m.group(1)) for m in map(jobjson_re.match, os.listdir(self.output_dir)) if m is not None],
+            default=0
+        )
+        job_nums = self.write_job_jsons(
+            missing_sims,
+            buildstock_csv_filename,
+            df,
+            self.get_n_sims_per_job(len(df)),
+            first_job_num=last_job_num + 1
+        )
+        jobids = self.queue_jobs(array_ids=job_nums, hipri=hipri)
+        if not get_bool_env_var('MEASURESONLY'):
+            self.queue_post_processing(jobids, hipri=hipri)
+        return jobids
+
+    def get_n_sims_per_job(self, n_datapoints):
         # number of simulations is number of buildings * number of upgrades
         n_sims = n_datapoints * (len(self.cfg.get('upgrades', [])) + 1)
 
@@ -187,8 +379,9 @@ class EagleBatch(BuildStockBatchBase):
         n_sims_per_job = math.ceil(n_sims / self.cfg[self.hpc_name]['n_jobs'])
         #     use more appropriate batch size in the case of n_jobs being much
         #     larger than we need, now that we know n_sims
-        n_sims_per_job = max(n_sims_per_job, self.min_sims_per_job)
+        return max(n_sims_per_job, self.min_sims_per_job)
 
+    def get_all_sims(self, building_ids):
         upgrade_sims = itertools.product(building_ids, range(len(self.cfg.get('upgrades', []))))
         if not self.skip_baseline_sims:
             # create batches of simulations
@@ -196,75 +389,284 @@ class EagleBatch(BuildStockBatchBase):
             all_sims = list(itertools.chain(baseline_sims, upgrade_sims))
         else:
             all_sims = list(itertools.chain(upgrade_sims))
-        random.shuffle(all_sims)
-        all_sims_iter = iter(all_sims)
+        return all_sims
+
+    def write_job_jsons(self, sims, buildstock_csv_filename, df, n_sims_per_job, first_job_num=1):
+        """Batch the simulations into jobs and write a job json for each
+
+        :param sims: ``(building_id, upgrade_idx)`` simulations to run
+        :type sims: list[tuple]
+        :param buildstock_csv_filename: buildstock.csv the buildings are from
+        :type buildstock_csv_filename: str
+        :param df: contents of buildstock.csv
+        :type df: pandas.DataFrame
+        :param n_sims_per_job: number of simulations in a full job
+        :type n_sims_per_job: int
+        :param first_job_num: number of the first job, defaults to 1
+        :type first_job_num: int, optional
+        :return: job numbers
+        :rtype: list[int]
+        """
+        n_datapoints = len(df)
+        # Find the weather files each building needs so the jobs only copy those
+        epws_by_building = self.get_epws_by_building(
+            buildstock_csv_filename,
+            os.path.join(self.buildstock_dir, 'resources', 'options_lookup.tsv')
+        )
+        if not all(os.path.isfile(os.path.join(self.weather_dir, x)) for x in set(epws_by_building.values())):
+            logger.warning('Some weather files in options_lookup.tsv are not in the weather files, using all of them.')
+            epws_by_building = {}
+
+        # Group the simulations in each job by weather file and balance their predicted runtimes
+        batching_cfg = self.batching_cfg
+        runtime_model = self.get_runtime_model()
+        sim_cost = None if runtime_model is None else runtime_model.sim_cost(df)
+        # The jobs use it to predict the memory of their simulations
+        if runtime_model is not None:
+            runtime_model.save(self.runtime_model_filename)
+        elif os.path.exists(self.runtime_model_filename):
+            os.remove(self.runtime_model_filename)
+        batches = batch_simulations(
+            sims,
+            math.ceil(len(sims) / n_sims_per_job),
+            epws_by_building=epws_by_building if batching_cfg.get('group_by_weather', True) else None,
+            keep_buildings_together=batching_cfg.get('keep_buildings_together', False),
+            sim_cost=sim_cost
+        )
 
-        for i in itertools.count(1):
-            batch = list(itertools.islice(all_sims_iter, n_sims_per_job))
-            if not batch:
-                break
+        work_queue = None
+        if batching_cfg.get('work_queue', False):
+            if os.path.exists(self.work_queue_dir):
+                shutil.rmtree(self.work_queue_dir)
+            work_queue = WorkQueue(self.work_queue_dir)
+        job_nums = []
+        for i, batch in enumerate(batches, first_job_num):
             logger.info('Queueing job {} ({} simulations)'.format(i, len(batch)))
+            job_json = {
+                'job_num': i,
+                'n_datapoints': n_datapoints,
+                'batch': batch,
+            }
+            if sim_cost is not None:
+                job_json['batch'] = order_longest_first(batch, sim_cost)
+                job_json['predicted_runtime_s'] = predict_makespan(map(sim_cost, batch), self.cores_per_node)
+            if work_queue is not None:
+                # Any job can end up running any simulation, so they all stage every weather file
+                work_queue.put(
+                    i, job_json['batch'], batching_cfg.get('work_queue_chunk_size', self.work_queue_chunk_size)
+                )
+                job_json['work_queue'] = True
+            elif all(bldg_id in epws_by_building for bldg_id, _ in batch):
+                job_json['weather_files'] = sorted(set(epws_by_building[bldg_id] for bldg_id, _ in batch))
             job_json_filename = os.path.join(self.output_dir, 'job{:03d}.json'.format(i))
             with open(job_json_filename, 'w') as f:
-                json.dump({
-                    'job_num': i,
-                    'n_datapoints': n_datapoints,
-                    'batch': batch,
-                }, f, indent=4)
-
-        # now queue them
-        jobids = self.queue_jobs()
-
-        # queue up post-processing to run after all the simulation jobs are complete
-        if not get_bool_env_var('MEASURESONLY'):
-            self.queue_post_processing(jobids)
+                json.dump(job_json, f, indent=4)
+            job_nums.append(i)
+        return job_nums
 
     def run_job_batch(self, job_array_number):
+        # Stop claiming simulations from the work queue in time to save the results before the wall time is up
+        deadline = None
+        if os.environ.get('JOB_WALLTIME_MINUTES'):
+            deadline = self.get_work_queue_deadline(int(os.environ['JOB_WALLTIME_MINUTES']))
 
-        self.clear_and_copy_dir(
-            pathlib.Path(self.buildstock_dir) / 'resources',
-            self.local_buildstock_dir / 'resources'
-        )
-        self.clear_and_copy_dir(
-            pathlib.Path(self.buildstock_dir) / 'measures',
-            self.local_buildstock_dir / 'measures'
-        )
-        self.clear_and_copy_dir(
-            self.weather_dir,
-            self.local_weather_dir
-        )
-        self.clear_and_copy_dir(
-            pathlib.Path(self.output_dir) / 'housing_characteristics',
-            self.local_housing_characteristics_dir
-        )
-        if os.path.exists(self.local_singularity_img):
-            os.remove(self.local_singularity_img)
-        shutil.copy2(self.singularity_image, self.local_singularity_img)
-
-        # Run the job batch as normal
         job_json_filename = os.path.join(self.output_dir, 'job{:03d}.json'.format(job_array_number))
         with open(job_json_filename, 'r') as f:
             args = json.load(f)
 
+        # Copy the inputs to the node's local scratch, unless an earlier job on this node already did
+        with self.stage_to_local_scratch(self.get_items_to_stage(args.get('weather_files'))):
+            self._run_job_batch(job_array_number, args, deadline)
+
+    def get_work_queue_deadline(self, walltime_minutes, start=None):
+        """When a work queue job stops claiming simulations
+
+        It leaves time for a couple of simulations and saving the results, but never more than
+        :attr:`work_queue_max_margin_fraction` of the wall time, so short jobs still claim simulations.
+
+        :param walltime_minutes: wall time of the job
+        :type walltime_minutes: int
+        :param start: when the job started, now if None, defaults to None
+        :type start: float, optional
+        :return: time after which it doesn't claim any more
+        :rtype: float
+        """
+        if start is None:
+            start = time.time()
+        minutes_per_sim = self.cfg['eagle'].get('minutes_per_sim', 3)
+        margin_minutes = min(2 * minutes_per_sim + 10, walltime_minutes * self.work_queue_max_margin_fraction)
+        return start + (walltime_minutes - margin_minutes) * 60
+
+    def get_items_to_stage(self, weather_files=None):
+        """The ``(src, dst)`` inputs the simulations need copied to the node's local scratch
+
+        :param weather_files: only stage these weather files, all of them if None, defaults to None
+        :type weather_files: list, optional
+        """
+        items_to_stage = [
+            (pathlib.Path(self.buildstock_dir) / 'resources', self.local_buildstock_dir / 'resources'),
+            (pathlib.Path(self.buildstock_dir) / 'measures', self.local_buildstock_dir / 'measures'),
+            (pathlib.Path(self.output_dir) / 'housing_characteristics', self.local_housing_characteristics_dir),
+            (self.singularity_image, self.local_singularity_img),
+        ]
+        if weather_files is not None:
+            # Only the weather files the simulations in this job need
+            items_to_stage.extend(
+                (pathlib.Path(self.weather_dir) / epw_filename, self.local_weather_dir / epw_filename)
+                for epw_filename in weather_files
+            )
+        else:
+            items_to_stage.append((self.weather_dir, self.local_weather_dir))
+        return items_to_stage
+
+    def run_pilot(self, n_sims):
+        self.prepare_output_dir()
+        return super().run_pilot(n_sims)
+
+    def run_pilot_sims(self, sims, n_datapoints):
+        with self.stage_to_local_scratch(self.get_items_to_stage()):
+            # A new process for each simulation so its peak memory can be measured on its own. As many run at once as
+            # in _run_job_batch, so the runtimes calibrate the runtime model for the same load.
+            with multiprocessing.Pool(cpu_count(), maxtasksperchild=1) as pool:
+                return pool.starmap(
+                    functools.partial(self.run_pilot_sim, self.output_dir, self.cfg, n_datapoints),
+                    sims,
+                    chunksize=1
+                )
+
+    @classmethod
+    def run_pilot_sim(cls, output_dir, cfg, n_datapoints, i, upgrade_idx):
+        """Run a simulation and measure its runtime and the peak memory of the singularity container"""
+        upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
+        tick = time.time()
+        # The processes in the container run at the same time, their memory is added up
+        with PeakMemorySampler() as sampler:
+            try:
+                dpout = cls.run_building(output_dir, cfg, n_datapoints, i, upgrade_idx) or {}
+            except Exception:
+                logger.exception(f'Pilot simulation of building {i} upgrade {upgrade_id} failed')
+                dpout = {}
+        # ru_maxrss is in KiB on linux, it's the largest single process if the process tree couldn't be sampled
+        peak_memory_mb = max(sampler.peak_mb or 0, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+        return {
+            'building_id': i,
+            'upgrade': upgrade_id,
+            'completed_status': dpout.get('completed_status', 'Fail'),
+            'runtime_s': time.time() - tick,
+            'peak_memory_mb': peak_memory_mb,
+        }
+
+    def iter_work_queue(self, job_array_number, claimed_chunks, deadline=None):
+        """Claim simulations from the work queue until it's empty or the deadline has passed
+
+        :param claimed_chunks: the names of the claimed chunks are appended to this list
+        :type claimed_chunks: list
+        :param deadline: don't claim any more after this time, defaults to None
+        :type deadline: float, optional
+        """
+        work_queue = WorkQueue(self.work_queue_dir)
+        while deadline is None or time.time() < deadline:
+            claimed = work_queue.claim(job_array_number)
+            if claimed is None:
+                return
+            name, sims = claimed
+            logger.info(f'Claimed {len(sims)} simulations in {name}')
+            claimed_chunks.append(name)
+            yield from sims
+        logger.warning('Not claiming any more simulations, the job is nearly out of time')
+
+    def get_sim_memory(self):
+        """A function that predicts the peak memory of ``(building_id, upgrade_idx)`` in MiB
+
+        :return: None if there's no runtime model or it doesn't have the memory of the simulations
+        :rtype: callable
+        """
+        if not os.path.exists(self.runtime_model_filename):
+            return None
+        runtime_model = RuntimeModel.load(self.runtime_model_filename)
+        if runtime_model.features:
+            buildstock_df = pd.read_csv(self.local_housing_characteristics_dir / 'buildstock.csv', index_col=0)
+        else:
+            buildstock_df = pd.DataFrame()
+        return runtime_model.sim_memory(buildstock_df)
+
+    def _run_job_batch(self, job_array_number, args, deadline=None):
         traceback_file_path = self.local_output_dir / 'simulation_output' / f'traceback{job_array_number}.out'
 
-        @delayed
-        def run_building_d(i, upgrade_idx):
+        # Only written from the postprocessing threads in this process, nothing that holds the lock is sent anywhere
+        traceback_lock = threading.Lock()
+
+        def write_traceback(i, error_details):
+            with traceback_lock, open(traceback_file_path, 'a') as f:
+                txt = "\n" + "#" * 20 + "\n" + f"Traceback for building{i}\n" + error_details
+                f.write(txt)
+                del txt
+
+        async def run_sim(i, upgrade_idx):
+            upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
+            timeout = None if watchdog is None else watchdog.timeout(upgrade_id)
+            tick = time.time()
             try:
-                return self.run_building(self.output_dir, self.cfg, args['n_datapoints'], i, upgrade_idx)
+                dpout = await self.run_building_async(
+                    self.output_dir, self.cfg, args['n_datapoints'], i, upgrade_idx, postprocess=False,
+                    timeout=timeout
+                )
+                runtime = time.time() - tick
+                if watchdog is not None and (timeout is None or runtime < timeout):
+                    watchdog.record(upgrade_id, runtime)
+                return i, upgrade_idx, dpout, None
             except Exception:
-                with open(traceback_file_path, 'a') as f:
-                    txt = get_error_details()
-                    txt = "\n" + "#" * 20 + "\n" + f"Traceback for building{i}\n" + txt
-                    f.write(txt)
-                    del txt
+                # The traceback is written with the results, the error details are returned with them
+                return i, upgrade_idx, {"building_id": i, "upgrade": upgrade_id}, get_error_details()
+
+        def postprocess_building(sim_result):
+            i, upgrade_idx, dpout, error_details = sim_result
+            if error_details is not None:
+                write_traceback(i, error_details)
+            if not callable(dpout):
+                return dpout
+            try:
+                return dpout()
+            except Exception:
+                write_traceback(i, get_error_details())
                 upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
                 return {"building_id": i, "upgrade": upgrade_id}
 
-        # Run the simulations, get the data_point_out.json info from each
+        claimed_chunks = []
+        if args.get('work_queue'):
+            sims = self.iter_work_queue(job_array_number, claimed_chunks, deadline)
+        else:
+            sims = args['batch']
+
+        # A simulation is started when there's a core, hyperthreads included, for it. With memory predictions its
+        # predicted peak memory also has to fit in what the running ones leave.
+        sim_memory = self.get_sim_memory()
+        memory_mb = available_memory_mb()
+        max_running = cpu_count()
+        if sim_memory is None or memory_mb is None:
+            memory_mb = None
+        else:
+            memory_mb *= NODE_MEMORY_FRACTION
+            logger.info(f'Running up to {max_running} simulations at once in {memory_mb:.0f} MiB of memory')
+
+        # If it's turned on, simulations that run much longer than the ones before them, or than the pilot's, are
+        # killed so the core can move on
+        watchdog = RuntimeWatchdog.from_cfg(
+            self.cfg['eagle'].get('simulation_timeout'),
+            max_running=max_running,
+            runtime_model=RuntimeModel.load(self.runtime_model_filename)
+            if os.path.exists(self.runtime_model_filename) else None
+        )
+
+        # Run the simulations, get the data_point_out.json info from each. The simulation directories are cleaned
+        # up in background threads, as many as there are simulations running, while the next simulations start.
         tick = time.time()
-        with Parallel(n_jobs=-1, verbose=9) as parallel:
-            dpouts = parallel(itertools.starmap(run_building_d, args['batch']))
+        with SimulationExecutor() as executor:
+            dpouts = run_pipelined(
+                run_admitted(executor, run_sim, sims, max_running, memory_mb, sim_memory),
+                postprocess_building,
+                n_workers=max_running
+            )
         tick = time.time() - tick
         logger.info('Simulation time: {:.2f} minutes'.format(tick / 60.))
 
@@ -294,16 +696,38 @@ class EagleBatch(BuildStockBatchBase):
         if os.path.exists(traceback_file_path):
             shutil.copy2(traceback_file_path, lustre_sim_out_dir)
 
+        # The results of the claimed simulations are saved
+        if claimed_chunks:
+            WorkQueue(self.work_queue_dir).done(claimed_chunks)
+
     @classmethod
-    def run_building(cls, output_dir, cfg, n_datapoints, i, upgrade_idx=None):
+    def run_building(cls, output_dir, cfg, n_datapoints, i, upgrade_idx=None, postprocess=True):
+        """Run a simulation and read its results, see :meth:`run_building_async`"""
+        return asyncio.run(cls.run_building_async(output_dir, cfg, n_datapoints, i, upgrade_idx, postprocess))
 
-        fs = LocalFileSystem()
+    @classmethod
+    async def run_building_async(cls, output_dir, cfg, n_datapoints, i, upgrade_idx=None, postprocess=True,
+                                 timeout=None):
+        """Run a simulation and read its results
+
+        :param postprocess: clean up the simulation directory and read the results before returning. If False,
+            return a function that does that instead so it can be run after the next simulation has started,
+            defaults to True
+        :type postprocess: bool, optional
+        :param timeout: seconds after which the simulation is killed and its ``completed_status`` is ``Timeout``, no
+            limit if None, defaults to None
+        :type timeout: float, optional
+        :return: results of the simulation, or a function that returns them
+        """
         upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
 
+        cleanup = True
+        timed_out = False
         try:
             sim_id, sim_dir = cls.make_sim_dir(i, upgrade_idx, os.path.join(cls.local_output_dir, 'simulation_output'))
         except SimulationExists as ex:
             sim_dir = ex.sim_dir
+            cleanup = False
         else:
             # Generate the osw for this simulation
             osw = cls.create_osw(cfg, n_datapoints, sim_id, building_id=i, upgrade_idx=upgrade_idx)
@@ -351,16 +775,16 @@ class EagleBatch(BuildStockBatchBase):
             logger.debug('\n'.join(map(str, args)))
             with open(os.path.join(sim_dir, 'singularity_output.log'), 'w') as f_out:
                 try:
-                    subprocess.run(
+                    await run_process(
                         args,
-                        check=True,
-                        input='\n'.join(runscript).encode('utf-8'),
                         stdout=f_out,
-                        stderr=subprocess.STDOUT,
-                        cwd=cls.local_output_dir
+                        input='\n'.join(runscript).encode('utf-8'),
+                        cwd=cls.local_output_dir,
+                        timeout=timeout
                     )
-                except subprocess.CalledProcessError:
-                    pass
+                except asyncio.TimeoutError:
+                    logger.warning(f'Killed building {i} upgrade {upgrade_id} after {timeout / 60:.1f} minutes')
+                    timed_out = True
                 finally:
                     # Clean up the symbolic links we created in the container
                     for mount_dir in dirs_to_mount + [os.path.join(sim_dir, 'lib')]:
@@ -369,40 +793,66 @@ class EagleBatch(BuildStockBatchBase):
                         except FileNotFoundError:
                             pass
 
-                    # Clean up simulation directory
-                    cls.cleanup_sim_dir(
-                        sim_dir,
-                        fs,
-                        f'{output_dir}/results/simulation_output/timeseries',
-                        upgrade_id,
-                        i
-                    )
+        postprocess_building = functools.partial(
+            cls.postprocess_building, output_dir, cfg, sim_dir, i, upgrade_id, cleanup, timed_out
+        )
+        return postprocess_building() if postprocess else postprocess_building
+
+    @classmethod
+    def postprocess_building(cls, output_dir, cfg, sim_dir, i, upgrade_id, cleanup=True, timed_out=False):
+        """Clean up the simulation directory and read the results of a simulation run by :meth:`run_building`
+
+        The outputs of a simulation that timed out are left as they are, without timeseries.
+        """
+        fs = LocalFileSystem()
+        if cleanup and not timed_out:
+            cls.cleanup_sim_dir(
+                sim_dir,
+                fs,
+                f'{output_dir}/results/simulation_output/timeseries',
+                upgrade_id,
+                i,
+                **cls.get_cleanup_sim_dir_kwargs(cfg)
+            )
 
         reporting_measures = cfg.get('reporting_measures', [])
-        dpout = postprocessing.read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, i)
+        dpout = postprocessing.read_simulation_outputs(
+            fs, reporting_measures, sim_dir, upgrade_id, i, columns=cfg.get('postprocessing', {}).get('columns')
+        )
+        if timed_out:
+            dpout['completed_status'] = TIMEOUT_STATUS
         return dpout
 
-    def queue_jobs(self, array_ids=None):
+    def queue_jobs(self, array_ids=None, hipri=False):
         eagle_cfg = self.cfg['eagle']
         minutes_per_sim = eagle_cfg.get('minutes_per_sim', 3)
-        with open(os.path.join(self.output_dir, 'job001.json'), 'r') as f:
-            job_json = json.load(f)
-            n_sims_per_job = len(job_json['batch'])
-            del job_json
+        jobjson_re = re.compile(r'job(\d+).json')
         if array_ids:
             array_spec = ','.join(map(str, array_ids))
         else:
-            jobjson_re = re.compile(r'job(\d+).json')
-            array_max = max(map(
+            array_ids = sorted(map(
                 lambda m: int(m.group(1)),
                 filter(lambda m: m is not None, map(jobjson_re.match, (os.listdir(self.output_dir))))
             ))
-            array_spec = '1-{}'.format(array_max)
+            array_spec = '1-{}'.format(array_ids[-1])
+        with open(os.path.join(self.output_dir, 'job{:03d}.json'.format(array_ids[0])), 'r') as f:
+            job_json = json.load(f)
+            n_sims_per_job = len(job_json['batch'])
+            has_predicted_runtime = 'predicted_runtime_s' in job_json
+            uses_work_queue = job_json.get('work_queue', False)
+            del job_json
         account = eagle_cfg['account']
 
         # Estimate the wall time in minutes
-        cores_per_node = 36
-        walltime = math.ceil(math.ceil(n_sims_per_job / cores_per_node) * minutes_per_sim)
+        if has_predicted_runtime:
+            # The jobs in the array share a wall time, the longest one's predicted runtime
+            predicted_runtime = 0
+            for array_id in array_ids:
+                with open(os.path.join(self.output_dir, 'job{:03d}.json'.format(array_id)), 'r') as f:
+                    predicted_runtime = max(predicted_runtime, json.load(f)['predicted_runtime_s'])
+            walltime = max(math.ceil(predicted_runtime * PREDICTED_WALLTIME_FACTOR / 60), minutes_per_sim)
+        else:
+            walltime = math.ceil(math.ceil(n_sims_per_job / self.cores_per_node) * minutes_per_sim)
 
         # Queue up simulations
         here = os.path.dirname(os.path.abspath(__file__))
@@ -411,11 +861,15 @@ class EagleBatch(BuildStockBatchBase):
         env.update(os.environ)
         env['PROJECTFILE'] = self.project_filename
         env['MY_CONDA_ENV'] = os.environ['CONDA_PREFIX']
+        export_vars = ['PROJECTFILE', 'MY_CONDA_ENV', 'MEASURESONLY']
+        if uses_work_queue:
+            env['JOB_WALLTIME_MINUTES'] = str(walltime)
+            export_vars.append('JOB_WALLTIME_MINUTES')
         args = [
             'sbatch',
             '--account={}'.format(account),
             '--time={}'.format(walltime),
-            '--export=PROJECTFILE,MY_CONDA_ENV,MEASURESONLY',
+            '--export={}'.format(','.join(export_vars)),
             '--array={}'.format(array_spec),
             '--output=job.out-%a',
             '--job-name=bstk',
@@ -423,6 +877,8 @@ class EagleBatch(BuildStockBatchBase):
         ]
         if os.environ.get('SLURM_JOB_QOS'):
             args.insert(-1, '--qos={}'.format(os.environ.get('SLURM_JOB_QOS')))
+        elif hipri:
+            args.insert(-1, '--qos=high')
 
         logger.debug(' '.join(args))
         resp = subprocess.run(
@@ -597,6 +1053,18 @@ def user_cli(argv=sys.argv[1:]):
         help='Run the sampling only.',
         action='store_true'
     )
+    group.add_argument(
+        '--pilot',
+        type=int,
+        metavar='N',
+        help='Run N simulations spread over the upgrades and buildings to measure their runtime and memory. '
+             'Writes a calibration file next to the project file that later runs use to size the jobs.'
+    )
+    group.add_argument(
+        '--rerun-missing',
+        help='Only rerun the simulations of an earlier run that are missing or failed, and postprocess them all again',
+        action='store_true'
+    )
 
     # parse CLI arguments
     args = parser.parse_args(argv)
@@ -621,6 +1089,12 @@ def user_cli(argv=sys.argv[1:]):
         eagle_batch.queue_post_processing(upload_only=args.uploadonly, hipri=args.hipri)
         return True
 
+    # or queue jobs for the simulations it didn't finish
+    if args.rerun_missing:
+        eagle_batch = EagleBatch(project_filename)
+        eagle_batch.rerun_missing(hipri=args.hipri)
+        return True
+
     # otherwise, queue up the whole eagle buildstockbatch process
     # the main work of the first Eagle job is to run the sampling script ...
     eagle_sh = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eagle.sh')
@@ -638,13 +1112,20 @@ def user_cli(argv=sys.argv[1:]):
     env['MY_CONDA_ENV'] = os.environ['CONDA_PREFIX']
     env['MEASURESONLY'] = str(int(args.measures_only))
     env['SAMPLINGONLY'] = str(int(args.samplingonly))
+    export_vars = ['PROJECTFILE', 'MY_CONDA_ENV', 'MEASURESONLY', 'SAMPLINGONLY']
+    walltime = cfg['eagle'].get('sampling', {}).get('time', 60)
+    if args.pilot:
+        # The pilot simulations run on one node, leave time for the longest simulations allowed
+        env['PILOT'] = str(args.pilot)
+        export_vars.append('PILOT')
+        walltime += math.ceil(args.pilot / EagleBatch.cores_per_node) * 120
     subargs = [
         'sbatch',
-        '--time={}'.format(cfg['eagle'].get('sampling', {}).get('time', 60)),
+        '--time={}'.format(walltime),
         '--account={}'.format(cfg['eagle']['account']),
         '--nodes=1',
-        '--export=PROJECTFILE,MY_CONDA_ENV,MEASURESONLY,SAMPLINGONLY',
-        '--output=sampling.out',
+        '--export={}'.format(','.join(export_vars)),
+        '--output={}'.format('pilot.out' if args.pilot else 'sampling.out'),
         eagle_sh
     ]
     if args.hipri:
@@ -659,9 +1140,10 @@ def user_cli(argv=sys.argv[1:]):
 def main():
     """
     Determines which piece of work is to be run right now, on this process, on
-    this node. There are four types of work that may need to be done:
+    this node. There are five types of work that may need to be done:
 
     - initialization, sampling, and queuing other work (job_array_number == 0)
+    - sampling and a few simulations to calibrate the rest (job_array_number == 0 and PILOT)
     - run a batch of simulations (job_array_number > 0)
     - post-process results (job_array_number == 0 and POSTPROCESS)
     - upload results to Athena (job_array_number == 0 and POSTPROCESS and UPLOADONLY)
@@ -687,6 +1169,7 @@ def main():
     upload_only = get_bool_env_var('UPLOADONLY')
     measures_only = get_bool_env_var('MEASURESONLY')
     sampling_only = get_bool_env_var('SAMPLINGONLY')
+    pilot = int(os.environ.get('PILOT', 0))
     if job_array_number:
         # if job array number is non-zero, run the batch job
         # Simulation should not be scheduled for sampling only
@@ -702,6 +1185,9 @@ def main():
             batch.process_results(skip_combine=True, force_upload=True)
         else:
             batch.process_results()
+    elif pilot:
+        logger.debug("Starting pilot")
+        batch.run_pilot(pilot)
     else:
         logger.debug("Kicking off batch")
         # default job_array_number == 0 task is to kick the whole BuildStock
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""
+buildstockbatch.executor
+~~~~~~~~~~~~~~~~~~~~~~~~
+Running simulation processes from an asyncio event loop instead of from worker processes
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+async def run_process(args, stdout=None, input=None, cwd=None, timeout=None):
+    """Run a process and wait for it to finish
+
+    The process is started in a new session and if it's cancelled or takes longer than ``timeout`` the whole
+    session is killed, so nothing it started, like EnergyPlus inside a container, is left running.
+
+    :param args: command to run
+    :type args: list
+    :param stdout: file to write stdout and stderr to, inherited if None, defaults to None
+    :param input: bytes to write to stdin, defaults to None
+    :type input: bytes, optional
+    :param cwd: working directory, defaults to None
+    :param timeout: seconds to wait before killing it, no limit if None, defaults to None
+    :type timeout: float, optional
+    :return: exit code
+    :rtype: int
+    :raises asyncio.TimeoutError: if it took longer than ``timeout``
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *map(str, args),
+        stdin=subprocess.DEVNULL if input is None else subprocess.PIPE,
+        stdout=stdout,
+        stderr=None if stdout is None else subprocess.STDOUT,
+        cwd=None if cwd is None else str(cwd),
+        start_new_session=True
+    )
+    try:
+        await asyncio.wait_for(proc.communicate(input), timeout)
+    except BaseException:
+        if proc.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, signal.SIGKILL)
+            await asyncio.shield(proc.wait())
+        raise
+    return proc.returncode
+
+
+class SimulationExecutor(concurrent.futures.Executor):
+    """Runs simulations as tasks on an asyncio event loop in a background thread
+
+    :meth:`submit` takes coroutine functions, like ones that run a simulation with :func:`run_process`, and plain
+    functions, which are run in a thread. It returns a :class:`concurrent.futures.Future`. Cancelling it cancels the
+    task, which kills the simulation's process.
+    """
+
+    def __init__(self, max_workers=None, timeout=None):
+        """
+        :param max_workers: most tasks to run at once, no limit if None, defaults to None
+        :type max_workers: int, optional
+        :param timeout: seconds after which a task is cancelled and its future raises ``asyncio.TimeoutError``, no
+            limit if None, defaults to None
+        :type timeout: float, optional
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._semaphore = None
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='simulation')
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='SimulationExecutor', daemon=True)
+        self._thread.start()
+
+    async def _run(self, fn, args, kwargs):
+        # Made on the loop so it's attached to it on every python version
+        if self._semaphore is None and self.max_workers is not None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        async with self._semaphore or contextlib.AsyncExitStack():
+            if asyncio.iscoroutinefunction(fn):
+                aw = fn(*args, **kwargs)
+            else:
+                aw = self._loop.run_in_executor(self._thread_pool, functools.partial(fn, *args, **kwargs))
+            return await asyncio.wait_for(aw, self.timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            future = asyncio.run_coroutine_threadsafe(self._run(fn, args, kwargs), self._loop)
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    async def _drain(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            futures = list(self._futures)
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+
+        def stop():
+            # Cancelled tasks may still be killing their processes
+            asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread_pool.shutdown(wait=True)
+
+        if wait:
+            stop()
+            self._thread.join()
+            self._loop.close()
+        else:
+            threading.Thread(target=stop, daemon=True).start()
@@ -16,7 +16,6 @@ import functools
 from fsspec.implementations.local import LocalFileSystem
 import gzip
 import itertools
-from joblib import Parallel, delayed
 import json
 import logging
 import os
@@ -26,10 +25,13 @@ import shutil
 import sys
 import tarfile
 import tempfile
+import time
 
 from buildstockbatch.base import BuildStockBatchBase, SimulationExists
+from buildstockbatch.executor import SimulationExecutor
+from buildstockbatch.scheduling import run_admitted
 from buildstockbatch import postprocessing
-from .utils import log_error_details, ContainerRuntime
+from .utils import log_error_details, ContainerRuntime, run_pipelined
 
 logger = logging.getLogger(__name__)
 
@@ -87,8 +89,18 @@ class LocalDockerBatch(DockerBatchBase):
 
     @classmethod
     def run_building(cls, project_dir, buildstock_dir, weather_dir, docker_image, results_dir, measures_only,
-                     n_datapoints, cfg, i, upgrade_idx=None):
-
+                     n_datapoints, cfg, i, upgrade_idx=None, postprocess=True, weather_files=None):
+        """Run a simulation in a docker container and read its results
+
+        :param weather_files: filenames in ``weather_dir`` to mount in the container, all of them if None, defaults
+            to None
+        :type weather_files: list, optional
+        :param postprocess: clean up the simulation directory and read the results before returning. If False,
+            return a function that does that instead so it can be run after the next simulation has started,
+            defaults to True
+        :type postprocess: bool, optional
+        :return: results of the simulation, or a function that returns them
+        """
         upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
 
         try:
@@ -101,13 +113,25 @@ class LocalDockerBatch(DockerBatchBase):
             (os.path.join(buildstock_dir, 'measures'), 'measures', 'ro'),
             (os.path.join(buildstock_dir, 'resources'), 'lib/resources', 'ro'),
             (os.path.join(project_dir, 'housing_characteristics'), 'lib/housing_characteristics', 'ro'),
-            (weather_dir, 'weather', 'ro')
         ]
+        if weather_files is None:
+            bind_mounts.append((weather_dir, 'weather', 'ro'))
+        else:
+            bind_mounts.extend(
+                (os.path.join(weather_dir, epw_filename), f'weather/{epw_filename}', 'ro')
+                for epw_filename in weather_files
+            )
         docker_volume_mounts = dict([(key, {'bind': f'/var/simdata/openstudio/{bind}', 'mode': mode}) for key, bind, mode in bind_mounts])  # noqa E501
-        for bind in bind_mounts:
-            dir_to_make = os.path.join(sim_dir, *bind[1].split('/'))
-            if not os.path.exists(dir_to_make):
-                os.makedirs(dir_to_make)
+        for src, bind, _ in bind_mounts:
+            path_to_make = os.path.join(sim_dir, *bind.split('/'))
+            if os.path.exists(path_to_make):
+                continue
+            if os.path.isdir(src):
+                os.makedirs(path_to_make)
+            else:
+                # Files are mounted over an empty placeholder
+                os.makedirs(os.path.dirname(path_to_make), exist_ok=True)
+                open(path_to_make, 'a').close()
 
         osw = cls.create_osw(cfg, n_datapoints, sim_id, building_id=i, upgrade_idx=upgrade_idx)
 
@@ -140,20 +164,44 @@ class LocalDockerBatch(DockerBatchBase):
         for dirname in ('lib', 'measures', 'weather'):
             shutil.rmtree(os.path.join(sim_dir, dirname), ignore_errors=True)
 
+        postprocess_building = functools.partial(cls.postprocess_building, results_dir, cfg, sim_dir, i, upgrade_id)
+        return postprocess_building() if postprocess else postprocess_building
+
+    @classmethod
+    def postprocess_building(cls, results_dir, cfg, sim_dir, i, upgrade_id):
+        """Clean up the simulation directory and read the results of a simulation run by :meth:`run_building`"""
         fs = LocalFileSystem()
         cls.cleanup_sim_dir(
             sim_dir,
             fs,
             f"{results_dir}/simulation_output/timeseries",
             upgrade_id,
-            i
+            i,
+            **cls.get_cleanup_sim_dir_kwargs(cfg)
         )
 
         # Read data_point_out.json
         reporting_measures = cfg.get('reporting_measures', [])
-        dpout = postprocessing.read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, i)
+        dpout = postprocessing.read_simulation_outputs(
+            fs, reporting_measures, sim_dir, upgrade_id, i, columns=cfg.get('postprocessing', {}).get('columns')
+        )
         return dpout
 
+    @staticmethod
+    def get_n_jobs(n_jobs=None):
+        """The number of simulations to run at once, like joblib -1 is all the cores, -2 all but one and so on
+
+        :param n_jobs: number of simulations, all the cores available to docker if None, defaults to None
+        :type n_jobs: int, optional
+        :rtype: int
+        """
+        if n_jobs == 0:
+            raise ValueError('n_jobs == 0 has no meaning')
+        if n_jobs is None or n_jobs < 0:
+            client = docker.client.from_env()
+            n_jobs = max(client.info()['NCPU'] + 1 + (n_jobs or -1), 1)
+        return n_jobs
+
     def run_batch(self, n_jobs=None, measures_only=False, sampling_only=False):
         buildstock_csv_filename = self.sampler.run_sampling()
 
@@ -163,8 +211,18 @@ class LocalDockerBatch(DockerBatchBase):
         df = pd.read_csv(buildstock_csv_filename, index_col=0)
         building_ids = df.index.tolist()
         n_datapoints = len(building_ids)
-        run_building_d = functools.partial(
-            delayed(self.run_building),
+
+        # Only mount the weather file each building needs
+        epws_by_building = self.get_epws_by_building(
+            buildstock_csv_filename,
+            os.path.join(self.buildstock_dir, 'resources', 'options_lookup.tsv')
+        )
+        if not all(os.path.isfile(os.path.join(self.weather_dir, x)) for x in set(epws_by_building.values())):
+            logger.warning('Some weather files in options_lookup.tsv are not in the weather files, using all of them.')
+            epws_by_building = {}
+
+        run_building_partial = functools.partial(
+            self.run_building,
             self.project_dir,
             self.buildstock_dir,
             self.weather_dir,
@@ -174,18 +232,35 @@ class LocalDockerBatch(DockerBatchBase):
             n_datapoints,
             self.cfg
         )
+
+        def run_sim(i, upgrade_idx=None):
+            epw_filename = epws_by_building.get(i)
+            return run_building_partial(
+                i,
+                upgrade_idx=upgrade_idx,
+                postprocess=False,
+                weather_files=None if epw_filename is None else [epw_filename]
+            )
+
         upgrade_sims = []
         for i in range(len(self.cfg.get('upgrades', []))):
-            upgrade_sims.append(map(functools.partial(run_building_d, upgrade_idx=i), building_ids))
+            upgrade_sims.append(zip(building_ids, itertools.repeat(i)))
         if not self.skip_baseline_sims:
-            baseline_sims = map(run_building_d, building_ids)
+            baseline_sims = zip(building_ids, itertools.repeat(None))
             all_sims = itertools.chain(baseline_sims, *upgrade_sims)
         else:
             all_sims = itertools.chain(*upgrade_sims)
-        if n_jobs is None:
-            client = docker.client.from_env()
-            n_jobs = client.info()['NCPU']
-        dpouts = Parallel(n_jobs=n_jobs, verbose=10)(all_sims)
+        n_jobs = self.get_n_jobs(n_jobs)
+
+        # Clean up each simulation directory in a background thread while the next simulation runs
+        def postprocess_building(postprocess):
+            return postprocess() if callable(postprocess) else postprocess
+
+        # The docker containers are started from threads, there's no need for worker processes
+        with SimulationExecutor(max_workers=n_jobs) as executor:
+            dpouts = run_pipelined(
+                run_admitted(executor, run_sim, all_sims, n_jobs), postprocess_building, n_workers=n_jobs
+            )
 
         sim_out_dir = os.path.join(self.results_dir, 'simulation_output')
 
@@ -202,6 +277,43 @@ class LocalDockerBatch(DockerBatchBase):
                     tarf.add(os.path.join(sim_out_dir, dirname), arcname=dirname)
                     shutil.rmtree(os.path.join(sim_out_dir, dirname))
 
+    def run_pilot_sims(self, sims, n_datapoints):
+        client = docker.client.from_env()
+        n_jobs = client.info()['NCPU']
+        # Run them apart from the results so the batch runs them again
+        with tempfile.TemporaryDirectory(dir=self.results_dir, prefix='pilot') as pilot_results_dir:
+            for i in range(len(self.cfg.get('upgrades', [])) + 1):
+                os.makedirs(os.path.join(pilot_results_dir, 'simulation_output', 'timeseries', f'up{i:02d}'))
+            run_pilot_sim = functools.partial(
+                self.run_pilot_sim, self.project_dir, self.buildstock_dir, self.weather_dir, self.docker_image,
+                pilot_results_dir, n_datapoints, self.cfg
+            )
+            with SimulationExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(run_pilot_sim, i, upgrade_idx) for i, upgrade_idx in sims]
+                return [future.result() for future in futures]
+
+    @classmethod
+    def run_pilot_sim(cls, project_dir, buildstock_dir, weather_dir, docker_image, results_dir, n_datapoints, cfg,
+                      i, upgrade_idx):
+        """Run a simulation and measure its runtime, docker doesn't tell the peak memory of a container"""
+        upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
+        tick = time.time()
+        try:
+            dpout = cls.run_building(
+                project_dir, buildstock_dir, weather_dir, docker_image, results_dir, False, n_datapoints, cfg, i,
+                upgrade_idx
+            ) or {}
+        except Exception:
+            logger.exception(f'Pilot simulation of building {i} upgrade {upgrade_id} failed')
+            dpout = {}
+        return {
+            'building_id': i,
+            'upgrade': upgrade_id,
+            'completed_status': dpout.get('completed_status', 'Fail'),
+            'runtime_s': time.time() - tick,
+            'peak_memory_mb': None,
+        }
+
     @property
     def output_dir(self):
         return self.results_dir
@@ -275,6 +387,9 @@ def main():
                        action='store_true')
     group.add_argument('--samplingonly', help='Run the sampling only.',
                        action='store_true')
+    group.add_argument('--pilot', type=int, metavar='N',
+                       help='Run N simulations spread over the upgrades and buildings to measure their runtime. '
+                       'Writes a calibration file next to the project file that later runs use to size the jobs.')
     args = parser.parse_args()
     if not os.path.isfile(args.project_filename):
         raise FileNotFoundError(f'The project file {args.project_filename} doesn\'t exist')
@@ -284,6 +399,9 @@ def main():
     if args.validateonly:
         return True
     batch = LocalDockerBatch(args.project_filename)
+    if args.pilot:
+        batch.run_pilot(args.pilot)
+        return
     if not (args.postprocessonly or args.uploadonly or args.validateonly):
         batch.run_batch(n_jobs=args.j, measures_only=args.measures_only, sampling_only=args.samplingonly)
     if args.measures_only or args.samplingonly:
@@ -11,36 +11,152 @@ A module containing utility functions for postprocessing
 """
 
 import boto3
+import csv
 import dask.bag as db
 import dask.dataframe as dd
 import dask
 import datetime as dt
 from fsspec.implementations.local import LocalFileSystem
+import fnmatch
+import functools
 from functools import partial
 import gzip
-import itertools
+import hashlib
 import json
 import logging
 import math
 import numpy as np
+import os
 import pandas as pd
 from pathlib import Path
 import pyarrow as pa
+from pyarrow import csv as pa_csv
 from pyarrow import parquet
 import random
 import re
 from s3fs import S3FileSystem
+import sqlite3
 import time
 
+from buildstockbatch.results import BuildStockResults, characteristic_column_name, get_time_col
+
 logger = logging.getLogger(__name__)
 
 MAX_PARQUET_MEMORY = 1e9  # maximum size of the parquet file in memory when combining multiple parquets
+TIMESERIES_TIME_COLS = ('time', 'Time', 'TimeDST', 'TimeUTC')
+TIMESERIES_KEY_COLS = TIMESERIES_TIME_COLS + ('time_axis', 'timestep', 'schedules_id', 'schedules_timestep')
+TIMESERIES_TIMESTAMP_PARSERS = ('%Y/%m/%d %H:%M:%S', pa_csv.ISO8601)
+_CORE_FUELS = ('electricity', 'natural_gas', 'fuel_oil', 'propane', 'wood', 'district_heating', 'district_cooling',
+               'other_fuel')
+_CORE_ENDUSES = ('heating', 'cooling', 'interior_lighting', 'exterior_lighting', 'interior_equipment',
+                 'exterior_equipment', 'fans', 'pumps', 'heat_rejection', 'humidification', 'heat_recovery',
+                 'water_systems', 'refrigeration', 'generators')
+DEFAULT_TIMESERIES_COLUMN_FAMILIES = {
+    'core': ['total_site_*', 'net_site_*'] +
+            [f'{fuel}_{enduse}_*' for fuel in _CORE_FUELS for enduse in _CORE_ENDUSES],
+    'schedules': ['schedules_*'],
+    'output_variables': ['*]'],
+    'subcategories': ['*'],
+}
+DEFAULT_SAMPLE_STRATA = ('census_region', 'geometry_building_type_recs', 'building_type')
+SQLITE_MAX_COLUMNS = 2000  # default compile time limit on the number of columns in a sqlite table
+SAMPLE_WEIGHT_COL = 'build_existing_model.sample_weight'
+DEFAULT_SQLITE_INDEX_CHARACTERISTICS = (
+    'state',
+    'county',
+    'puma',
+    'geometry_building_type_recs',
+    'building_type',
+    'vintage',
+    'heating_fuel',
+)
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+_JSON_STRING_OR_BRACKET = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+_JSON_LITERAL = re.compile(r'[^,}\]\s]+')
+_json_decoder = json.JSONDecoder()
+
+
+def _skip_json_value(s, idx):
+    # Find the end of the value starting at idx without decoding it
+    if s[idx] in '{[':
+        depth = 0
+        for m in _JSON_STRING_OR_BRACKET.finditer(s, idx):
+            token = m.group()
+            if token in '{[':
+                depth += 1
+            elif token in '}]':
+                depth -= 1
+                if depth == 0:
+                    return m.end()
+        raise json.JSONDecodeError('Unterminated value', s, idx)
+    m = (_JSON_STRING if s[idx] == '"' else _JSON_LITERAL).match(s, idx)
+    if m is None:
+        raise json.JSONDecodeError('Expecting value', s, idx)
+    return m.end()
+
+
+def extract_json_keys(s, keys):
+    """Decode only some of the top level keys of a JSON object
+
+    The object is scanned key by key. The values of keys that aren't wanted are skipped over without being decoded
+    and the scan stops as soon as all the wanted keys have been found.
+
+    :param s: JSON document
+    :type s: str
+    :param keys: allowlist of top level keys to decode
+    :type keys: iterable of str
+    :return: the keys that were found and their values
+    :rtype: dict
+    :raises json.JSONDecodeError: if the document isn't a JSON object
+    """
+    keys = set(keys)
+    out = {}
+    try:
+        idx = _JSON_WHITESPACE.match(s, 0).end()
+        if s[idx] != '{':
+            raise json.JSONDecodeError('Expecting object', s, idx)
+        idx = _JSON_WHITESPACE.match(s, idx + 1).end()
+        if s[idx] == '}':
+            return out
+        while len(out) < len(keys):
+            if s[idx] != '"':
+                raise json.JSONDecodeError('Expecting property name enclosed in double quotes', s, idx)
+            key, idx = json.decoder.scanstring(s, idx + 1)
+            idx = _JSON_WHITESPACE.match(s, idx).end()
+            if s[idx] != ':':
+                raise json.JSONDecodeError("Expecting ':' delimiter", s, idx)
+            idx = _JSON_WHITESPACE.match(s, idx + 1).end()
+            if key in keys:
+                out[key], idx = _json_decoder.raw_decode(s, idx)
+            else:
+                idx = _skip_json_value(s, idx)
+            idx = _JSON_WHITESPACE.match(s, idx).end()
+            if s[idx] == '}':
+                break
+            if s[idx] != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+            idx = _JSON_WHITESPACE.match(s, idx + 1).end()
+    except IndexError:
+        raise json.JSONDecodeError('Unexpected end of document', s, len(s))
+    return out
+
+
+DATAPOINT_COLS_TO_KEEP = {
+    'ApplyUpgrade': [
+        'upgrade_name',
+        'applicable'
+    ]
+}
 
 
 def read_data_point_out_json(fs, reporting_measures, filename):
+    keys = ['ApplyUpgrade', 'BuildExistingModel', 'SimulationOutputReport'] + list(reporting_measures)
     try:
         with fs.open(filename, 'r') as f:
-            d = json.load(f)
+            d = extract_json_keys(f.read(), keys)
     except (FileNotFoundError, json.JSONDecodeError):
         return None
     else:
@@ -52,20 +168,63 @@ def read_data_point_out_json(fs, reporting_measures, filename):
         return d
 
 
+@functools.lru_cache(maxsize=None)
 def to_camelcase(x):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', x)
     return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
 
+# Columns that are kept regardless of the ``postprocessing.columns`` configuration
+RESULTS_KEY_COLUMNS = (
+    'building_id',
+    'upgrade',
+    'job_id',
+    'started_at',
+    'completed_at',
+    'completed_status',
+    'apply_upgrade.applicable',
+    'apply_upgrade.upgrade_name',
+    'build_existing_model.units_represented',
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _glob_patterns_regex(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(x) for x in patterns))
+
+
+def results_column_selector(columns_cfg):
+    """Make a function that says whether to keep a results column
+
+    Columns are matched by their name in the results, i.e. ``simulation_output_report.total_site_energy_mbtu``.
+    A column is kept if it matches one of the ``include`` glob patterns (or there are none) and none of the
+    ``exclude`` patterns. The columns in :data:`RESULTS_KEY_COLUMNS` are always kept.
+
+    :param columns_cfg: ``postprocessing.columns`` from the project configuration, can be None
+    :type columns_cfg: dict
+    :return: function that takes a column name, flattened or not yet converted to snake case, and returns a bool
+    """
+    columns_cfg = columns_cfg or {}
+    include_re = _glob_patterns_regex(tuple(columns_cfg.get('include', [])))
+    exclude_re = _glob_patterns_regex(tuple(columns_cfg.get('exclude', [])))
+
+    @functools.lru_cache(maxsize=None)
+    def keep_column(col):
+        col = to_camelcase(col)
+        if col in RESULTS_KEY_COLUMNS:
+            return True
+        if include_re is not None and not include_re.match(col):
+            return False
+        return exclude_re is None or not exclude_re.match(col)
+
+    return keep_column
+
+
 def flatten_datapoint_json(reporting_measures, d):
     new_d = {}
-    cols_to_keep = {
-        'ApplyUpgrade': [
-            'upgrade_name',
-            'applicable'
-        ]
-    }
-    for k1, k2s in cols_to_keep.items():
+    for k1, k2s in DATAPOINT_COLS_TO_KEEP.items():
         for k2 in k2s:
             new_d[f'{k1}.{k2}'] = d.get(k1, {}).get(k2)
 
@@ -93,19 +252,84 @@ def flatten_datapoint_json(reporting_measures, d):
     return new_d
 
 
-def read_out_osw(fs, filename):
+def flatten_datapoint_jsons(reporting_measures, dpouts, camelcase=True):
+    """Flatten the outputs of many simulations into one table
+
+    This is the batched, columnar equivalent of calling :func:`flatten_datapoint_json` on each simulation. Each
+    measure's outputs are turned into columns for all the simulations at once and the column names are only
+    worked out once per unique key. Top level values that aren't measure outputs, like ``started_at``, are passed
+    through as they are, so are outputs that were already flattened in the results of older versions.
+
+    :param reporting_measures: a list of reporting measure to pull results from
+    :type reporting_measures: list[str]
+    :param dpouts: simulation outputs, from :func:`read_simulation_outputs`
+    :type dpouts: list[dict]
+    :param camelcase: convert the column names with :func:`to_camelcase`, defaults to True
+    :type camelcase: bool, optional
+    :return: a row for each simulation
+    :rtype: pandas.DataFrame
+    """
+    measures = ['ApplyUpgrade', 'BuildExistingModel', 'SimulationOutputReport'] + \
+        [x for x in reporting_measures if x not in ('ApplyUpgrade', 'BuildExistingModel', 'SimulationOutputReport')]
+    measures_set = set(measures)
+    dpouts = list(dpouts)
+    frames = [pd.DataFrame.from_records(
+        [{k: v for k, v in d.items() if k not in measures_set} for d in dpouts],
+        index=pd.RangeIndex(len(dpouts))
+    )]
+    has_outputs = np.array([any(isinstance(d.get(x), dict) for x in measures) for d in dpouts], dtype=bool)
+    for measure in measures:
+        records = [d.get(measure) for d in dpouts]
+        if not any(isinstance(x, dict) for x in records):
+            continue
+        measure_df = pd.DataFrame.from_records(
+            [x if isinstance(x, dict) else {} for x in records],
+            index=pd.RangeIndex(len(dpouts))
+        )
+        if measure in DATAPOINT_COLS_TO_KEEP:
+            measure_df = measure_df.reindex(columns=DATAPOINT_COLS_TO_KEEP[measure])
+            measure_df.loc[~has_outputs] = np.nan
+        measure_df.columns = [f'{measure}.{k}' for k in measure_df.columns]
+        frames.append(measure_df)
+    df = pd.concat(frames, axis=1)
+
+    # if there is no units_represented key, default to 1
+    if has_outputs.any():
+        units_col = 'BuildExistingModel.units_represented'
+        units = df[units_col] if units_col in df.columns else pd.Series(np.nan, index=df.index)
+        df[units_col] = pd.to_numeric(units.where(~has_outputs | units.notna(), 1))
+    bldg_id_col = 'BuildExistingModel.building_id'
+    if bldg_id_col in df.columns:
+        if 'building_id' in df.columns:
+            df['building_id'] = df['building_id'].fillna(df[bldg_id_col])
+        else:
+            df['building_id'] = df[bldg_id_col]
+        del df[bldg_id_col]
+
+    if camelcase:
+        df.columns = [to_camelcase(x) for x in df.columns]
+    return df
+
+
+def read_out_osw(fs, filename, read_building_id=True):
+    """Read the timing and status of a simulation from out.osw
+
+    :param read_building_id: also read the building id, which needs the large ``steps`` section of out.osw to be
+        decoded, defaults to True
+    :type read_building_id: bool, optional
+    """
+    keys_to_copy = [
+        'started_at',
+        'completed_at',
+        'completed_status'
+    ]
     try:
         with fs.open(filename, 'r') as f:
-            d = json.load(f)
+            d = extract_json_keys(f.read(), keys_to_copy + (['steps'] if read_building_id else []))
     except (FileNotFoundError, json.JSONDecodeError):
         return None
     else:
         out_d = {}
-        keys_to_copy = [
-            'started_at',
-            'completed_at',
-            'completed_status'
-        ]
         for key in keys_to_copy:
             out_d[key] = d.get(key, None)
         for step in d.get('steps', []):
@@ -114,9 +338,12 @@ def read_out_osw(fs, filename):
         return out_d
 
 
-def read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, building_id):
+def read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, building_id, columns=None):
     """Read the simulation outputs and return as a dict
 
+    The outputs of each measure are kept in a dict under the measure name like in ``data_point_out.json``, they're
+    flattened into columns a job at a time by :func:`flatten_datapoint_jsons` in :func:`combine_results`.
+
     :param fs: filesystem to read from
     :type fs: fsspec filesystem
     :param reporting_measures: a list of reporting measure to pull results from
@@ -127,6 +354,8 @@ def read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, buildin
     :type upgrade_id: int
     :param building_id: building id
     :type building_id: int
+    :param columns: ``postprocessing.columns`` configuration to select which outputs to keep, defaults to all
+    :type columns: dict, optional
     :return: dpout [dict]
     """
 
@@ -135,18 +364,174 @@ def read_simulation_outputs(fs, reporting_measures, sim_dir, upgrade_id, buildin
     )
     if dpout is None:
         dpout = {}
-    else:
-        dpout = flatten_datapoint_json(reporting_measures, dpout)
-    out_osw = read_out_osw(fs, f'{sim_dir}/out.osw')
+    for measure, keys in DATAPOINT_COLS_TO_KEEP.items():
+        if measure in dpout:
+            dpout[measure] = {k: dpout[measure].get(k) for k in keys}
+    out_osw = read_out_osw(fs, f'{sim_dir}/out.osw', read_building_id=False)
     if out_osw:
         dpout.update(out_osw)
-    dpout['upgrade'] = upgrade_id
+    # building_id comes before upgrade, like when it was read from out.osw
     dpout['building_id'] = building_id
+    dpout['upgrade'] = upgrade_id
+    if columns:
+        keep_column = results_column_selector(columns)
+        dpout = {
+            k: {k2: v2 for k2, v2 in v.items() if keep_column(f'{k}.{k2}')} if isinstance(v, dict) else v
+            for k, v in dpout.items() if isinstance(v, dict) or keep_column(k)
+        }
     return dpout
 
 
+def write_deduplicated_table(df, fs, out_dir):
+    """Write a table to ``out_dir`` named by a hash of its contents, unless it is already there
+
+    A ``timestep`` column with the row number is added to the table so it can be joined to the timeseries.
+
+    :param df: table to write
+    :type df: pandas.DataFrame
+    :param fs: filesystem to write to
+    :type fs: fsspec filesystem
+    :param out_dir: directory of deduplicated tables
+    :type out_dir: str
+    :return: hash identifying the table
+    :rtype: str
+    """
+    df = df.reset_index(drop=True)
+    h = hashlib.sha256(','.join(map(str, df.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    table_id = h.hexdigest()[:16]
+    filename = f'{out_dir}/{table_id}.parquet'
+    if not fs.exists(filename):
+        # If two simulations race to write the same table they write identical files.
+        fs.makedirs(out_dir, exist_ok=True)
+        df.insert(0, 'timestep', np.arange(len(df), dtype='int32'))
+        write_dataframe_as_parquet(df, fs, filename)
+    return table_id
+
+
+def read_deduplicated_tables(fs, filenames, id_col):
+    """Read tables written by :func:`write_deduplicated_table` into one dataframe with their hash in ``id_col``"""
+    dfs = []
+    for filename in filenames:
+        with fs.open(filename, 'rb') as f:
+            df = pd.read_parquet(f, engine='pyarrow')
+        df.insert(0, id_col, re.search(r'(\w+)\.parquet$', filename).group(1))
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def read_enduse_timeseries_csv(filename):
+    """Read an enduse_timeseries.csv into an arrow table
+
+    The header is read first so the time columns can be given an explicit timestamp type and formats, the types
+    of the other columns are inferred by arrow, so integer columns stay integers. Columns without any values are
+    float64, as pandas reads them, instead of arrow's null type so every building has the same schema. The file is
+    parsed by the multithreaded arrow csv reader. If arrow can't read it, because a time column is in another
+    format or a column has values of different types further down, it's read with pandas as it used to be.
+
+    :param filename: path to enduse_timeseries.csv
+    :type filename: str
+    :return: the timeseries and the names of the time columns in it
+    :rtype: tuple(pyarrow.Table, list[str])
+    """
+    with open(filename, 'r', newline='') as f:
+        cols = next(csv.reader(f))
+    time_cols = [c for c in cols if c in TIMESERIES_TIME_COLS]
+    if not time_cols:
+        raise RuntimeError(f'Did not find any time column ({list(TIMESERIES_TIME_COLS)}) in {filename}.')
+    read_options = pa_csv.ReadOptions(use_threads=True)
+    convert_options = pa_csv.ConvertOptions(
+        column_types={c: pa.timestamp('ns') for c in time_cols},
+        timestamp_parsers=list(TIMESERIES_TIMESTAMP_PARSERS)
+    )
+    try:
+        tbl = pa_csv.read_csv(filename, read_options=read_options, convert_options=convert_options)
+    except pa.ArrowInvalid as ex:
+        logger.warning(f'Could not read {filename} with arrow, reading it with pandas: {ex}')
+        df = pd.read_csv(filename, parse_dates=time_cols)
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+    if any(pa.types.is_null(field.type) for field in tbl.schema):
+        tbl = tbl.cast(pa.schema([
+            field.with_type(pa.float64()) if pa.types.is_null(field.type) else field for field in tbl.schema
+        ]))
+    return tbl, time_cols
+
+
+def _constant_column(value, length):
+    return pa.array(np.full(length, value, dtype=object), type=pa.string())
+
+
+def dedupe_timeseries_timestamps(tbl, time_cols, fs, time_axes_dir):
+    """Replace the time columns of a timeseries with a reference into a shared time axis
+
+    The time columns are written once per distinct time axis to ``time_axes_dir`` with
+    :func:`write_deduplicated_table`. They are replaced in the timeseries with a ``time_axis`` column with the hash
+    and a ``timestep`` column with the row number in the time axis.
+
+    :param tbl: timeseries
+    :type tbl: pyarrow.Table
+    :param time_cols: the time columns in ``tbl``
+    :type time_cols: list[str]
+    :param fs: filesystem to write the time axis to
+    :type fs: fsspec filesystem
+    :param time_axes_dir: directory of time axes
+    :type time_axes_dir: str
+    :return: timeseries without the time columns
+    :rtype: pyarrow.Table
+    """
+    time_axis = write_deduplicated_table(tbl.select(time_cols).to_pandas(), fs, time_axes_dir)
+    tbl = tbl.drop(time_cols)
+    tbl = tbl.add_column(0, 'timestep', pa.array(np.arange(tbl.num_rows, dtype='int32')))
+    tbl = tbl.add_column(0, 'time_axis', _constant_column(time_axis, tbl.num_rows))
+    return tbl
+
+
+def add_schedules_reference(tbl, schedules_id, n_schedule_rows):
+    """Add the ``schedules_id`` and ``schedules_timestep`` columns referencing a schedule to a timeseries
+
+    ``schedules_timestep`` is the row of the schedule for each timestep, its ``timestep`` in the schedules table.
+    The schedule rows are in standard time, like ``Time``, and a timestep uses the row at its ``TimeDST``, the same
+    way EnergyPlus reads ScheduleFiles (https://github.com/NREL/resstock/issues/469#issuecomment-697849076). It's
+    null where there is no such row. Without ``Time`` and ``TimeDST`` the rows line up one to one.
+
+    This has to be called before the time columns are replaced by :func:`dedupe_timeseries_timestamps`.
+
+    :param tbl: timeseries
+    :type tbl: pyarrow.Table
+    :param schedules_id: the id :func:`write_deduplicated_table` returned for the schedule
+    :type schedules_id: str
+    :param n_schedule_rows: number of rows in the schedule
+    :type n_schedule_rows: int
+    :return: timeseries with the reference
+    :rtype: pyarrow.Table
+    """
+    if 'Time' in tbl.column_names and 'TimeDST' in tbl.column_names and tbl.num_rows > 0:
+        time = tbl.column('Time').to_numpy()
+        time_dst = tbl.column('TimeDST').to_numpy()
+        order = np.argsort(time, kind='stable')
+        pos = np.minimum(np.searchsorted(time, time_dst, sorter=order), len(time) - 1)
+        timesteps = order[pos]
+        missing = time[timesteps] != time_dst
+    else:
+        timesteps = np.arange(tbl.num_rows)
+        missing = np.zeros(tbl.num_rows, dtype=bool)
+    missing |= timesteps >= n_schedule_rows
+    tbl = tbl.add_column(0, 'schedules_timestep', pa.array(timesteps.astype('int32'), mask=missing))
+    return tbl.add_column(0, 'schedules_id', _constant_column(schedules_id, tbl.num_rows))
+
+
+def combine_time_axes(fs, time_axes_dir):
+    """Read all the time axes written by :func:`dedupe_timeseries_timestamps` into one dataframe"""
+    time_axes_df = read_deduplicated_tables(fs, sorted(fs.glob(f'{time_axes_dir}/*.parquet')), 'time_axis')
+    return time_axes_df.sort_values(['time_axis', 'timestep'], ignore_index=True)
+
+
 def write_dataframe_as_parquet(df, fs, filename):
     tbl = pa.Table.from_pandas(df, preserve_index=False)
+    write_table_as_parquet(tbl, fs, filename)
+
+
+def write_table_as_parquet(tbl, fs, filename):
     with fs.open(filename, 'wb') as f:
         parquet.write_table(tbl, f, flavor='spark')
 
@@ -204,6 +589,80 @@ def clean_up_results_df(df, cfg, keep_upgrade_id=False):
     return results_df
 
 
+def select_sample_buildings(results_df, cfg):
+    """Select a reproducible, characteristic-stratified subsample of the buildings
+
+    Each stratum gets ``fraction`` of its buildings (at least one) so that every combination of the stratifying
+    characteristics is represented. The weights are adjusted so the sample represents the whole stock.
+
+    :param results_df: cleaned up results dataframe with ``upgrade``, ``building_id`` and characteristics columns
+    :type results_df: pandas.DataFrame
+    :param cfg: project configuration (contents of yaml file)
+    :type cfg: dict
+    :return: sample weight (buildings represented) for each sampled building indexed by building_id
+    :rtype: pandas.Series
+    """
+    sample_cfg = cfg['postprocessing']['sample']
+    fraction = sample_cfg['fraction']
+    seed = sample_cfg.get('seed', 0)
+
+    bldg_df = results_df.sort_values(['building_id', 'upgrade']).drop_duplicates('building_id')
+    strata_cols = [characteristic_column_name(x) for x in sample_cfg.get('stratify_by', DEFAULT_SAMPLE_STRATA)]
+    strata_cols = [x for x in strata_cols if x in bldg_df.columns]
+    if 'stratify_by' in sample_cfg and len(strata_cols) < len(sample_cfg['stratify_by']):
+        logger.warning(f'Some of the sample stratify_by characteristics were not found in the results, '
+                       f'using {strata_cols}')
+    if strata_cols:
+        strata = bldg_df[strata_cols].fillna('').astype(str).apply(tuple, axis=1)
+    else:
+        strata = pd.Series('', index=bldg_df.index)
+
+    n_buildings_represented = cfg.get('baseline', {}).get('n_buildings_represented', len(bldg_df))
+    base_weight = n_buildings_represented / len(bldg_df)
+    rng = np.random.RandomState(seed)
+    weights = {}
+    for _, stratum_df in bldg_df.groupby(strata, sort=True):
+        n_stratum = len(stratum_df)
+        n_sample = min(n_stratum, max(1, int(round(fraction * n_stratum))))
+        sampled_ids = rng.choice(stratum_df['building_id'].values, n_sample, replace=False)
+        for building_id in sampled_ids:
+            weights[int(building_id)] = base_weight * n_stratum / n_sample
+    weights = pd.Series(weights, name='sample_weight').sort_index()
+    weights.index.name = 'building_id'
+    logger.info(f'Selected {len(weights)} of {len(bldg_df)} buildings for the sample dataset')
+    return weights
+
+
+def get_timeseries_column_families(cfg, columns):
+    """Split the timeseries columns into column families
+
+    The families are defined in ``postprocessing.timeseries_column_families`` as a mapping of family name to a list of
+    glob patterns. Each column goes in the first family with a matching pattern, columns that don't match any go in
+    ``other``. The ``building_id`` and time columns are the keys and are not assigned to a family.
+
+    :param cfg: project configuration (contents of yaml file)
+    :type cfg: dict
+    :param columns: timeseries column names
+    :type columns: list[str]
+    :return: dict of family name to list of columns, empty families are omitted
+    """
+    families_cfg = cfg.get('postprocessing', {}).get('timeseries_column_families', False)
+    if families_cfg is True:
+        families_cfg = DEFAULT_TIMESERIES_COLUMN_FAMILIES
+    families = {family_name: [] for family_name in families_cfg}
+    families['other'] = []
+    for col in columns:
+        if col == 'building_id' or col in TIMESERIES_KEY_COLS:
+            continue
+        for family_name, patterns in families_cfg.items():
+            if any(fnmatch.fnmatchcase(col, pattern) for pattern in patterns):
+                families[family_name].append(col)
+                break
+        else:
+            families['other'].append(col)
+    return {k: v for k, v in families.items() if v}
+
+
 def get_cols(fs, filename):
     with fs.open(filename, 'rb') as f:
         schema = parquet.read_schema(f)
@@ -217,6 +676,46 @@ def read_results_json(fs, filename):
     return dpouts
 
 
+def find_missing_simulations(fs, sim_output_dir, sims):
+    """Find the simulations of a batch that are missing from its results or failed
+
+    A simulation is done if its latest result, by job number, is ``Success`` or ``Invalid`` (the upgrade doesn't apply
+    to the building). When the batch wrote timeseries, a successful simulation also needs its timeseries file.
+
+    :param fs: filesystem to read from
+    :type fs: fsspec filesystem
+    :param sim_output_dir: ``simulation_output`` directory of the batch
+    :type sim_output_dir: str
+    :param sims: expected ``(building_id, upgrade_idx)`` simulations, ``upgrade_idx`` is None for the baseline
+    :type sims: list[tuple]
+    :return: simulations that need to be run again, in the order of ``sims``
+    :rtype: list[tuple]
+    """
+    results_jsons = fs.glob(f'{sim_output_dir}/results_job*.json.gz')
+    results_jsons.sort(key=lambda x: int(re.search(r'results_job(\d+)\.json\.gz', x).group(1)))
+    statuses = {}
+    for results_json in results_jsons:
+        for dpout in read_results_json(fs, results_json):
+            statuses[(int(dpout['building_id']), int(dpout['upgrade']))] = dpout.get('completed_status')
+
+    ts_filenames = set(
+        os.path.basename(os.path.dirname(x)) + '/' + os.path.basename(x)
+        for x in fs.glob(f'{sim_output_dir}/timeseries/up*/bldg*.parquet')
+    )
+
+    missing = []
+    for building_id, upgrade_idx in sims:
+        upgrade_id = 0 if upgrade_idx is None else upgrade_idx + 1
+        status = statuses.get((building_id, upgrade_id))
+        if status == 'Invalid':
+            continue
+        if status == 'Success' and \
+                (not ts_filenames or f'up{upgrade_id:02d}/bldg{building_id:07d}.parquet' in ts_filenames):
+            continue
+        missing.append((building_id, upgrade_idx))
+    return missing
+
+
 def read_enduse_timeseries_parquet(fs, filename, all_cols):
     with fs.open(filename, 'rb') as f:
         df = pd.read_parquet(f, engine='pyarrow')
@@ -231,6 +730,12 @@ def read_and_concat_enduse_timeseries_parquet(fs, filenames, all_cols):
     return pd.concat(read_enduse_timeseries_parquet(fs, filename, all_cols) for filename in filenames)
 
 
+def select_sample_timeseries(ts_df, sample_weights):
+    sample_ts_df = ts_df.loc[ts_df.index.isin(sample_weights.index)].copy()
+    sample_ts_df['sample_weight'] = sample_ts_df.index.map(sample_weights)
+    return sample_ts_df
+
+
 def combine_results(fs, results_dir, cfg, do_timeseries=True):
     """Combine the results of the batch simulations.
 
@@ -248,9 +753,14 @@ def combine_results(fs, results_dir, cfg, do_timeseries=True):
     results_csvs_dir = f'{results_dir}/results_csvs'
     parquet_dir = f'{results_dir}/parquet'
     ts_dir = f'{results_dir}/parquet/timeseries'
+    sample_dir = f'{parquet_dir}/sample'
+    do_sample = 'sample' in cfg.get('postprocessing', {})
+    do_column_families = bool(cfg.get('postprocessing', {}).get('timeseries_column_families', False))
     dirs = [results_csvs_dir, parquet_dir]
-    if do_timeseries:
+    if do_timeseries and not do_column_families:
         dirs.append(ts_dir)
+    if do_sample:
+        dirs.append(sample_dir)
 
     # create the postprocessing results directories
     for dr in dirs:
@@ -260,20 +770,37 @@ def combine_results(fs, results_dir, cfg, do_timeseries=True):
     results_job_json_glob = f'{sim_output_dir}/results_job*.json.gz'
     results_jsons = fs.glob(results_job_json_glob)
     results_json_job_ids = [int(re.search(r'results_job(\d+)\.json\.gz', x).group(1)) for x in results_jsons]
-    dpouts_by_job = dask.compute([dask.delayed(read_results_json)(fs, x) for x in results_jsons])[0]
-    for job_id, dpouts_for_this_job in zip(results_json_job_ids, dpouts_by_job):
-        for dpout in dpouts_for_this_job:
-            dpout['job_id'] = job_id
-    dpouts = itertools.chain.from_iterable(dpouts_by_job)
-    results_df = pd.DataFrame(dpouts).rename(columns=to_camelcase)
-
-    del dpouts
+    reporting_measures = cfg.get('reporting_measures', [])
+    results_dfs = dask.compute([
+        dask.delayed(flatten_datapoint_jsons)(reporting_measures, dask.delayed(read_results_json)(fs, x))
+        for x in results_jsons
+    ])[0]
+    for job_id, results_df_for_this_job in zip(results_json_job_ids, results_dfs):
+        results_df_for_this_job['job_id'] = job_id
+    results_df = pd.concat(results_dfs, ignore_index=True) if results_dfs else pd.DataFrame()
+
+    del results_dfs
+
+    # Simulations that were rerun with --rerun-missing keep the result from the latest job
+    if not results_df.empty and results_df.duplicated(['building_id', 'upgrade']).any():
+        results_df = results_df.sort_values('job_id', kind='stable'). \
+            drop_duplicates(['building_id', 'upgrade'], keep='last'). \
+            sort_index(). \
+            reset_index(drop=True)
+
+    columns_cfg = cfg.get('postprocessing', {}).get('columns')
+    if columns_cfg:
+        keep_column = results_column_selector(columns_cfg)
+        results_df = results_df[[x for x in results_df.columns if keep_column(x)]]
 
     if results_df.empty:
         raise ValueError("No simulation results found to post-process")
 
     results_df = clean_up_results_df(results_df, cfg, keep_upgrade_id=True)
 
+    if do_sample:
+        sample_weights = select_sample_buildings(results_df, cfg)
+
     if do_timeseries:
 
         # Look at all the parquet files to see what columns are in all of them.
@@ -288,6 +815,40 @@ def combine_results(fs, results_dir, cfg, do_timeseries=True):
         all_ts_cols.difference_update(all_ts_cols_sorted)
         all_ts_cols_sorted.extend(sorted(all_ts_cols))
 
+        # Combine the time axes if the timestamps were deduplicated
+        if fs.exists(f'{ts_in_dir}/time_axes'):
+            time_axes_df = combine_time_axes(fs, f'{ts_in_dir}/time_axes')
+            time_axes_out_dirs = [f'{parquet_dir}/time_axes']
+            if do_sample:
+                time_axes_out_dirs.append(f'{sample_dir}/time_axes')
+            for time_axes_out_dir in time_axes_out_dirs:
+                fs.makedirs(time_axes_out_dir, exist_ok=True)
+                logger.info(f'Writing {time_axes_out_dir}/time_axes.parquet')
+                write_dataframe_as_parquet(time_axes_df, fs, f'{time_axes_out_dir}/time_axes.parquet')
+            del time_axes_df
+
+        # Combine the schedules, each distinct schedule was only written once
+        schedules_filenames = sorted(fs.glob(f'{ts_in_dir}/schedules/*.parquet'))
+        if schedules_filenames:
+            schedules_mem = read_deduplicated_tables(fs, schedules_filenames[:1], 'schedules_id').\
+                memory_usage(deep=True).sum()
+            npartitions = min(len(schedules_filenames), math.ceil(schedules_mem * len(schedules_filenames) /
+                                                                  MAX_PARQUET_MEMORY))
+            read_schedules_d = dask.delayed(partial(read_deduplicated_tables, fs, id_col='schedules_id'))
+            schedules_df = dd.from_delayed(map(read_schedules_d, np.array_split(schedules_filenames, npartitions)))
+            schedules_out_loc = f'{parquet_dir}/schedules'
+            if not isinstance(fs, LocalFileSystem):
+                schedules_out_loc = f's3://{schedules_out_loc}'
+            logger.info(f'Writing {schedules_out_loc}')
+            schedules_df.to_parquet(schedules_out_loc, engine='pyarrow', flavor='spark', write_index=False)
+            del schedules_df
+
+        if do_column_families:
+            ts_key_cols = [x for x in all_ts_cols_sorted if x in TIMESERIES_KEY_COLS]
+            ts_column_families = get_timeseries_column_families(cfg, all_ts_cols_sorted)
+            logger.info('Splitting timeseries into column families: ' +
+                        ', '.join(f'{k} ({len(v)} columns)' for k, v in ts_column_families.items()))
+
     for upgrade_id, df in results_df.groupby('upgrade'):
         if upgrade_id > 0:
             # Remove building characteristics for upgrade scenarios.
@@ -320,6 +881,20 @@ def combine_results(fs, results_dir, cfg, do_timeseries=True):
             f"{results_parquet_dir}/results_up{upgrade_id:02d}.parquet"
         )
 
+        # Write the sample of the results
+        if do_sample:
+            sample_df = df.loc[df.index.intersection(sample_weights.index)].copy()
+            sample_df.insert(0, 'sample_weight', sample_weights.loc[sample_df.index])
+            sample_parquet_dir = sample_dir + results_parquet_dir[len(parquet_dir):]
+            if not fs.exists(sample_parquet_dir):
+                fs.makedirs(sample_parquet_dir)
+            write_dataframe_as_parquet(
+                sample_df.reset_index(),
+                fs,
+                f"{sample_parquet_dir}/results_up{upgrade_id:02d}.parquet"
+            )
+            del sample_df
+
         if do_timeseries:
 
             # Get the names of the timseries file for each simulation in this upgrade
@@ -347,15 +922,140 @@ def combine_results(fs, results_dir, cfg, do_timeseries=True):
             # Write out new dask timeseries dataframe.
             if isinstance(fs, LocalFileSystem):
                 ts_out_loc = f"{ts_dir}/upgrade={upgrade_id}"
+                sample_ts_out_loc = f"{sample_dir}/timeseries/upgrade={upgrade_id}"
             else:
                 assert isinstance(fs, S3FileSystem)
                 ts_out_loc = f"s3://{ts_dir}/upgrade={upgrade_id}"
-            logger.info(f'Writing {ts_out_loc}')
-            ts_df.to_parquet(
-                ts_out_loc,
-                engine='pyarrow',
-                flavor='spark'
-            )
+                sample_ts_out_loc = f"s3://{sample_dir}/timeseries/upgrade={upgrade_id}"
+            writes = []
+            if do_column_families:
+                # Write each column family to its own dataset, they all share the building_id and time columns.
+                for family_name, family_cols in ts_column_families.items():
+                    family_out_loc = ts_out_loc.replace('/timeseries/', f'/timeseries_{family_name}/')
+                    logger.info(f'Writing {family_out_loc}')
+                    writes.append(ts_df[ts_key_cols + family_cols].to_parquet(
+                        family_out_loc,
+                        engine='pyarrow',
+                        flavor='spark',
+                        compute=False
+                    ))
+            else:
+                logger.info(f'Writing {ts_out_loc}')
+                writes.append(ts_df.to_parquet(
+                    ts_out_loc,
+                    engine='pyarrow',
+                    flavor='spark',
+                    compute=False
+                ))
+
+            # Write the sample timeseries in the same pass so the files are only read once.
+            if do_sample:
+                logger.info(f'Writing {sample_ts_out_loc}')
+                sample_ts_df = ts_df.map_partitions(select_sample_timeseries, sample_weights)
+                writes.append(sample_ts_df.to_parquet(
+                    sample_ts_out_loc,
+                    engine='pyarrow',
+                    flavor='spark',
+                    compute=False
+                ))
+            dask.compute(*writes)
+
+
+def _write_sqlite_table(conn, table_name, df, if_exists='replace'):
+    if len(df.columns) > SQLITE_MAX_COLUMNS:
+        raise ValueError(
+            f'Table {table_name} has {len(df.columns)} columns, which is more than sqlite supports '
+            f'({SQLITE_MAX_COLUMNS}).'
+        )
+    df.to_sql(table_name, conn, if_exists=if_exists, index=False, chunksize=10000)
+
+
+def _create_sqlite_index(conn, table_name, columns):
+    index_name = 'idx_' + re.sub(r'\W+', '_', '_'.join([table_name] + columns))
+    col_list = ', '.join(f'"{col}"' for col in columns)
+    conn.execute(f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" ({col_list})')
+
+
+def write_results_sqlite(results_dir, cfg, do_timeseries=True):
+    """Write the combined results into a single sqlite database for quick local analysis.
+
+    This reads the parquet files written by :func:`combine_results` so it must be run after it.
+
+    :param results_dir: directory where results are stored, the database is written here
+    :type results_dir: str
+    :param cfg: project configuration (contents of yaml file)
+    :type cfg: dict
+    :param do_timeseries: write an aggregated timeseries table if requested, defaults to True. It's the sum of the
+        timeseries of the buildings weighted by their ``build_existing_model.sample_weight`` in the baseline
+        results, so it's for the building stock they represent.
+    :type do_timeseries: bool, optional
+    :return: path to the sqlite file
+    """
+    sqlite_cfg = cfg.get('postprocessing', {}).get('sqlite', {})
+    db_filename = os.path.join(results_dir, sqlite_cfg.get('filename', 'results.sqlite'))
+    index_characteristics = sqlite_cfg.get('index_characteristics', DEFAULT_SQLITE_INDEX_CHARACTERISTICS)
+
+    if os.path.exists(db_filename):
+        os.remove(db_filename)
+    logger.info(f'Writing {db_filename}')
+    res = BuildStockResults(results_dir)
+    upgrades = res.upgrades
+    conn = sqlite3.connect(db_filename)
+    sample_weights = None
+    try:
+        for upgrade_id in upgrades:
+            table_name = f'results_up{upgrade_id:02d}'
+            df = res.results(upgrade=upgrade_id)
+            df.insert(1, 'upgrade', upgrade_id)
+            _write_sqlite_table(conn, table_name, df)
+            conn.execute(f'CREATE UNIQUE INDEX "idx_{table_name}_building_id" ON "{table_name}" ("building_id")')
+            if upgrade_id == 0:
+                for characteristic in index_characteristics:
+                    col = characteristic_column_name(characteristic)
+                    if col in df.columns:
+                        _create_sqlite_index(conn, table_name, [col])
+                if SAMPLE_WEIGHT_COL in df.columns:
+                    sample_weights = df.set_index('building_id')[SAMPLE_WEIGHT_COL]
+            del df
+
+        if do_timeseries and sqlite_cfg.get('timeseries', False):
+            # Sum the timeseries over all the buildings in each upgrade, weighted by the buildings they represent
+            if sample_weights is None:
+                logger.warning(
+                    f'There is no {SAMPLE_WEIGHT_COL} in the baseline results, the timeseries table is the unweighted '
+                    'sum of the buildings.'
+                )
+            table_name = 'timeseries'
+            time_col = None
+            for upgrade_id in upgrades:
+                if not res.has_timeseries(upgrade_id):
+                    continue
+                agg_df = None
+                for ts_df in res.iter_timeseries(upgrade=upgrade_id):
+                    ts_df = ts_df.reset_index()
+                    if time_col is None:
+                        time_col = get_time_col(ts_df.columns)
+                    value_cols = [
+                        col for col in ts_df.select_dtypes(include='number').columns
+                        if col != 'building_id' and col not in TIMESERIES_KEY_COLS
+                    ]
+                    values = ts_df[value_cols]
+                    if sample_weights is not None:
+                        values = values.mul(ts_df['building_id'].map(sample_weights), axis=0)
+                    batch_sum = values.groupby(ts_df[time_col]).sum()
+                    agg_df = batch_sum if agg_df is None else agg_df.add(batch_sum, fill_value=0)
+                if agg_df is None:
+                    continue
+                agg_df = agg_df.sort_index().reset_index()
+                agg_df.insert(0, 'upgrade', upgrade_id)
+                _write_sqlite_table(conn, table_name, agg_df, if_exists='append')
+                del agg_df
+            if time_col is not None:
+                _create_sqlite_index(conn, table_name, ['upgrade', time_col])
+        conn.commit()
+    finally:
+        conn.close()
+    return db_filename
 
 
 def remove_intermediate_files(fs, results_dir):
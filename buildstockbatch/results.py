@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+
+"""
+buildstockbatch.results
+~~~~~~~~~~~~~~~~~~~~~~~
+A module for lazily querying the postprocessed results written by ``combine_results``
+
+:author: Noel Merket, Rajendra Adhikari
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+from fsspec.implementations.local import LocalFileSystem
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import re
+from s3fs import S3FileSystem
+
+logger = logging.getLogger(__name__)
+
+CHARACTERISTICS_PREFIX = 'build_existing_model.'
+DEFAULT_BATCH_SIZE = 2 ** 17
+
+
+def get_time_col(columns, time_col=None):
+    """Return the name of the time column to use out of ``columns``"""
+    if time_col is not None:
+        return time_col
+    for col in ('Time', 'time', 'TimeDST'):
+        if col in columns:
+            return col
+    raise ValueError(f'Could not find a time column in {list(columns)}')
+
+
+def characteristic_column_name(name):
+    """Return the results column for a building characteristic
+
+    Accepts either the full column name (``build_existing_model.geometry_building_type_recs``), the column suffix
+    (``geometry_building_type_recs``) or the parameter name as it appears in options_lookup.tsv
+    (``Geometry Building Type RECS``).
+    """
+    if name.startswith(CHARACTERISTICS_PREFIX):
+        return name
+    return CHARACTERISTICS_PREFIX + re.sub(r'\W+', '_', name.strip()).lower()
+
+
+class BuildStockResults(object):
+    """Lazy, filtered access to postprocessed results
+
+    Nothing is read when this object is created. Each query opens a ``pyarrow.dataset`` over the relevant parquet
+    files and pushes the column projection and row filters down into the scan so only the row groups and columns
+    needed are read.
+
+    :param results_dir: The ``results`` directory of a local run, the ``parquet`` directory inside it, or the
+        ``s3://bucket/prefix/output_directory_name`` location the parquet files were uploaded to.
+    :type results_dir: str
+    :param fs: filesystem to read from, inferred from ``results_dir`` if not provided
+    :type fs: fsspec filesystem, optional
+    """
+
+    def __init__(self, results_dir, fs=None):
+        results_dir = str(results_dir)
+        if fs is None:
+            if results_dir.startswith('s3://'):
+                fs = S3FileSystem()
+            else:
+                fs = LocalFileSystem()
+        if results_dir.startswith('s3://'):
+            results_dir = results_dir[len('s3://'):]
+        self.fs = fs
+        self.results_dir = results_dir.rstrip('/')
+
+    @property
+    def parquet_dir(self):
+        # Locally the parquet files are in results/parquet, on s3 they're uploaded to the root of the prefix.
+        parquet_dir = f'{self.results_dir}/parquet'
+        if self.fs.isdir(parquet_dir):
+            return parquet_dir
+        return self.results_dir
+
+    @property
+    def upgrades(self):
+        """List of upgrade ids that have results, 0 is the baseline"""
+        upgrades = []
+        if self.fs.exists(f'{self.parquet_dir}/baseline'):
+            upgrades.append(0)
+        for path in self.fs.glob(f'{self.parquet_dir}/upgrades/upgrade=*'):
+            upgrades.append(int(re.search(r'upgrade=(\d+)', path).group(1)))
+        return sorted(upgrades)
+
+    def _results_path(self, upgrade):
+        if upgrade == 0:
+            return f'{self.parquet_dir}/baseline'
+        return f'{self.parquet_dir}/upgrades/upgrade={upgrade}'
+
+    @property
+    def timeseries_column_families(self):
+        """List of column families the timeseries were split into, empty if they weren't split"""
+        families = []
+        for path in self.fs.glob(f'{self.parquet_dir}/timeseries_*'):
+            families.append(re.search(r'timeseries_(\w+)$', path.rstrip('/')).group(1))
+        return sorted(families)
+
+    def _timeseries_path(self, upgrade, family=None):
+        ts_dir = 'timeseries' if family is None else f'timeseries_{family}'
+        return f'{self.parquet_dir}/{ts_dir}/upgrade={upgrade}'
+
+    def has_timeseries(self, upgrade):
+        """Whether there are timeseries results for an upgrade"""
+        if self.fs.exists(self._timeseries_path(upgrade)):
+            return True
+        return any(self.fs.exists(self._timeseries_path(upgrade, x)) for x in self.timeseries_column_families)
+
+    def _dataset(self, path):
+        if not self.fs.exists(path):
+            raise FileNotFoundError(path)
+        return ds.dataset(path, filesystem=self.fs, format='parquet')
+
+    def building_ids(self, characteristics=None):
+        """Return the building ids in the baseline results that match the characteristics
+
+        :param characteristics: a mapping of characteristic to an allowed value or list of allowed values, for
+            instance ``{'County': ['CO, Denver County', 'CO, Jefferson County'], 'Vintage': '1980s'}``
+        :type characteristics: dict, optional
+        :return: list of building ids
+        """
+        dataset = self._dataset(self._results_path(0))
+        filter_expr = self._characteristics_expression(characteristics)
+        tbl = dataset.to_table(columns=['building_id'], filter=filter_expr)
+        return tbl.column('building_id').to_pylist()
+
+    @staticmethod
+    def _characteristics_expression(characteristics):
+        expr = None
+        for name, values in (characteristics or {}).items():
+            if isinstance(values, (str, int, float, bool)):
+                values = [values]
+            col_expr = ds.field(characteristic_column_name(name)).isin(list(values))
+            expr = col_expr if expr is None else expr & col_expr
+        return expr
+
+    def _filter_expression(self, dataset, building_ids=None, characteristics=None, time_col=None, start=None,
+                           end=None):
+        if characteristics:
+            matching_ids = self.building_ids(characteristics)
+            if building_ids is None:
+                building_ids = matching_ids
+            else:
+                building_ids = sorted(set(building_ids).intersection(matching_ids))
+        exprs = []
+        if building_ids is not None:
+            exprs.append(ds.field('building_id').isin(list(map(int, building_ids))))
+        if start is not None or end is not None:
+            time_type = dataset.schema.field(time_col).type
+            if start is not None:
+                exprs.append(ds.field(time_col) >= pa.scalar(pd.Timestamp(start), type=time_type))
+            if end is not None:
+                exprs.append(ds.field(time_col) < pa.scalar(pd.Timestamp(end), type=time_type))
+        expr = None
+        for x in exprs:
+            expr = x if expr is None else expr & x
+        return expr
+
+    @staticmethod
+    def _project(dataset, columns):
+        if columns is None:
+            return None
+        columns = list(columns)
+        if 'building_id' not in columns:
+            columns.insert(0, 'building_id')
+        missing_cols = set(columns).difference(dataset.schema.names)
+        if missing_cols:
+            raise KeyError(f'Columns not found in results: {sorted(missing_cols)}')
+        return columns
+
+    @staticmethod
+    def _iter_batches(dataset, columns, filter_expr, batch_size, as_pandas):
+        for batch in dataset.to_batches(columns=columns, filter=filter_expr, batch_size=batch_size):
+            if batch.num_rows == 0:
+                continue
+            yield batch.to_pandas() if as_pandas else batch
+
+    def _scan_results(self, upgrade, building_ids, characteristics, columns):
+        dataset = self._dataset(self._results_path(upgrade))
+        columns = self._project(dataset, columns)
+        filter_expr = self._filter_expression(dataset, building_ids, characteristics)
+        return dataset, columns, filter_expr
+
+    @property
+    def time_axes(self):
+        """The time axes the timeseries reference if the timestamps were deduplicated, otherwise ``None``
+
+        Each row is a timestep of a time axis identified by the ``time_axis`` and ``timestep`` columns.
+        """
+        if not hasattr(self, '_time_axes'):
+            time_axes_path = f'{self.parquet_dir}/time_axes'
+            if self.fs.exists(time_axes_path):
+                tbl = self._dataset(time_axes_path).to_table()
+                self._time_axes = tbl.sort_by([('time_axis', 'ascending'), ('timestep', 'ascending')])
+            else:
+                self._time_axes = None
+        return self._time_axes
+
+    def _time_axes_filter(self, time_col, start, end):
+        time_axes = self.time_axes.to_pandas()
+        time_values = pd.to_datetime(time_axes[time_col])
+        mask = pd.Series(True, index=time_axes.index)
+        if start is not None:
+            mask &= time_values >= pd.Timestamp(start)
+        if end is not None:
+            mask &= time_values < pd.Timestamp(end)
+        # No timesteps match if no time axis has any in range
+        expr = ds.field('timestep') < 0
+        for time_axis, timesteps in time_axes.loc[mask].groupby('time_axis')['timestep']:
+            timesteps = timesteps.sort_values()
+            if timesteps.iloc[-1] - timesteps.iloc[0] + 1 == len(timesteps):
+                timestep_expr = (ds.field('timestep') >= timesteps.iloc[0]) & \
+                    (ds.field('timestep') <= timesteps.iloc[-1])
+            else:
+                timestep_expr = ds.field('timestep').isin(timesteps.tolist())
+            expr = expr | ((ds.field('time_axis') == time_axis) & timestep_expr)
+        return expr
+
+    def _add_time_columns(self, tbl, time_cols, drop_cols):
+        if not time_cols and not drop_cols:
+            return tbl
+        time_axes = self.time_axes
+        if time_cols:
+            axis_names, axis_starts = np.unique(time_axes.column('time_axis').to_numpy(), return_index=True)
+            axis_starts = pd.Series(axis_starts, index=axis_names)
+            idx = axis_starts.reindex(tbl.column('time_axis').to_numpy()).to_numpy() + \
+                tbl.column('timestep').to_numpy()
+            idx = pa.array(idx)
+            i = tbl.schema.get_field_index('time_axis')
+            for col in reversed(time_cols):
+                tbl = tbl.add_column(i, time_axes.schema.field(col), time_axes.column(col).take(idx))
+        for col in drop_cols:
+            tbl = tbl.remove_column(tbl.schema.get_field_index(col))
+        return tbl
+
+    def _scan_timeseries(self, upgrade, building_ids, characteristics, start, end, columns, time_col):
+        families = self.timeseries_column_families
+        if not families or self.fs.exists(self._timeseries_path(upgrade)):
+            datasets = [self._dataset(self._timeseries_path(upgrade))]
+        else:
+            datasets = [self._dataset(self._timeseries_path(upgrade, family)) for family in families]
+        key_cols = [x for x in datasets[0].schema.names if all(x in d.schema.names for d in datasets)]
+
+        # When the timestamps were deduplicated the time columns are looked up in the time axes by the time_axis and
+        # timestep columns.
+        time_cols = []
+        drop_cols = []
+        time_filter = None
+        if 'time_axis' in key_cols and self.time_axes is not None:
+            axes_time_cols = [x for x in self.time_axes.column_names if x not in ('time_axis', 'timestep')]
+            if columns is None:
+                time_cols = axes_time_cols
+            else:
+                time_cols = [x for x in columns if x in axes_time_cols]
+                if time_cols:
+                    # Read the time_axis and timestep where the first time column was requested
+                    drop_cols = [x for x in ('time_axis', 'timestep') if x not in columns]
+                    i = columns.index(time_cols[0])
+                    columns = [x for x in columns[:i] if x not in axes_time_cols] + drop_cols + \
+                        [x for x in columns[i:] if x not in axes_time_cols]
+            if start is not None or end is not None:
+                time_filter = self._time_axes_filter(get_time_col(axes_time_cols, time_col), start, end)
+                start, end = None, None
+
+        if len(datasets) == 1:
+            dataset = datasets[0]
+            if start is not None or end is not None:
+                time_col = get_time_col(dataset.schema.names, time_col)
+            columns = self._project(dataset, columns)
+            filter_expr = self._filter_expression(dataset, building_ids, characteristics, time_col, start, end)
+            parts = [(dataset, columns)]
+        else:
+            # The timeseries are split into column families that share the building_id and time columns, only read
+            # the families that have the requested columns.
+            if columns is None:
+                requested_cols = None
+            else:
+                requested_cols = [x for x in columns if x not in key_cols]
+                all_cols = set(key_cols).union(*[d.schema.names for d in datasets])
+                missing_cols = set(requested_cols).difference(all_cols)
+                if missing_cols:
+                    raise KeyError(f'Columns not found in results: {sorted(missing_cols)}')
+            parts = []
+            for dataset in datasets:
+                family_cols = [x for x in dataset.schema.names if x not in key_cols]
+                if requested_cols is not None:
+                    family_cols = [x for x in family_cols if x in requested_cols]
+                    if not family_cols:
+                        continue
+                part_key_cols = [x for x in key_cols if columns is None or x in columns or x == 'building_id']
+                parts.append((dataset, (part_key_cols if not parts else []) + family_cols))
+            if not parts:
+                parts.append((datasets[0], self._project(datasets[0], [x for x in columns if x in key_cols])))
+            if start is not None or end is not None:
+                time_col = get_time_col(key_cols, time_col)
+            filter_expr = self._filter_expression(datasets[0], building_ids, characteristics, time_col, start, end)
+
+        if time_filter is not None:
+            filter_expr = time_filter if filter_expr is None else filter_expr & time_filter
+        return parts, filter_expr, (time_cols, drop_cols)
+
+    def _iter_timeseries_tables(self, parts, filter_expr):
+        first_dataset, first_cols = parts[0]
+        for filename in first_dataset.files:
+            basename = filename.split('/')[-1]
+            tbl = ds.dataset(filename, filesystem=self.fs, format='parquet').to_table(
+                columns=first_cols, filter=filter_expr
+            )
+            for dataset, cols in parts[1:]:
+                family_filename = [x for x in dataset.files if x.split('/')[-1] == basename]
+                if len(family_filename) != 1:
+                    raise RuntimeError(f'Could not find {basename} in {dataset.files}')
+                family_tbl = ds.dataset(family_filename[0], filesystem=self.fs, format='parquet').to_table(
+                    columns=cols, filter=filter_expr
+                )
+                if family_tbl.num_rows != tbl.num_rows:
+                    raise RuntimeError(f'The timeseries column families for {basename} are not aligned.')
+                for i, col in enumerate(cols):
+                    tbl = tbl.append_column(family_tbl.schema.field(i), family_tbl.column(i))
+            yield tbl
+
+    def results(self, upgrade=0, building_ids=None, characteristics=None, columns=None, as_pandas=True):
+        """Read the annual results for an upgrade
+
+        :param upgrade: upgrade id, 0 for baseline, defaults to 0
+        :type upgrade: int, optional
+        :param building_ids: only return these buildings
+        :type building_ids: list[int], optional
+        :param characteristics: only return buildings with these baseline characteristics, see
+            :meth:`building_ids`
+        :type characteristics: dict, optional
+        :param columns: columns to read, defaults to all columns. ``building_id`` is always included.
+        :type columns: list[str], optional
+        :param as_pandas: return a pandas DataFrame instead of a pyarrow Table, defaults to True
+        :type as_pandas: bool, optional
+        :return: results table
+        """
+        dataset, columns, filter_expr = self._scan_results(upgrade, building_ids, characteristics, columns)
+        tbl = dataset.to_table(columns=columns, filter=filter_expr)
+        return tbl.to_pandas() if as_pandas else tbl
+
+    def iter_results(self, upgrade=0, building_ids=None, characteristics=None, columns=None, as_pandas=True,
+                     batch_size=DEFAULT_BATCH_SIZE):
+        """Iterate over the annual results for an upgrade in batches
+
+        Takes the same arguments as :meth:`results` and yields DataFrames (or pyarrow RecordBatches) of at most
+        ``batch_size`` rows.
+        """
+        dataset, columns, filter_expr = self._scan_results(upgrade, building_ids, characteristics, columns)
+        yield from self._iter_batches(dataset, columns, filter_expr, batch_size, as_pandas)
+
+    def timeseries(self, upgrade=0, building_ids=None, characteristics=None, start=None, end=None, columns=None,
+                   time_col=None, as_pandas=True):
+        """Read the timeseries results for an upgrade
+
+        :param upgrade: upgrade id, 0 for baseline, defaults to 0
+        :type upgrade: int, optional
+        :param building_ids: only return these buildings
+        :type building_ids: list[int], optional
+        :param characteristics: only return buildings with these baseline characteristics, see
+            :meth:`building_ids`
+        :type characteristics: dict, optional
+        :param start: only return timesteps at or after this time
+        :type start: str or datetime, optional
+        :param end: only return timesteps before this time
+        :type end: str or datetime, optional
+        :param columns: columns to read, defaults to all columns. ``building_id`` is always included.
+        :type columns: list[str], optional
+        :param time_col: column to apply ``start`` and ``end`` to, defaults to the first of ``Time``, ``time`` or
+            ``TimeDST`` in the dataset
+        :type time_col: str, optional
+        :param as_pandas: return a pandas DataFrame instead of a pyarrow Table, defaults to True
+        :type as_pandas: bool, optional
+        :return: timeseries table
+        """
+        parts, filter_expr, time_cols = self._scan_timeseries(
+            upgrade, building_ids, characteristics, start, end, columns, time_col
+        )
+        if len(parts) == 1:
+            dataset, columns = parts[0]
+            tbl = dataset.to_table(columns=columns, filter=filter_expr)
+        else:
+            tbls = list(self._iter_timeseries_tables(parts, filter_expr))
+            tbl = pa.concat_tables(tbls) if tbls else parts[0][0].to_table(columns=parts[0][1], filter=filter_expr)
+        tbl = self._add_time_columns(tbl, *time_cols)
+        return tbl.to_pandas() if as_pandas else tbl
+
+    def iter_timeseries(self, upgrade=0, building_ids=None, characteristics=None, start=None, end=None, columns=None,
+                        time_col=None, as_pandas=True, batch_size=DEFAULT_BATCH_SIZE):
+        """Iterate over the timeseries results for an upgrade in batches
+
+        Takes the same arguments as :meth:`timeseries` and yields DataFrames (or pyarrow RecordBatches) of at most
+        ``batch_size`` rows.
+        """
+        parts, filter_expr, time_cols = self._scan_timeseries(
+            upgrade, building_ids, characteristics, start, end, columns, time_col
+        )
+        if len(parts) == 1 and not any(time_cols):
+            dataset, columns = parts[0]
+            yield from self._iter_batches(dataset, columns, filter_expr, batch_size, as_pandas)
+            return
+        if len(parts) == 1:
+            dataset, columns = parts[0]
+            batches = (
+                pa.Table.from_batches([batch]) for batch in
+                dataset.to_batches(columns=columns, filter=filter_expr, batch_size=batch_size)
+            )
+        else:
+            batches = self._iter_timeseries_tables(parts, filter_expr)
+        for tbl in batches:
+            tbl = self._add_time_columns(tbl, *time_cols)
+            for batch in tbl.to_batches(max_chunksize=batch_size):
+                if batch.num_rows == 0:
+                    continue
+                yield batch.to_pandas() if as_pandas else batch
+
+    def schedules_ids(self, upgrade=0, building_ids=None, characteristics=None):
+        """Return which schedule each building used
+
+        Each distinct schedule is stored once in the ``schedules`` dataset and the timeseries reference it by the
+        ``schedules_id`` column.
+
+        :param upgrade: upgrade id, 0 for baseline, defaults to 0
+        :type upgrade: int, optional
+        :param building_ids: only return these buildings
+        :type building_ids: list[int], optional
+        :param characteristics: only return buildings with these baseline characteristics, see
+            :meth:`building_ids`
+        :type characteristics: dict, optional
+        :return: ``schedules_id`` indexed by ``building_id``
+        :rtype: pandas.Series
+        """
+        tbl = self.timeseries(
+            upgrade, building_ids, characteristics, columns=['schedules_id'], as_pandas=False
+        )
+        df = tbl.select(['building_id', 'schedules_id']).replace_schema_metadata(None).to_pandas()
+        return df.drop_duplicates('building_id').set_index('building_id')['schedules_id'].sort_index()
+
+    def schedules(self, schedules_ids=None, columns=None, as_pandas=True):
+        """Read the schedules the simulations used
+
+        The ``schedules_timestep`` column of the timeseries is the ``timestep`` of the schedule row each time step
+        used, which is shifted for daylight saving time.
+
+        :param schedules_ids: only return these schedules, see :meth:`schedules_ids`
+        :type schedules_ids: list[str], optional
+        :param columns: columns to read, defaults to all columns. ``schedules_id`` and ``timestep`` are always
+            included.
+        :type columns: list[str], optional
+        :param as_pandas: return a pandas DataFrame instead of a pyarrow Table, defaults to True
+        :type as_pandas: bool, optional
+        :return: schedules table
+        """
+        dataset = self._dataset(f'{self.parquet_dir}/schedules')
+        if columns is not None:
+            columns = ['schedules_id', 'timestep'] + [x for x in columns if x not in ('schedules_id', 'timestep')]
+            missing_cols = set(columns).difference(dataset.schema.names)
+            if missing_cols:
+                raise KeyError(f'Columns not found in schedules: {sorted(missing_cols)}')
+        filter_expr = None
+        if schedules_ids is not None:
+            filter_expr = ds.field('schedules_id').isin(list(schedules_ids))
+        tbl = dataset.to_table(columns=columns, filter=filter_expr)
+        return tbl.to_pandas() if as_pandas else tbl
@@ -0,0 +1,716 @@
+# -*- coding: utf-8 -*-
+
+"""
+buildstockbatch.scheduling
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+Splitting the simulations of a batch into jobs and running them on a node
+
+:author: Noel Merket
+:copyright: (c) 2018 by The Alliance for Sustainable Energy
+:license: BSD-3
+"""
+
+import bisect
+import collections
+import concurrent.futures
+import glob
+import heapq
+import itertools
+import json
+import os
+import pandas as pd
+import math
+import random
+import re
+import threading
+
+# Predicted runtimes are multiplied by this to get the wall time to ask for
+PREDICTED_WALLTIME_FACTOR = 1.5
+
+# Fraction of a node's available memory the simulations can use
+NODE_MEMORY_FRACTION = 0.9
+
+# completed_status of a simulation the watchdog killed
+TIMEOUT_STATUS = 'Timeout'
+
+
+def batch_simulations(sims, n_batches, epws_by_building=None, keep_buildings_together=False, sim_cost=None):
+    """Split simulations into batches that each need few weather files and have about the same predicted runtime
+
+    The simulations are ordered by weather file and building and cut into ``n_batches`` contiguous batches of about
+    the same predicted cost, so each weather file ends up in as few batches as possible.
+
+    :param sims: ``(building_id, upgrade_idx)`` of each simulation, ``upgrade_idx`` is None for the baseline
+    :type sims: list
+    :param n_batches: number of batches to split the simulations into, fewer are returned if there aren't enough
+        simulations
+    :type n_batches: int
+    :param epws_by_building: epw filename by building id from
+        :meth:`~buildstockbatch.base.BuildStockBatchBase.get_epws_by_building`, defaults to None
+    :type epws_by_building: dict, optional
+    :param keep_buildings_together: put the baseline and upgrades of a building in the same batch, defaults to False
+    :type keep_buildings_together: bool, optional
+    :param sim_cost: function that takes ``(building_id, upgrade_idx)`` and returns the predicted cost of that
+        simulation, every simulation costs the same if None, defaults to None
+    :type sim_cost: callable, optional
+    :return: batches of ``(building_id, upgrade_idx)``
+    :rtype: list
+    """
+    if epws_by_building is None:
+        epws_by_building = {}
+    if sim_cost is None:
+        def sim_cost(sim):
+            return 1
+
+    # The simulations that have to go in the same batch
+    units = collections.defaultdict(list)
+    for sim in sims:
+        units[sim[0] if keep_buildings_together else tuple(sim)].append(sim)
+    units = sorted(units.values(), key=lambda unit: (str(epws_by_building.get(unit[0][0], '')), unit[0][0]))
+    if not units:
+        return []
+    costs = [sum(sim_cost(sim) for sim in unit) for unit in units]
+    total_cost = sum(costs)
+    if total_cost <= 0:
+        costs = [len(unit) for unit in units]
+        total_cost = sum(costs)
+
+    # Each unit goes in the batch where the middle of its cost falls
+    n_batches = max(1, min(n_batches, len(units)))
+    batches = [[] for _ in range(n_batches)]
+    cumulative_cost = 0
+    for unit, cost in zip(units, costs):
+        i = min(int((cumulative_cost + cost / 2) / total_cost * n_batches), n_batches - 1)
+        batches[i].extend(unit)
+        cumulative_cost += cost
+    return [batch for batch in batches if batch]
+
+
+def order_longest_first(batch, sim_cost):
+    """Order the simulations in a batch from the longest to the shortest predicted runtime
+
+    Started in this order on a node's cores, the long simulations don't end up waiting at the end of the job.
+    """
+    return sorted(batch, key=sim_cost, reverse=True)
+
+
+def predict_makespan(runtimes, n_workers):
+    """Predict how long it takes to run simulations longest first on ``n_workers`` cores
+
+    :param runtimes: predicted runtime of each simulation
+    :type runtimes: iterable
+    :param n_workers: number of simulations that run at once
+    :type n_workers: int
+    :return: time until the last simulation finishes, in the units of ``runtimes``
+    :rtype: float
+    """
+    loads = [0] * n_workers
+    for runtime in sorted(runtimes, reverse=True):
+        heapq.heapreplace(loads, loads[0] + runtime)
+    return max(loads)
+
+
+def select_pilot_sims(buildstock_df, n_sims, n_upgrades, features=(), skip_baseline=False, seed=0):
+    """Pick a small set of simulations that covers the upgrades and kinds of buildings
+
+    The buildings are grouped by their ``features`` values. Each group in turn gets its next building, simulated
+    with the next upgrade, until there are ``n_sims`` simulations.
+
+    :param buildstock_df: buildstock.csv indexed by building id
+    :type buildstock_df: pandas.DataFrame
+    :param n_sims: number of simulations to pick
+    :type n_sims: int
+    :param n_upgrades: number of upgrades in the project
+    :type n_upgrades: int
+    :param features: buildstock.csv columns to spread the simulations over, defaults to ()
+    :type features: list, optional
+    :param skip_baseline: don't pick baseline simulations, defaults to False
+    :type skip_baseline: bool, optional
+    :param seed: random seed for picking buildings in a group, defaults to 0
+    :type seed: int, optional
+    :return: ``(building_id, upgrade_idx)`` of each simulation
+    :rtype: list
+    """
+    upgrade_idxs = ([] if skip_baseline else [None]) + list(range(n_upgrades))
+    rng = random.Random(seed)
+    if features:
+        groups = [df.index.tolist() for _, df in buildstock_df.groupby(list(features))]
+    else:
+        groups = [buildstock_df.index.tolist()]
+    for group in groups:
+        rng.shuffle(group)
+    groups.sort(key=len, reverse=True)
+
+    # Round m gives group g its (m // n_upgrades)th building with upgrade (g + m) % n_upgrades, so each building is
+    # simulated with every upgrade before the group moves on to the next building.
+    sims = []
+    for m in itertools.count():
+        groups_left = [group for group in groups if m // len(upgrade_idxs) < len(group)]
+        if not groups_left or not upgrade_idxs:
+            break
+        for g, group in enumerate(groups_left):
+            if len(sims) >= n_sims:
+                return sims
+            sims.append((group[m // len(upgrade_idxs)], upgrade_idxs[(g + m) % len(upgrade_idxs)]))
+    return sims
+
+
+def available_memory_mb():
+    """The memory available for starting new processes, ``MemAvailable`` in /proc/meminfo
+
+    :return: available memory in MiB, None where /proc/meminfo doesn't have it
+    :rtype: float
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_tree_memory_mb(pid):
+    """The resident memory of all the descendants of a process together, from /proc
+
+    :param pid: process id
+    :type pid: int
+    :return: memory in MiB, None where there's no /proc
+    :rtype: float
+    """
+    children = collections.defaultdict(list)
+    try:
+        proc_pids = [int(x) for x in os.listdir('/proc') if x.isdigit()]
+    except OSError:
+        return None
+    for proc_pid in proc_pids:
+        try:
+            with open(f'/proc/{proc_pid}/stat', 'r') as f:
+                # The command name is in parentheses and can have spaces in it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[ppid].append(proc_pid)
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    rss = 0
+    stack = list(children[pid])
+    while stack:
+        proc_pid = stack.pop()
+        stack.extend(children[proc_pid])
+        try:
+            with open(f'/proc/{proc_pid}/statm', 'r') as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss / 1024 ** 2
+
+
+class PeakMemorySampler:
+    """Samples the memory of the processes started from this one in a background thread and keeps the peak
+
+    The peak of the whole process tree counts everything that runs at the same time, like openstudio and EnergyPlus
+    inside a container, where ``ru_maxrss`` only has the largest single process.
+
+    .. code-block:: python
+
+        with PeakMemorySampler() as sampler:
+            subprocess.run(args)
+        sampler.peak_mb
+    """
+
+    def __init__(self, interval=0.5):
+        """
+        :param interval: seconds between samples, defaults to 0.5
+        :type interval: float, optional
+        """
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        memory_mb = process_tree_memory_mb(os.getpid())
+        if memory_mb is not None:
+            self.peak_mb = max(memory_mb, self.peak_mb or 0)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='PeakMemorySampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_admitted(executor, fn, sims, max_running, memory_mb=None, sim_memory=None):
+    """Run simulations on an executor, starting each one when a worker is free and its memory fits
+
+    A simulation is only started when the predicted peak memory of it and the running simulations is no more than
+    ``memory_mb``, unless nothing else is running. ``sims`` is read from as simulations are started, so it can be
+    a generator that claims more work as it goes.
+
+    :param executor: a :class:`concurrent.futures.Executor` with at least ``max_running`` workers
+    :param fn: called with ``(building_id, upgrade_idx)`` of each simulation
+    :type fn: callable
+    :param sims: ``(building_id, upgrade_idx)`` of each simulation
+    :type sims: iterable
+    :param max_running: most simulations to run at once
+    :type max_running: int
+    :param memory_mb: memory the simulations can use in MiB, no limit if None, defaults to None
+    :type memory_mb: float, optional
+    :param sim_memory: predicts the peak memory of a simulation in MiB, None if it isn't known, defaults to None
+    :type sim_memory: callable, optional
+    :return: generator of the results of ``fn``, in the order the simulations finish
+    """
+    sims = iter(sims)
+    running = {}
+    memory_used = 0
+    next_sim = None
+    while True:
+        while len(running) < max_running:
+            if next_sim is None:
+                next_sim = next(sims, None)
+                if next_sim is None:
+                    break
+            sim_mb = 0
+            if memory_mb is not None and sim_memory is not None:
+                sim_mb = sim_memory(next_sim) or 0
+            if running and memory_mb is not None and memory_used + sim_mb > memory_mb:
+                break
+            running[executor.submit(fn, *next_sim)] = sim_mb
+            memory_used += sim_mb
+            next_sim = None
+        if not running:
+            return
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            memory_used -= running.pop(future)
+            yield future.result()
+
+
+def _to_datetime(s):
+    if s.dtype == object:
+        try:
+            return pd.to_datetime(s, format='%Y%m%dT%H%M%SZ')
+        except (ValueError, TypeError):
+            pass
+    return pd.to_datetime(s)
+
+
+class RuntimeModel(object):
+    """Predicts the runtime of a simulation from the runtimes of earlier simulations
+
+    The prediction is the median runtime of earlier simulations of the same upgrade and with the same values of the
+    ``features``, which are buildstock.csv columns. Where there are none of those it falls back to the median of the
+    upgrade and then of all simulations. Saved to a file it is the calibration file written by a pilot run, which
+    also has the peak memory the simulations used, looked up the same way.
+    """
+
+    def __init__(self, features, runtimes, peak_memory_mb=None, peak_memory=None):
+        """
+        :param features: buildstock.csv columns the runtime depends on
+        :type features: list
+        :param runtimes: median runtime in seconds by ``()``, ``(upgrade,)`` and ``(upgrade, *feature_values)``
+        :type runtimes: dict
+        :param peak_memory_mb: most memory a simulation used in MiB, None if it wasn't measured
+        :type peak_memory_mb: float, optional
+        :param peak_memory: most memory a simulation used in MiB by the same keys as ``runtimes``, defaults to {}
+        :type peak_memory: dict, optional
+        """
+        self.features = list(features)
+        self.runtimes = runtimes
+        self.peak_memory_mb = peak_memory_mb
+        self.peak_memory = peak_memory or {}
+
+    @classmethod
+    def fit(cls, results_df, buildings_df=None, features=()):
+        """Fit to the runtimes of earlier simulations
+
+        :param results_df: results with ``building_id``, ``upgrade``, ``completed_status`` and either
+            ``started_at`` and ``completed_at`` or the measured ``runtime_s`` columns, and optionally the measured
+            ``peak_memory_mb``
+        :type results_df: pandas.DataFrame
+        :param buildings_df: the ``features`` of each building, indexed by building id
+        :type buildings_df: pandas.DataFrame, optional
+        :param features: buildstock.csv columns the runtime depends on, defaults to ()
+        :type features: list, optional
+        :rtype: RuntimeModel
+        """
+        features = list(features)
+        df = results_df.loc[results_df['completed_status'] == 'Success', ['building_id', 'upgrade']].copy()
+        if 'runtime_s' in results_df.columns:
+            df['runtime'] = results_df.loc[df.index, 'runtime_s']
+        else:
+            df['runtime'] = (
+                _to_datetime(results_df.loc[df.index, 'completed_at']) -
+                _to_datetime(results_df.loc[df.index, 'started_at'])
+            ).dt.total_seconds()
+        peak_memory_mb = None
+        if 'peak_memory_mb' in results_df.columns and results_df['peak_memory_mb'].notna().any():
+            peak_memory_mb = float(results_df['peak_memory_mb'].max())
+            df['memory'] = results_df.loc[df.index, 'peak_memory_mb']
+        else:
+            df['memory'] = float('nan')
+        df = df[df['runtime'] > 0]
+        df['upgrade'] = df['upgrade'].astype(int)
+        if features:
+            df = df.join(buildings_df[features].astype(str), on='building_id', how='inner')
+
+        runtimes = {}
+        peak_memory = {}
+        if not df.empty:
+            runtimes[()] = float(df['runtime'].median())
+            if df['memory'].notna().any():
+                peak_memory[()] = float(df['memory'].max())
+        groupbys = [['upgrade'], ['upgrade'] + features] if features else [['upgrade']]
+        for groupby in groupbys:
+            grouped = df.groupby(groupby)
+            for key, runtime in grouped['runtime'].median().items():
+                key = key if isinstance(key, tuple) else (key,)
+                runtimes[(int(key[0]), *key[1:])] = float(runtime)
+            for key, memory in grouped['memory'].max().dropna().items():
+                key = key if isinstance(key, tuple) else (key,)
+                peak_memory[(int(key[0]), *key[1:])] = float(memory)
+        return cls(features, runtimes, peak_memory_mb, peak_memory)
+
+    @classmethod
+    def fit_to_results_dir(cls, results_dir, features=()):
+        """Fit to the ``results_csvs`` of an earlier run
+
+        :param results_dir: ``results`` directory of an earlier run
+        :type results_dir: str
+        :param features: buildstock.csv columns the runtime depends on, defaults to ()
+        :type features: list, optional
+        :rtype: RuntimeModel
+        """
+        results_dfs = []
+        for filename in sorted(glob.glob(os.path.join(results_dir, 'results_csvs', 'results_up*.csv.gz'))):
+            upgrade = int(re.search(r'results_up(\d+)\.csv\.gz$', filename).group(1))
+            results_dfs.append(pd.read_csv(filename).assign(upgrade=upgrade))
+        if not results_dfs:
+            raise FileNotFoundError(f'No results_csvs in {results_dir}')
+        results_df = pd.concat(results_dfs, ignore_index=True)
+
+        # The building characteristics are in the baseline results
+        feature_cols = {f'build_existing_model.{x.lower().replace(" ", "_")}': x for x in features}
+        missing_cols = set(feature_cols.keys()).difference(results_df.columns)
+        if missing_cols:
+            raise ValueError(f'The results in {results_dir} don\'t have {", ".join(sorted(missing_cols))}')
+        buildings_df = results_df.loc[results_df['upgrade'] == 0, ['building_id', *feature_cols.keys()]]. \
+            set_index('building_id').rename(columns=feature_cols)
+        return cls.fit(results_df, buildings_df, features)
+
+    @classmethod
+    def load(cls, filename, features=()):
+        """Load a model saved with :meth:`save`, or fit one to an earlier run's results directory
+
+        :param filename: json file or results directory
+        :type filename: str
+        :param features: buildstock.csv columns the runtime depends on when fitting to a results directory
+        :type features: list, optional
+        :rtype: RuntimeModel
+        """
+        if os.path.isdir(filename):
+            return cls.fit_to_results_dir(filename, features)
+        with open(filename, 'r') as f:
+            model_json = json.load(f)
+        return cls(
+            model_json['features'],
+            {tuple(x['key']): x['runtime_s'] for x in model_json['runtimes']},
+            model_json.get('peak_memory_mb'),
+            {
+                tuple(x['key']): x['peak_memory_mb']
+                for x in model_json['runtimes'] if x.get('peak_memory_mb') is not None
+            }
+        )
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({
+                'features': self.features,
+                'runtimes': [
+                    {'key': list(key), 'runtime_s': runtime, 'peak_memory_mb': self.peak_memory.get(key)}
+                    for key, runtime in sorted(self.runtimes.items(), key=lambda x: (len(x[0]), str(x[0])))
+                ],
+                'peak_memory_mb': self.peak_memory_mb
+            }, f, indent=2)
+
+    def predict(self, upgrade, feature_values=()):
+        """Predict the runtime of a simulation in seconds
+
+        :param upgrade: upgrade id, 0 for the baseline
+        :type upgrade: int
+        :param feature_values: values of the building's ``features``
+        :type feature_values: tuple, optional
+        :return: predicted runtime in seconds, None if nothing was fitted
+        :rtype: float
+        """
+        for key in ((upgrade, *feature_values), (upgrade,), ()):
+            if key in self.runtimes:
+                return self.runtimes[key]
+
+    def predict_memory(self, upgrade, feature_values=()):
+        """Predict the peak memory of a simulation in MiB
+
+        :param upgrade: upgrade id, 0 for the baseline
+        :type upgrade: int
+        :param feature_values: values of the building's ``features``
+        :type feature_values: tuple, optional
+        :return: peak memory in MiB, None if it wasn't measured
+        :rtype: float
+        """
+        for key in ((upgrade, *feature_values), (upgrade,), ()):
+            if key in self.peak_memory:
+                return self.peak_memory[key]
+        return self.peak_memory_mb
+
+    def _feature_values(self, buildstock_df):
+        if not self.features:
+            return {}
+        return dict(zip(
+            buildstock_df.index,
+            buildstock_df[self.features].astype(str).itertuples(index=False, name=None)
+        ))
+
+    def sim_memory(self, buildstock_df):
+        """A function that predicts the peak memory of ``(building_id, upgrade_idx)`` for :func:`run_admitted`
+
+        :param buildstock_df: buildstock.csv indexed by building id
+        :type buildstock_df: pandas.DataFrame
+        :return: None if the memory wasn't measured
+        :rtype: callable
+        """
+        if self.peak_memory_mb is None and not self.peak_memory:
+            return None
+        feature_values = self._feature_values(buildstock_df)
+
+        def sim_memory(sim):
+            building_id, upgrade_idx = sim
+            upgrade = 0 if upgrade_idx is None else upgrade_idx + 1
+            return self.predict_memory(upgrade, feature_values.get(building_id, ()))
+
+        return sim_memory
+
+    def sim_cost(self, buildstock_df):
+        """A function that predicts the runtime of ``(building_id, upgrade_idx)`` for :func:`batch_simulations`
+
+        :param buildstock_df: buildstock.csv indexed by building id
+        :type buildstock_df: pandas.DataFrame
+        :rtype: callable
+        """
+        feature_values = self._feature_values(buildstock_df)
+        default_runtime = self.runtimes.get((), 1)
+
+        def sim_cost(sim):
+            building_id, upgrade_idx = sim
+            upgrade = 0 if upgrade_idx is None else upgrade_idx + 1
+            runtime = self.predict(upgrade, feature_values.get(building_id, ()))
+            return default_runtime if runtime is None else runtime
+
+        return sim_cost
+
+
+class RuntimeWatchdog(object):
+    """Works out how long to let a simulation run from the runtimes of the simulations that finished before it
+
+    The timeout is ``percentile`` of the runtimes of the upgrade times ``factor``, once there are ``min_samples`` of
+    them, and of all upgrades before that. It's never less than ``min_timeout_s`` or ``factor`` times the longest
+    runtime the runtime model it was seeded with predicts for the upgrade. Until there are enough runtimes, and at
+    most, it's ``max_timeout_s``.
+
+    The first runtimes to come in are the fastest of the simulations that started together, so ``min_samples`` should
+    be well over the number of simulations running at once, see :meth:`from_cfg`.
+    """
+
+    def __init__(self, factor=3, percentile=99, min_samples=20, min_timeout_s=600, max_timeout_s=None,
+                 runtime_model=None):
+        """
+        :param factor: multiplies the percentile to get the timeout, defaults to 3
+        :type factor: float, optional
+        :param percentile: percentile of the runtimes, defaults to 99
+        :type percentile: float, optional
+        :param min_samples: runtimes needed before the percentile is used, defaults to 20
+        :type min_samples: int, optional
+        :param min_timeout_s: shortest timeout in seconds, defaults to 600
+        :type min_timeout_s: float, optional
+        :param max_timeout_s: longest timeout in seconds, no limit if None, defaults to None
+        :type max_timeout_s: float, optional
+        :param runtime_model: predicted runtimes, from a pilot, that the timeouts are never shorter than ``factor``
+            times, defaults to None
+        :type runtime_model: RuntimeModel, optional
+        """
+        self.factor = factor
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_timeout_s = min_timeout_s
+        self.max_timeout_s = max_timeout_s
+        self.runtimes = collections.defaultdict(list)
+        self.all_runtimes = []
+        # Longest predicted runtime by upgrade, and of all of them under None
+        self.predicted_runtimes = {}
+        if runtime_model is not None:
+            for key, runtime in runtime_model.runtimes.items():
+                for upgrade in ((key[0], None) if key else (None,)):
+                    self.predicted_runtimes[upgrade] = max(runtime, self.predicted_runtimes.get(upgrade, 0))
+
+    @classmethod
+    def from_cfg(cls, timeout_cfg, max_running=1, runtime_model=None):
+        """Make one from the ``simulation_timeout`` configuration
+
+        :param timeout_cfg: ``simulation_timeout`` section of the eagle or aws configuration, None if there isn't one
+        :type timeout_cfg: dict
+        :param max_running: number of simulations running at once, it waits for twice as many runtimes as this,
+            defaults to 1
+        :type max_running: int, optional
+        :param runtime_model: predicted runtimes to seed it with, defaults to None
+        :type runtime_model: RuntimeModel, optional
+        :return: None if there's no configuration or it's turned off
+        :rtype: RuntimeWatchdog
+        """
+        if timeout_cfg is None or not timeout_cfg.get('enabled', True):
+            return None
+        max_minutes = timeout_cfg.get('max_minutes')
+        return cls(
+            factor=timeout_cfg.get('factor', 3),
+            min_samples=max(20, 2 * max_running),
+            min_timeout_s=timeout_cfg.get('min_minutes', 10) * 60,
+            max_timeout_s=None if max_minutes is None else max_minutes * 60,
+            runtime_model=runtime_model
+        )
+
+    def record(self, upgrade, runtime_s):
+        """Add the runtime of a simulation that finished
+
+        :param upgrade: upgrade id, 0 for the baseline
+        :type upgrade: int
+        :param runtime_s: runtime in seconds
+        :type runtime_s: float
+        """
+        bisect.insort(self.runtimes[upgrade], runtime_s)
+        bisect.insort(self.all_runtimes, runtime_s)
+
+    def _percentile(self, runtimes):
+        return runtimes[min(math.ceil(len(runtimes) * self.percentile / 100), len(runtimes)) - 1]
+
+    def timeout(self, upgrade):
+        """How long to let a simulation of an upgrade run
+
+        :param upgrade: upgrade id, 0 for the baseline
+        :type upgrade: int
+        :return: timeout in seconds, None if there's no limit yet
+        :rtype: float
+        """
+        min_timeout_s = max(
+            self.min_timeout_s,
+            self.predicted_runtimes.get(upgrade, self.predicted_runtimes.get(None, 0)) * self.factor
+        )
+        for runtimes in (self.runtimes[upgrade], self.all_runtimes):
+            if len(runtimes) >= self.min_samples:
+                timeout = max(self._percentile(runtimes) * self.factor, min_timeout_s)
+                if self.max_timeout_s is not None:
+                    timeout = min(timeout, self.max_timeout_s)
+                return timeout
+        return self.max_timeout_s
+
+
+class WorkQueue(object):
+    """Simulations that array jobs claim a chunk at a time from a directory on a shared filesystem
+
+    Each chunk is a json file in ``pending``. A job claims one by renaming it into ``claimed``, which is atomic, so
+    only one job gets each chunk. A job first claims the chunks it was given, in order, and then takes the last chunks
+    of the job with the most left. Chunks are moved to ``done`` when their results are saved, so the ones in
+    ``claimed`` at the end were lost with a job that didn't finish.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.pending_dir = os.path.join(queue_dir, 'pending')
+        self.claimed_dir = os.path.join(queue_dir, 'claimed')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        self._next_own_chunk = 0
+
+    @staticmethod
+    def chunk_name(job_num, chunk_num):
+        return f'job{job_num:03d}_{chunk_num:05d}.json'
+
+    def put(self, job_num, sims, chunk_size):
+        """Add a job's simulations to the queue
+
+        :param job_num: job the simulations are given to
+        :type job_num: int
+        :param sims: ``(building_id, upgrade_idx)`` of each simulation
+        :type sims: list
+        :param chunk_size: number of simulations claimed at a time
+        :type chunk_size: int
+        :return: number of chunks
+        :rtype: int
+        """
+        for dirname in (self.pending_dir, self.claimed_dir, self.done_dir):
+            os.makedirs(dirname, exist_ok=True)
+        chunks = [sims[i:i + chunk_size] for i in range(0, len(sims), chunk_size)]
+        for chunk_num, chunk in enumerate(chunks):
+            # Write it elsewhere first so a job never claims a partly written chunk
+            name = self.chunk_name(job_num, chunk_num)
+            tmp_filename = os.path.join(self.queue_dir, f'.{name}')
+            with open(tmp_filename, 'w') as f:
+                json.dump(chunk, f)
+            os.rename(tmp_filename, os.path.join(self.pending_dir, name))
+        return len(chunks)
+
+    def _take(self, name):
+        try:
+            os.rename(os.path.join(self.pending_dir, name), os.path.join(self.claimed_dir, name))
+        except FileNotFoundError:
+            return None
+        with open(os.path.join(self.claimed_dir, name), 'r') as f:
+            return name, [tuple(sim) for sim in json.load(f)]
+
+    def claim(self, job_num):
+        """Claim the next chunk of simulations for a job
+
+        :param job_num: job that claims the chunk
+        :type job_num: int
+        :return: ``(chunk name, simulations)``, None when the queue is empty
+        :rtype: tuple
+        """
+        # The job's own chunks
+        while True:
+            name = self.chunk_name(job_num, self._next_own_chunk)
+            claimed = self._take(name)
+            if claimed is not None:
+                self._next_own_chunk += 1
+                return claimed
+            if os.path.exists(os.path.join(self.claimed_dir, name)) or \
+                    os.path.exists(os.path.join(self.done_dir, name)):
+                # Another job took it
+                self._next_own_chunk += 1
+            else:
+                break
+
+        # Take over the end of the job with the most chunks left
+        while True:
+            pending_by_job = collections.defaultdict(list)
+            for name in os.listdir(self.pending_dir):
+                pending_by_job[name.split('_')[0]].append(name)
+            if not pending_by_job:
+                return None
+            names = max(pending_by_job.values(), key=len)
+            for name in sorted(names, reverse=True):
+                claimed = self._take(name)
+                if claimed is not None:
+                    return claimed
+
+    def done(self, names):
+        """Mark chunks as done once the results of their simulations are saved
+
+        :param names: chunk names from :meth:`claim`
+        :type names: list
+        """
+        for name in names:
+            os.rename(os.path.join(self.claimed_dir, name), os.path.join(self.done_dir, name))
@@ -341,6 +341,32 @@ def test_write_parquet_no_index():
         assert df.columns.values.tolist() == schema.names
 
 
+def test_get_epws_by_building(tmp_path):
+    options_lookup_filename = tmp_path / 'options_lookup.tsv'
+    with open(options_lookup_filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['Parameter Name', 'Option Name', 'Measure Dir', 'Measure Arg 1'])
+        writer.writerow(['Location', 'AL_Mobile', 'ResidentialLocation', 'weather_file_name=AL_Mobile.epw'])
+        writer.writerow(['Location', 'CO_Denver', 'ResidentialLocation', 'weather_file_name=CO_Denver.epw'])
+        writer.writerow(['Vintage', '1980s', 'ResidentialGeometry', 'year_built=1985'])
+    buildstock_csv_filename = tmp_path / 'buildstock.csv'
+    pd.DataFrame({
+        'Building': [1, 2, 3],
+        'Location': ['CO_Denver', 'AL_Mobile', 'CO_Denver'],
+        'Vintage': ['1980s'] * 3,
+    }).to_csv(buildstock_csv_filename, index=False)
+
+    epws_by_building = BuildStockBatchBase.get_epws_by_building(buildstock_csv_filename, options_lookup_filename)
+    assert epws_by_building == {1: 'CO_Denver.epw', 2: 'AL_Mobile.epw', 3: 'CO_Denver.epw'}
+
+    # No parameter has weather files in the test buildstock
+    epws_by_building = BuildStockBatchBase.get_epws_by_building(
+        os.path.join(here, 'buildstock.csv'),
+        os.path.join(here, 'test_inputs', 'test_openstudio_buildstock', 'resources', 'options_lookup.tsv')
+    )
+    assert epws_by_building == {}
+
+
 def test_skipping_baseline(basic_residential_project_file):
     project_filename, results_dir = basic_residential_project_file({
         'baseline': {
@@ -1,9 +1,11 @@
 import os
+import pytest
 import requests
 import re
 from unittest.mock import patch
 
 from buildstockbatch.base import BuildStockBatchBase
+from buildstockbatch.localdocker import LocalDockerBatch
 
 here = os.path.dirname(os.path.abspath(__file__))
 
@@ -35,3 +37,15 @@ def test_docker_image_exists_on_docker_hub(basic_residential_project_file):
             headers={'Authorization': f'Bearer {token}'}
         )
         assert(r3.ok)
+
+
+@patch('buildstockbatch.localdocker.docker')
+def test_get_n_jobs(mock_docker):
+    mock_docker.client.from_env.return_value.info.return_value = {'NCPU': 8}
+    assert LocalDockerBatch.get_n_jobs() == 8
+    assert LocalDockerBatch.get_n_jobs(-1) == 8
+    assert LocalDockerBatch.get_n_jobs(-2) == 7
+    assert LocalDockerBatch.get_n_jobs(-20) == 1
+    assert LocalDockerBatch.get_n_jobs(3) == 3
+    with pytest.raises(ValueError):
+        LocalDockerBatch.get_n_jobs(0)
@@ -1,22 +1,41 @@
-import joblib
+import asyncio
 import json
 import os
 import pandas as pd
 import pathlib
+import pytest
 import requests
 import shutil
 import tarfile
-from unittest.mock import patch
+import threading
+import time
+from unittest.mock import Mock, patch
 import gzip
 
 from buildstockbatch.eagle import user_cli, EagleBatch
+from buildstockbatch.scheduling import WorkQueue
 from buildstockbatch.utils import get_project_configuration
 
 here = os.path.dirname(os.path.abspath(__file__))
 
 
-@patch('buildstockbatch.eagle.subprocess')
-def test_hpc_run_building(mock_subprocess, monkeypatch, basic_residential_project_file):
+def async_mock(**kwargs):
+    """Mock a coroutine function, the awaited calls are recorded on its ``mock``
+
+    This is what ``unittest.mock.AsyncMock`` does, which needs python 3.8.
+    """
+    mock = Mock(**kwargs)
+
+    async def coroutine_function(*args, **kw):
+        return mock(*args, **kw)
+
+    coroutine_function.mock = mock
+    return coroutine_function
+
+
+@patch('buildstockbatch.eagle.run_process', new_callable=async_mock)
+def test_hpc_run_building(run_process, monkeypatch, basic_residential_project_file):
+    mock_run_process = run_process.mock
 
     tar_filename = pathlib.Path(__file__).resolve().parent / 'test_results' / 'simulation_output' / 'simulations_job0.tar.gz'  # noqa E501
     with tarfile.open(tar_filename, 'r') as tarf:
@@ -57,29 +76,25 @@ def test_hpc_run_building(mock_subprocess, monkeypatch, basic_residential_projec
             '/tmp/scratch/openstudio.simg',
             'bash', '-x'
         ]
-        mock_subprocess.run.assert_called_once()
-        assert(mock_subprocess.run.call_args[0][0] == expected_singularity_args)
-        called_kw = mock_subprocess.run.call_args[1]
-        assert(called_kw.get('check') is True)
+        mock_run_process.assert_called_once()
+        assert(mock_run_process.call_args[0][0] == expected_singularity_args)
+        called_kw = mock_run_process.call_args[1]
         assert('input' in called_kw)
         assert('stdout' in called_kw)
-        assert('stderr' in called_kw)
         assert(str(called_kw.get('cwd')) == '/tmp/scratch/output')
         assert(called_kw['input'].decode('utf-8').find(' --measures_only') == -1)
 
         # Measures only run
-        mock_subprocess.reset_mock()
+        mock_run_process.reset_mock()
         shutil.rmtree(sim_path)
         os.makedirs(sim_path)
         monkeypatch.setenv('MEASURESONLY', '1')
         EagleBatch.run_building(*run_bldg_args)
-        mock_subprocess.run.assert_called_once()
-        assert(mock_subprocess.run.call_args[0][0] == expected_singularity_args)
-        called_kw = mock_subprocess.run.call_args[1]
-        assert(called_kw.get('check') is True)
+        mock_run_process.assert_called_once()
+        assert(mock_run_process.call_args[0][0] == expected_singularity_args)
+        called_kw = mock_run_process.call_args[1]
         assert('input' in called_kw)
         assert('stdout' in called_kw)
-        assert('stderr' in called_kw)
         assert(str(called_kw.get('cwd')) == '/tmp/scratch/output')
         assert(called_kw['input'].decode('utf-8').find(' --measures_only') > -1)
 
@@ -157,6 +172,75 @@ def test_user_cli(mock_subprocess, mock_validate_options, basic_residential_proj
     assert '0' == mock_subprocess.run.call_args[1]['env']['MEASURESONLY']
 
 
+@patch('buildstockbatch.base.BuildStockBatchBase.validate_options_lookup')
+@patch('buildstockbatch.eagle.subprocess')
+def test_user_cli_pilot(mock_subprocess, mock_validate_options, basic_residential_project_file, monkeypatch):
+    mock_validate_options.return_value = True
+
+    project_filename, results_dir = basic_residential_project_file()
+    shutil.rmtree(results_dir)
+    monkeypatch.setenv('CONDA_PREFIX', 'something')
+    user_cli(['--pilot', '72', project_filename])
+    mock_subprocess.run.assert_called_once()
+    assert '--time=260' in mock_subprocess.run.call_args[0][0]
+    assert '--export=PROJECTFILE,MY_CONDA_ENV,MEASURESONLY,SAMPLINGONLY,PILOT' in mock_subprocess.run.call_args[0][0]
+    assert '--output=pilot.out' in mock_subprocess.run.call_args[0][0]
+    assert '72' == mock_subprocess.run.call_args[1]['env']['PILOT']
+
+
+def test_run_pilot(mocker, basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file({
+        'sampler': {
+            'type': 'precomputed',
+            'args': {
+                'sample_file': os.path.join(here, 'buildstock.csv')
+            }
+        },
+        'eagle': {
+            'account': 'testaccount',
+            'batching': {
+                'runtime_model_features': ['Geometry Foundation Type']
+            }
+        }
+    })
+    mocker.patch.object(EagleBatch, 'weather_dir', None)
+    mocker.patch.object(EagleBatch, 'singularity_image', '/path/to/singularity.simg')
+
+    def run_pilot_sims(sims, n_datapoints):
+        return [{
+            'building_id': bldg_id,
+            'upgrade': 0 if upgrade_idx is None else upgrade_idx + 1,
+            'completed_status': 'Success',
+            'runtime_s': 600 if upgrade_idx is None else 900,
+            'peak_memory_mb': 1000 + bldg_id,
+        } for bldg_id, upgrade_idx in sims]
+
+    run_pilot_sims_mock = mocker.patch.object(EagleBatch, 'run_pilot_sims', side_effect=run_pilot_sims)
+    batch = EagleBatch(project_filename)
+    batch.run_pilot(6)
+    sims, n_datapoints = run_pilot_sims_mock.call_args[0]
+    assert len(sims) == 6
+    assert n_datapoints == 10
+    assert set(upgrade_idx for _, upgrade_idx in sims) == {None, 0}
+
+    assert batch.calibration_filename == os.path.splitext(project_filename)[0] + '_calibration.json'
+    runtime_model = batch.get_runtime_model()
+    assert runtime_model.features == ['Geometry Foundation Type']
+    assert runtime_model.predict(0) == 600
+    assert runtime_model.predict(1) == 900
+    assert runtime_model.peak_memory_mb == max(1000 + bldg_id for bldg_id, _ in sims)
+
+
+def test_run_pilot_sims(mocker):
+    # The pilot runs as many simulations at once as the job batches
+    mocker.patch('buildstockbatch.eagle.cpu_count', return_value=72)
+    pool_mock = mocker.patch('buildstockbatch.eagle.multiprocessing.Pool')
+    pool_mock.return_value.__enter__.return_value.starmap.return_value = []
+    assert EagleBatch.run_pilot_sims(mocker.MagicMock(), [(1, None), (2, 0)], 10) == []
+    assert pool_mock.call_args[0][0] == 72
+    assert pool_mock.return_value.__enter__.return_value.starmap.call_args[0][1] == [(1, None), (2, 0)]
+
+
 @patch('buildstockbatch.eagle.subprocess')
 def test_qos_high_job_submit(mock_subprocess, basic_residential_project_file, monkeypatch):
     mock_subprocess.run.return_value.stdout = 'Submitted batch job 1\n'
@@ -189,6 +273,40 @@ def test_qos_high_job_submit(mock_subprocess, basic_residential_project_file, mo
         assert '--qos=high' in mock_subprocess.run.call_args[0][0]
 
 
+@patch('buildstockbatch.eagle.subprocess')
+def test_queue_jobs_predicted_walltime(mock_subprocess, basic_residential_project_file, monkeypatch):
+    mock_subprocess.run.return_value.stdout = 'Submitted batch job 1\n'
+    mock_subprocess.PIPE = None
+    project_filename, results_dir = basic_residential_project_file()
+    shutil.rmtree(results_dir)
+    monkeypatch.setenv('CONDA_PREFIX', 'something')
+
+    with patch.object(EagleBatch, 'weather_dir', None), \
+            patch.object(EagleBatch, 'singularity_image', '/path/to/singularity.simg'):
+        batch = EagleBatch(project_filename)
+        for i, predicted_runtime in enumerate([3600, 4000, 3800], 1):
+            with open(os.path.join(results_dir, 'job{:03d}.json'.format(i)), 'w') as f:
+                json.dump({'batch': list(range(100)), 'predicted_runtime_s': predicted_runtime}, f)
+        batch.queue_jobs()
+        mock_subprocess.run.assert_called_once()
+        assert '--time=100' in mock_subprocess.run.call_args[0][0]
+        assert '--array=1-3' in mock_subprocess.run.call_args[0][0]
+
+        mock_subprocess.reset_mock()
+        batch.queue_jobs(array_ids=[1, 3])
+        assert '--time=95' in mock_subprocess.run.call_args[0][0]
+        assert '--array=1,3' in mock_subprocess.run.call_args[0][0]
+
+        # The jobs need the wall time to know when to stop claiming simulations from the work queue
+        with open(os.path.join(results_dir, 'job001.json'), 'w') as f:
+            json.dump({'batch': list(range(100)), 'predicted_runtime_s': 3600, 'work_queue': True}, f)
+        mock_subprocess.reset_mock()
+        batch.queue_jobs()
+        assert '--export=PROJECTFILE,MY_CONDA_ENV,MEASURESONLY,JOB_WALLTIME_MINUTES' in \
+            mock_subprocess.run.call_args[0][0]
+        assert mock_subprocess.run.call_args[1]['env']['JOB_WALLTIME_MINUTES'] == '100'
+
+
 def test_run_building_process(mocker,  basic_residential_project_file):
     project_filename, results_dir = basic_residential_project_file(raw=True)
     results_dir = pathlib.Path(results_dir)
@@ -201,13 +319,8 @@ def test_run_building_process(mocker,  basic_residential_project_file):
     with open(results_dir / 'job001.json', 'w') as f:
         json.dump(job_json, f)
 
-    def sequential_parallel(**kwargs):
-        kw2 = kwargs.copy()
-        kw2['n_jobs'] = 1
-        return joblib.Parallel(**kw2)
-
     mocker.patch('buildstockbatch.eagle.shutil.copy2')
-    mocker.patch('buildstockbatch.eagle.Parallel', sequential_parallel)
+    mocker.patch('buildstockbatch.eagle.run_process', async_mock(return_value=0))
     mocker.patch('buildstockbatch.eagle.subprocess')
 
     mocker.patch.object(EagleBatch, 'weather_dir', None)
@@ -270,22 +383,16 @@ def test_run_building_error_caught(mocker, basic_residential_project_file):
     with open(results_dir / 'job001.json', 'w') as f:
         json.dump(job_json, f)
 
-    def raise_error(*args, **kwargs):
+    async def raise_error(*args, **kwargs):
         raise RuntimeError('A problem happened')
 
-    def sequential_parallel(**kwargs):
-        kw2 = kwargs.copy()
-        kw2['n_jobs'] = 1
-        return joblib.Parallel(**kw2)
-
     mocker.patch('buildstockbatch.eagle.shutil.copy2')
-    mocker.patch('buildstockbatch.eagle.Parallel', sequential_parallel)
     mocker.patch('buildstockbatch.eagle.subprocess')
 
     mocker.patch.object(EagleBatch, 'weather_dir', None)
     mocker.patch.object(EagleBatch, 'singularity_image', '/path/to/singularity.simg')
     mocker.patch.object(EagleBatch, 'clear_and_copy_dir')
-    mocker.patch.object(EagleBatch, 'run_building', raise_error)
+    mocker.patch.object(EagleBatch, 'run_building_async', raise_error)
     mocker.patch.object(EagleBatch, 'local_output_dir', results_dir)
     mocker.patch.object(EagleBatch, 'results_dir', results_dir)
 
@@ -297,3 +404,216 @@ def test_run_building_error_caught(mocker, basic_residential_project_file):
 
     with open(traceback_file, 'r') as f:
         assert f.read().find('RuntimeError') > -1
+
+
+def test_run_job_batch_work_queue(mocker, basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file()
+    results_dir = pathlib.Path(results_dir)
+
+    for job_num in (1, 2):
+        with open(results_dir / 'job{:03d}.json'.format(job_num), 'w') as f:
+            json.dump({'job_num': job_num, 'batch': [], 'n_datapoints': 4, 'work_queue': True}, f)
+    queue = WorkQueue(results_dir / 'work_queue')
+    queue.put(1, [(1, None), (2, None), (3, None)], 2)
+    queue.put(2, [(4, None), (1, 0), (2, 0)], 2)
+
+    async def run_building(output_dir, cfg, n_datapoints, i, upgrade_idx=None, postprocess=True, timeout=None):
+        return {'building_id': i, 'upgrade': 0 if upgrade_idx is None else upgrade_idx + 1}
+
+    mocker.patch('buildstockbatch.eagle.shutil.copy2')
+    mocker.patch('buildstockbatch.eagle.subprocess')
+
+    mocker.patch.object(EagleBatch, 'weather_dir', None)
+    mocker.patch.object(EagleBatch, 'singularity_image', '/path/to/singularity.simg')
+    mocker.patch.object(EagleBatch, 'stage_to_local_scratch')
+    mocker.patch.object(EagleBatch, 'run_building_async', run_building)
+    mocker.patch.object(EagleBatch, 'local_output_dir', results_dir)
+    mocker.patch.object(EagleBatch, 'results_dir', results_dir)
+    (results_dir / 'simulation_output').mkdir(exist_ok=True)
+
+    # Job 1 runs its own simulations and then takes over job 2's from the end
+    b = EagleBatch(project_filename)
+    b.run_job_batch(1)
+    with gzip.open(results_dir / 'simulation_output' / 'results_job1.json.gz', 'r') as f:
+        dpouts = json.load(f)
+    assert [(x['building_id'], x['upgrade']) for x in dpouts] == [(1, 0), (2, 0), (3, 0), (2, 1), (4, 0), (1, 1)]
+    assert len(os.listdir(queue.done_dir)) == 4
+    assert os.listdir(queue.claimed_dir) == []
+
+    # Nothing left for job 2
+    b.run_job_batch(2)
+    with gzip.open(results_dir / 'simulation_output' / 'results_job2.json.gz', 'r') as f:
+        assert json.load(f) == []
+
+
+def test_run_building_timeout(mocker, tmp_path):
+    sim_dir = tmp_path / 'up00' / 'bldg0000001'
+    sim_dir.mkdir(parents=True)
+    mocker.patch.object(EagleBatch, 'make_sim_dir', return_value=('bldg0000001up00', str(sim_dir)))
+    mocker.patch.object(EagleBatch, 'create_osw', return_value={})
+    cleanup_sim_dir = mocker.patch.object(EagleBatch, 'cleanup_sim_dir')
+    run_process = mocker.patch('buildstockbatch.eagle.run_process', async_mock(side_effect=asyncio.TimeoutError))
+
+    dpout = asyncio.run(EagleBatch.run_building_async(str(tmp_path), {}, 1, 1, timeout=60))
+    assert run_process.mock.call_args[1]['timeout'] == 60
+    # The outputs of a killed simulation aren't cleaned up
+    cleanup_sim_dir.assert_not_called()
+    assert dpout == {'building_id': 1, 'upgrade': 0, 'completed_status': 'Timeout'}
+
+
+def test_stage_to_local_scratch(mocker, tmp_path):
+    local_scratch = tmp_path / 'scratch'
+    mocker.patch.object(EagleBatch, 'local_scratch', local_scratch)
+    src_dir = tmp_path / 'measures'
+    (src_dir / 'measure1').mkdir(parents=True)
+    with open(src_dir / 'measure1' / 'measure.rb', 'w') as f:
+        f.write('# measure')
+    src_file = tmp_path / 'openstudio.simg'
+    with open(src_file, 'wb') as f:
+        f.write(b'image')
+    items = [(src_dir, local_scratch / 'measures'), (src_file, local_scratch / 'openstudio.simg')]
+
+    clear_and_copy_dir = mocker.spy(EagleBatch, 'clear_and_copy_dir')
+    copy2 = mocker.spy(shutil, 'copy2')
+    with EagleBatch.stage_to_local_scratch(items):
+        assert (local_scratch / 'measures' / 'measure1' / 'measure.rb').exists()
+        assert (local_scratch / 'openstudio.simg').exists()
+    assert clear_and_copy_dir.call_count == 1
+    assert copy2.call_count == 1
+
+    # A later job with the same inputs doesn't copy anything
+    clear_and_copy_dir.reset_mock()
+    copy2.reset_mock()
+    with EagleBatch.stage_to_local_scratch(items):
+        pass
+    clear_and_copy_dir.assert_not_called()
+    copy2.assert_not_called()
+
+    # Only what changed is copied again
+    with open(src_dir / 'measure1' / 'measure.rb', 'a') as f:
+        f.write('\n# changed')
+    with EagleBatch.stage_to_local_scratch(items):
+        with open(local_scratch / 'measures' / 'measure1' / 'measure.rb', 'r') as f:
+            assert f.read().endswith('# changed')
+    assert clear_and_copy_dir.call_count == 1
+    copy2.assert_not_called()
+
+    # While a job runs, another job can add inputs, but waits for it to finish to replace them
+    src_file2 = tmp_path / 'weather.epw'
+    src_file2.write_text('weather')
+    items2 = items + [(src_file2, local_scratch / 'weather.epw')]
+
+    def run_job(job_items):
+        with EagleBatch.stage_to_local_scratch(job_items):
+            pass
+
+    with EagleBatch.stage_to_local_scratch(items):
+        adding_job = threading.Thread(target=run_job, args=(items2,))
+        adding_job.start()
+        adding_job.join(timeout=10)
+        assert not adding_job.is_alive()
+        assert (local_scratch / 'weather.epw').exists()
+
+        src_file.write_bytes(b'image2')
+        replacing_job = threading.Thread(target=run_job, args=(items,))
+        replacing_job.start()
+        time.sleep(0.5)
+        assert (local_scratch / 'openstudio.simg').read_bytes() == b'image'
+    replacing_job.join(timeout=10)
+    assert not replacing_job.is_alive()
+    assert (local_scratch / 'openstudio.simg').read_bytes() == b'image2'
+
+    # The manifest is written before and after copying, not for every item
+    weather_dir = tmp_path / 'weather'
+    weather_dir.mkdir()
+    weather_items = []
+    for i in range(10):
+        (weather_dir / f'{i}.epw').write_text('weather')
+        weather_items.append((weather_dir / f'{i}.epw', local_scratch / 'weather' / f'{i}.epw'))
+    json_dump = mocker.spy(json, 'dump')
+    with EagleBatch.stage_to_local_scratch(weather_items):
+        assert all(dst.exists() for _, dst in weather_items)
+    assert json_dump.call_count == 2
+    with open(local_scratch / 'staged.json', 'r') as f:
+        assert set(json.load(f)) >= {str(dst) for _, dst in weather_items}
+
+
+@patch('buildstockbatch.base.BuildStockBatchBase.validate_options_lookup')
+@patch('buildstockbatch.eagle.subprocess')
+def test_user_cli_rerun_missing(mock_subprocess, mock_validate_options, mocker, basic_residential_project_file,
+                                monkeypatch):
+    mock_validate_options.return_value = True
+    mock_subprocess.run.return_value.stdout = 'Submitted batch job 1\n'
+    mock_subprocess.PIPE = None
+    project_filename, results_dir = basic_residential_project_file({
+        'eagle': {'n_jobs': 2, 'account': 'testaccount'}
+    })
+    results_dir = pathlib.Path(results_dir)
+    monkeypatch.setenv('CONDA_PREFIX', 'something')
+    mocker.patch.object(EagleBatch, 'weather_dir', None)
+    mocker.patch.object(EagleBatch, 'results_dir', results_dir)
+    mocker.patch.object(EagleBatch, 'get_epws_by_building', return_value={})
+
+    shutil.copy2(os.path.join(here, 'buildstock.csv'), results_dir / 'housing_characteristics' / 'buildstock.csv')
+    for job_num in (1, 2):
+        (results_dir / 'job{:03d}.json'.format(job_num)).touch()
+    sim_out_dir = results_dir / 'simulation_output'
+    with gzip.open(sim_out_dir / 'results_job0.json.gz', 'rt', encoding='utf-8') as f:
+        dpouts = json.load(f)
+    for dpout in dpouts:
+        dpout['completed_status'] = 'Fail' if (dpout['building_id'], dpout['upgrade']) == (2, 1) else 'Success'
+    with gzip.open(sim_out_dir / 'results_job0.json.gz', 'wt', encoding='utf-8') as f:
+        json.dump(dpouts, f)
+
+    assert user_cli(['--rerun-missing', '--hipri', project_filename])
+    with open(results_dir / 'job003.json', 'r') as f:
+        job_json = json.load(f)
+    assert job_json['job_num'] == 3
+    expected_sims = [[2, 0]] + [[bldg_id, upgrade_idx] for bldg_id in range(5, 11) for upgrade_idx in (None, 0)]
+    assert sorted(job_json['batch'], key=str) == sorted(expected_sims, key=str)
+    assert not (results_dir / 'job004.json').exists()
+
+    # The simulations and then the postprocessing are queued
+    assert mock_subprocess.run.call_count == 2
+    assert '--array=3' in mock_subprocess.run.call_args_list[0][0][0]
+    assert '--qos=high' in mock_subprocess.run.call_args_list[0][0][0]
+    assert '--dependency=afterany:1' in mock_subprocess.run.call_args_list[1][0][0]
+
+    # It won't rerun simulations that were already postprocessed
+    (results_dir / 'parquet').mkdir()
+    with pytest.raises(FileExistsError):
+        user_cli(['--rerun-missing', project_filename])
+
+
+def test_run_job_batch_work_queue_short_walltime(mocker, basic_residential_project_file, monkeypatch):
+    project_filename, results_dir = basic_residential_project_file()
+    results_dir = pathlib.Path(results_dir)
+
+    with open(results_dir / 'job001.json', 'w') as f:
+        json.dump({'job_num': 1, 'batch': [], 'n_datapoints': 4, 'work_queue': True}, f)
+    queue = WorkQueue(results_dir / 'work_queue')
+    queue.put(1, [(1, None), (2, None), (3, None)], 2)
+
+    async def run_building(output_dir, cfg, n_datapoints, i, upgrade_idx=None, postprocess=True, timeout=None):
+        return {'building_id': i, 'upgrade': 0 if upgrade_idx is None else upgrade_idx + 1}
+
+    mocker.patch('buildstockbatch.eagle.shutil.copy2')
+    mocker.patch('buildstockbatch.eagle.subprocess')
+    mocker.patch.object(EagleBatch, 'weather_dir', None)
+    mocker.patch.object(EagleBatch, 'singularity_image', '/path/to/singularity.simg')
+    mocker.patch.object(EagleBatch, 'stage_to_local_scratch')
+    mocker.patch.object(EagleBatch, 'run_building_async', run_building)
+    mocker.patch.object(EagleBatch, 'local_output_dir', results_dir)
+    mocker.patch.object(EagleBatch, 'results_dir', results_dir)
+    (results_dir / 'simulation_output').mkdir(exist_ok=True)
+
+    # The shortest wall time queue_jobs asks for still leaves most of it for claiming simulations
+    monkeypatch.setenv('JOB_WALLTIME_MINUTES', '6')
+    b = EagleBatch(project_filename)
+    assert b.get_work_queue_deadline(6, start=0) == 4.5 * 60
+    assert b.get_work_queue_deadline(600, start=0) == (600 - 16) * 60
+    b.run_job_batch(1)
+    with gzip.open(results_dir / 'simulation_output' / 'results_job1.json.gz', 'r') as f:
+        assert len(json.load(f)) == 3
+    assert os.listdir(queue.pending_dir) == []
+    assert len(os.listdir(queue.done_dir)) == 2
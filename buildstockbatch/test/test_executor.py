@@ -0,0 +1,64 @@
+import asyncio
+import concurrent.futures
+import pytest
+import sys
+import time
+
+from buildstockbatch.executor import run_process, SimulationExecutor
+
+
+def test_run_process(tmp_path):
+    with open(tmp_path / 'out.log', 'w') as f_out:
+        returncode = asyncio.run(run_process(
+            [sys.executable, '-c', 'import sys; print(sys.stdin.read()); sys.exit(3)'],
+            stdout=f_out,
+            input=b'hello',
+            cwd=tmp_path
+        ))
+    assert returncode == 3
+    assert (tmp_path / 'out.log').read_text().strip() == 'hello'
+
+    tick = time.time()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run_process([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5))
+    assert time.time() - tick < 10
+
+
+def test_simulation_executor():
+    running = []
+    peak = []
+
+    async def sim(x):
+        running.append(x)
+        peak.append(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(x)
+        return x * 2
+
+    with SimulationExecutor(max_workers=2) as executor:
+        futures = [executor.submit(sim, x) for x in range(6)]
+        futures.append(executor.submit(lambda x: x + 1, 1))
+        assert [f.result() for f in futures] == [0, 2, 4, 6, 8, 10, 2]
+    assert max(peak) == 2
+
+    with pytest.raises(RuntimeError):
+        executor.submit(sim, 1)
+
+
+def test_simulation_executor_timeout_and_cancel():
+    sleep_args = [sys.executable, '-c', 'import time; time.sleep(30)']
+    tick = time.time()
+    with SimulationExecutor(timeout=0.5) as executor:
+        timed_out = executor.submit(run_process, sleep_args)
+        finished = executor.submit(run_process, [sys.executable, '-c', 'pass'])
+        assert finished.result() == 0
+        with pytest.raises(asyncio.TimeoutError):
+            timed_out.result()
+
+    with SimulationExecutor() as executor:
+        cancelled = executor.submit(run_process, sleep_args)
+        time.sleep(0.2)
+        assert cancelled.cancel()
+        with pytest.raises(concurrent.futures.CancelledError):
+            cancelled.result()
+    assert time.time() - tick < 10
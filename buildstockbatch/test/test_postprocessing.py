@@ -1,15 +1,21 @@
 from fsspec.implementations.local import LocalFileSystem
 import gzip
+import itertools
 import json
+import numpy as np
 import pandas as pd
 import pathlib
+import pyarrow as pa
+from pyarrow import parquet
 import re
 import tarfile
 import pytest
 import shutil
+import sqlite3
 
 from buildstockbatch import postprocessing
 from buildstockbatch.base import BuildStockBatchBase
+from buildstockbatch.results import BuildStockResults
 from buildstockbatch.utils import get_project_configuration
 from unittest.mock import patch
 
@@ -91,3 +97,465 @@ def test_large_parquet_combine(basic_residential_project_file):
             patch.object(postprocessing, 'MAX_PARQUET_MEMORY', 1e6):  # set the max memory to just 1MB
         bsb = BuildStockBatchBase(project_filename)
         bsb.process_results()  # this would raise exception if the postprocessing could not handle the situation
+
+
+def test_write_results_sqlite(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file({
+        'postprocessing': {
+            'sqlite': {
+                'timeseries': True,
+                'index_characteristics': ['County', 'Vintage']
+            }
+        }
+    })
+
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    db_filename = pathlib.Path(results_dir) / 'results.sqlite'
+    assert db_filename.exists()
+    with sqlite3.connect(str(db_filename)) as conn:
+        for upgrade_id in (0, 1):
+            df = pd.read_sql(f'SELECT * FROM results_up{upgrade_id:02d}', conn)
+            pq_df = pd.read_parquet(
+                pathlib.Path(results_dir) / 'parquet' /
+                ('baseline' if upgrade_id == 0 else f'upgrades/upgrade={upgrade_id}') /
+                f'results_up{upgrade_id:02d}.parquet'
+            )
+            assert sorted(df['building_id']) == sorted(pq_df['building_id'])
+            assert (df['upgrade'] == upgrade_id).all()
+        indexes = set(x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type='index'"))
+        assert 'idx_results_up00_building_id' in indexes
+        assert 'idx_results_up00_build_existing_model_county' in indexes
+        assert 'idx_results_up00_build_existing_model_vintage' in indexes
+        assert 'idx_timeseries_upgrade_Time' in indexes
+
+        ts_df = pd.read_sql('SELECT * FROM timeseries WHERE upgrade = 0', conn)
+        pq_ts_df = pd.read_parquet(pathlib.Path(results_dir) / 'parquet' / 'timeseries' / 'upgrade=0')
+        assert len(ts_df) == pq_ts_df['Time'].nunique()
+
+    # The timeseries are weighted by the sample weights of the buildings
+    baseline_filename = pathlib.Path(results_dir) / 'parquet' / 'baseline' / 'results_up00.parquet'
+    bs_df = pd.read_parquet(baseline_filename)
+    sample_weights = bs_df.set_index('building_id')['build_existing_model.sample_weight']
+    pq_ts_df = pq_ts_df.reset_index()
+    weighted = pq_ts_df['total_site_energy_mbtu'] * pq_ts_df['building_id'].astype(int).map(sample_weights)
+    assert ts_df['total_site_energy_mbtu'].sum() == pytest.approx(weighted.sum())
+
+    bs_df['build_existing_model.sample_weight'] = bs_df['building_id'] * 10.0
+    bs_df.to_parquet(baseline_filename, index=False)
+    postprocessing.write_results_sqlite(results_dir, bsb.cfg)
+    with sqlite3.connect(str(db_filename)) as conn:
+        ts_df = pd.read_sql('SELECT * FROM timeseries WHERE upgrade = 0', conn)
+    weighted = pq_ts_df['total_site_energy_mbtu'] * pq_ts_df['building_id'].astype(int) * 10.0
+    assert ts_df['total_site_energy_mbtu'].sum() == pytest.approx(weighted.sum())
+
+
+def test_sample_dataset(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file({
+        'postprocessing': {
+            'sample': {
+                'fraction': 0.01,
+                'stratify_by': ['County']
+            }
+        }
+    })
+
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    # Every county is its own stratum in the test results so every building is in the sample
+    sample_dir = pathlib.Path(results_dir) / 'parquet' / 'sample'
+    bs_df = pd.read_parquet(sample_dir / 'baseline' / 'results_up00.parquet')
+    assert sorted(bs_df['building_id']) == [1, 2, 3, 4]
+    assert bs_df['sample_weight'].sum() == pytest.approx(80000000)
+    up_df = pd.read_parquet(sample_dir / 'upgrades' / 'upgrade=1' / 'results_up01.parquet')
+    assert sorted(up_df['building_id']) == [1, 2, 3, 4]
+    ts_df = pd.read_parquet(sample_dir / 'timeseries' / 'upgrade=1')
+    assert set(ts_df.index) == {1, 2, 3, 4}
+    assert (ts_df['sample_weight'] == 20000000).all()
+
+    cfg = get_project_configuration(project_filename)
+    results_df = pd.read_parquet(pathlib.Path(results_dir) / 'parquet' / 'baseline' / 'results_up00.parquet')
+    results_df['upgrade'] = 0
+    cfg['postprocessing']['sample'] = {'fraction': 0.5, 'stratify_by': [], 'seed': 1}
+    weights = postprocessing.select_sample_buildings(results_df, cfg)
+    assert len(weights) == 2
+    assert weights.sum() == pytest.approx(80000000)
+    pd.testing.assert_series_equal(weights, postprocessing.select_sample_buildings(results_df, cfg))
+
+
+def test_timeseries_column_families(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file({
+        'postprocessing': {
+            'timeseries_column_families': True
+        }
+    })
+
+    cfg = get_project_configuration(project_filename)
+    families = postprocessing.get_timeseries_column_families(cfg, [
+        'building_id', 'Time', 'TimeDST', 'total_site_electricity_kwh', 'electricity_heating_kwh',
+        'electricity_central_system_heating_kwh', 'schedules_occupants', 'Zone Mean Air Temperature [C]'
+    ])
+    assert families == {
+        'core': ['total_site_electricity_kwh', 'electricity_heating_kwh'],
+        'schedules': ['schedules_occupants'],
+        'output_variables': ['Zone Mean Air Temperature [C]'],
+        'subcategories': ['electricity_central_system_heating_kwh'],
+    }
+
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    parquet_dir = pathlib.Path(results_dir) / 'parquet'
+    assert not (parquet_dir / 'timeseries').exists()
+    core_df = pd.read_parquet(parquet_dir / 'timeseries_core' / 'upgrade=0')
+    subcat_df = pd.read_parquet(parquet_dir / 'timeseries_subcategories' / 'upgrade=0')
+    assert 'total_site_energy_mbtu' in core_df.columns
+    assert 'electricity_central_system_heating_kwh' not in core_df.columns
+    assert 'electricity_central_system_heating_kwh' in subcat_df.columns
+    for df in (core_df, subcat_df):
+        assert {'Time', 'TimeDST', 'TimeUTC'}.issubset(df.columns)
+
+    # Read them back together
+    reference_df = pd.read_parquet(
+        pathlib.Path(__file__).resolve().parent / 'test_results' / 'parquet' / 'timeseries' / 'upgrade=0'
+    )
+    res = BuildStockResults(results_dir)
+    assert res.timeseries_column_families == ['core', 'subcategories']
+    cols = ['Time', 'total_site_energy_mbtu', 'electricity_central_system_heating_kwh']
+    df = res.timeseries(upgrade=0, building_ids=[1, 2], columns=cols)
+    ref_df = reference_df.loc[reference_df.index.isin([1, 2]), cols]
+    pd.testing.assert_frame_equal(
+        df.sort_values(['building_id', 'Time'])[cols],
+        ref_df.sort_values(['building_id', 'Time'])
+    )
+    df = pd.concat(res.iter_timeseries(upgrade=0, batch_size=5000))
+    assert len(df) == len(reference_df)
+    assert set(df.columns) == set(reference_df.columns)
+
+
+def test_deduplicate_timestamps(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file({
+        'postprocessing': {
+            'deduplicate_timestamps': True
+        }
+    })
+
+    # Deduplicate the timestamps in the simulation output the way cleanup_sim_dir would
+    fs = LocalFileSystem()
+    ts_dir = pathlib.Path(results_dir) / 'simulation_output' / 'timeseries'
+    ts_filenames = sorted(ts_dir.glob('up*/*.parquet'))
+    for filename in ts_filenames:
+        tbl = parquet.read_table(filename)
+        tbl = postprocessing.dedupe_timeseries_timestamps(
+            tbl, ['Time', 'TimeDST', 'TimeUTC'], fs, str(ts_dir / 'time_axes')
+        )
+        postprocessing.write_table_as_parquet(tbl, fs, str(filename))
+    assert 0 < len(list((ts_dir / 'time_axes').glob('*.parquet'))) < len(ts_filenames)
+
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    parquet_dir = pathlib.Path(results_dir) / 'parquet'
+    time_axes_df = pd.read_parquet(parquet_dir / 'time_axes')
+    assert time_axes_df.columns.tolist() == ['time_axis', 'timestep', 'Time', 'TimeDST', 'TimeUTC']
+    ts_df = pd.read_parquet(parquet_dir / 'timeseries' / 'upgrade=1')
+    assert 'Time' not in ts_df.columns
+    assert {'time_axis', 'timestep'}.issubset(ts_df.columns)
+
+    # The time columns are put back when reading them
+    reference_df = pd.read_parquet(
+        pathlib.Path(__file__).resolve().parent / 'test_results' / 'parquet' / 'timeseries' / 'upgrade=1'
+    )
+    res = BuildStockResults(results_dir)
+    cols = ['Time', 'TimeUTC', 'total_site_energy_mbtu']
+    df = res.timeseries(upgrade=1, building_ids=[1, 3], start='2007-02-01', end='2007-03-01', columns=cols)
+    ref_df = reference_df.loc[reference_df.index.isin([1, 3]), cols]
+    ref_df = ref_df.loc[(ref_df['Time'] >= '2007-02-01') & (ref_df['Time'] < '2007-03-01')]
+    assert df.columns.tolist() == cols
+    pd.testing.assert_frame_equal(
+        df.sort_values(['building_id', 'Time']),
+        ref_df.sort_values(['building_id', 'Time'])
+    )
+    df = pd.concat(res.iter_timeseries(upgrade=1, batch_size=5000))
+    assert len(df) == len(reference_df)
+    assert set(reference_df.columns).issubset(df.columns)
+
+
+def test_deduplicated_schedules(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file()
+
+    # Run cleanup_sim_dir on simulations made from the existing timeseries, buildings 2, 3 and 4
+    # share a schedule and building 1 has a different one
+    fs = LocalFileSystem()
+    ts_dir = pathlib.Path(results_dir) / 'simulation_output' / 'timeseries'
+    for bldg_id in range(1, 5):
+        tsdf = pd.read_parquet(ts_dir / 'up00' / f'bldg{bldg_id:07d}.parquet')
+        sim_dir = pathlib.Path(results_dir) / f'bldg{bldg_id:07d}up00'
+        (sim_dir / 'run').mkdir(parents=True)
+        (sim_dir / 'generated_files').mkdir()
+        tsdf.to_csv(sim_dir / 'run' / 'enduse_timeseries.csv', index=False)
+        schedules = pd.DataFrame({
+            'occupants': np.linspace(0, 1, len(tsdf)) * min(bldg_id, 2),
+            'lighting_interior': np.full(len(tsdf), 0.5),
+        })
+        schedules.to_csv(sim_dir / 'generated_files' / 'schedules.csv', index=False)
+        BuildStockBatchBase.cleanup_sim_dir(str(sim_dir), fs, str(ts_dir), 0, bldg_id)
+
+    assert len(list((ts_dir / 'schedules').glob('*.parquet'))) == 2
+    tsdf = pd.read_parquet(ts_dir / 'up00' / 'bldg0000001.parquet')
+    assert not any(col.startswith('schedules_') and col not in ('schedules_id', 'schedules_timestep')
+                   for col in tsdf.columns)
+    # Daylight saving time shifts the schedule an hour
+    assert (tsdf['schedules_timestep'] == np.arange(len(tsdf)) + (tsdf['Time'] != tsdf['TimeDST'])).all()
+
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    res = BuildStockResults(results_dir)
+    schedules_ids = res.schedules_ids(upgrade=0)
+    assert schedules_ids.index.tolist() == [1, 2, 3, 4]
+    assert schedules_ids.nunique() == 2
+    assert schedules_ids[2] == schedules_ids[3] == schedules_ids[4] != schedules_ids[1]
+    schedules_df = res.schedules(schedules_ids=[schedules_ids[1]], columns=['occupants'])
+    assert schedules_df.columns.tolist() == ['schedules_id', 'timestep', 'occupants']
+    assert schedules_df['occupants'].max() == pytest.approx(1)
+    assert len(res.schedules()) == 2 * len(schedules_df)
+    ts_df = res.timeseries(upgrade=0, building_ids=[1], columns=['TimeDST', 'schedules_id', 'schedules_timestep'])
+    assert (ts_df['schedules_id'] == schedules_ids[1]).all()
+    assert ts_df['schedules_timestep'].max() == len(schedules_df) - 1
+
+
+def test_schedules_daylight_saving_time(tmp_path):
+    # A day when daylight saving time starts, EnergyPlus reads the schedule at TimeDST
+    sim_dir = tmp_path / 'bldg0000001up00'
+    (sim_dir / 'run').mkdir(parents=True)
+    (sim_dir / 'generated_files').mkdir()
+    time = pd.date_range('2007-03-11 00:00', periods=24, freq='H')
+    time_dst = time.where(time < '2007-03-11 02:00', time + pd.Timedelta(hours=1))
+    tsdf = pd.DataFrame({'Time': time, 'TimeDST': time_dst, 'total_site_electricity_kwh': np.arange(24.0)})
+    tsdf.to_csv(sim_dir / 'run' / 'enduse_timeseries.csv', index=False, date_format='%Y/%m/%d %H:%M:%S')
+    schedules = pd.DataFrame({'occupants': np.arange(24) / 24})
+    schedules.to_csv(sim_dir / 'generated_files' / 'schedules.csv', index=False)
+    ts_dir = tmp_path / 'timeseries'
+    fs = LocalFileSystem()
+    for dedupe_timestamps in (False, True):
+        if ts_dir.exists():
+            shutil.rmtree(ts_dir)
+        (ts_dir / 'up00').mkdir(parents=True)
+        BuildStockBatchBase.cleanup_sim_dir(
+            str(sim_dir), fs, str(ts_dir), 0, 1, dedupe_timestamps=dedupe_timestamps
+        )
+        df = pd.read_parquet(ts_dir / 'up00' / 'bldg0000001.parquet')
+        schedules_df = postprocessing.read_deduplicated_tables(
+            fs, [str(x) for x in (ts_dir / 'schedules').glob('*.parquet')], 'schedules_id'
+        )
+        df = df.merge(
+            schedules_df.rename(columns={'timestep': 'schedules_timestep'}),
+            how='left', on=['schedules_id', 'schedules_timestep']
+        )
+        # what merging the schedules into the timeseries did
+        expected = schedules.rename(columns=lambda x: f'schedules_{x}')
+        expected['TimeDST'] = tsdf['Time']
+        expected = tsdf.merge(expected, how='left', on='TimeDST')
+        pd.testing.assert_series_equal(df['occupants'], expected['schedules_occupants'], check_names=False)
+        assert df['schedules_timestep'].iloc[2] == 3
+        assert df['occupants'].iloc[2] == pytest.approx(3 / 24)
+        assert pd.isna(df['occupants'].iloc[-1])
+
+
+def test_read_enduse_timeseries_csv(tmp_path):
+    filename = tmp_path / 'enduse_timeseries.csv'
+    with open(filename, 'w') as f:
+        f.write('Time,TimeDST,TimeUTC,total_site_electricity_kwh,fuel_use_natural_gas_total_m_btu\n')
+        f.write('2007/01/01 01:00:00,2007/01/01 01:00:00,2007/01/01 07:00:00,1.5,0\n')
+        f.write('2007/01/01 02:00:00,2007/01/01 02:00:00,2007/01/01 08:00:00,2,\n')
+    tbl, time_cols = postprocessing.read_enduse_timeseries_csv(str(filename))
+    assert time_cols == ['Time', 'TimeDST', 'TimeUTC']
+    reference_df = pd.read_csv(filename, parse_dates=time_cols)
+    reference_df['fuel_use_natural_gas_total_m_btu'] = reference_df['fuel_use_natural_gas_total_m_btu'].astype(float)
+    pd.testing.assert_frame_equal(tbl.to_pandas(), reference_df)
+
+    # Integer columns stay integers and time formats arrow doesn't know are parsed by pandas
+    with open(filename, 'w') as f:
+        f.write('Time,timestep,total_site_electricity_kwh\n')
+        f.write('1/1/2007 1:00,0,1.5\n')
+        f.write('1/1/2007 2:00,1,2\n')
+    tbl, time_cols = postprocessing.read_enduse_timeseries_csv(str(filename))
+    assert time_cols == ['Time']
+    df = tbl.to_pandas()
+    pd.testing.assert_frame_equal(df, pd.read_csv(filename, parse_dates=time_cols))
+    assert df['timestep'].dtype == 'int64'
+    assert df['Time'].iloc[1] == pd.Timestamp('2007-01-01 02:00')
+
+    # Columns without any values are float64 like pandas reads them, not arrow's null type
+    with open(filename, 'w') as f:
+        f.write('Time,total_site_electricity_kwh,fuel_use_propane_total_m_btu\n')
+        f.write('2007/01/01 01:00:00,1.5,\n')
+        f.write('2007/01/01 02:00:00,2,\n')
+    tbl, _ = postprocessing.read_enduse_timeseries_csv(str(filename))
+    assert tbl.schema.field('fuel_use_propane_total_m_btu').type == pa.float64()
+    pd.testing.assert_frame_equal(tbl.to_pandas(), pd.read_csv(filename, parse_dates=['Time']))
+
+    with open(filename, 'w') as f:
+        f.write('total_site_electricity_kwh\n1\n')
+    with pytest.raises(RuntimeError, match='Did not find any time column'):
+        postprocessing.read_enduse_timeseries_csv(str(filename))
+
+
+def test_extract_json_keys():
+    sims_dir = pathlib.Path(__file__).resolve().parent / 'test_results' / 'simulations_job0'
+    for filename in itertools.chain(sims_dir.glob('up*/*/out.osw'), sims_dir.glob('up*/*/run/data_point_out.json')):
+        with open(filename, 'r') as f:
+            s = f.read()
+        d = json.loads(s)
+        assert postprocessing.extract_json_keys(s, d.keys()) == d
+        some_keys = list(d.keys())[1::2]
+        assert postprocessing.extract_json_keys(s, some_keys + ['not_a_key']) == {k: d[k] for k in some_keys}
+
+    s = '{"skip": [1, {"a": "x\\"]}"}, -2.5e3, false], "b": {"c": null}, "d": "e"}'
+    assert postprocessing.extract_json_keys(s, ['b']) == {'b': {'c': None}}
+    assert postprocessing.extract_json_keys(s, ['d']) == {'d': 'e'}
+    assert postprocessing.extract_json_keys('{}', ['a']) == {}
+    for bad_json in ('', '[]', '{"a": 1', '{"a" 1}', '{"a": [1, 2}'):
+        with pytest.raises(json.JSONDecodeError):
+            postprocessing.extract_json_keys(bad_json, ['b'])
+
+    fs = LocalFileSystem()
+    out_osw = postprocessing.read_out_osw(fs, str(sims_dir / 'up00' / 'bldg0000001' / 'out.osw'))
+    assert out_osw['building_id'] == 1
+    assert set(out_osw.keys()) == {'started_at', 'completed_at', 'completed_status', 'building_id'}
+    out_osw_without_id = postprocessing.read_out_osw(
+        fs, str(sims_dir / 'up00' / 'bldg0000001' / 'out.osw'), read_building_id=False
+    )
+    del out_osw['building_id']
+    assert out_osw_without_id == out_osw
+
+
+def test_flatten_datapoint_jsons():
+    sims_dir = pathlib.Path(__file__).resolve().parent / 'test_results' / 'simulations_job0'
+    fs = LocalFileSystem()
+    reporting_measures = ['ReportingMeasure2']
+    nested_dpouts = []
+    flat_dpouts = []
+    for sim_dir in sorted(sims_dir.glob('up*/bldg*')):
+        upgrade_id = int(sim_dir.parent.name[2:])
+        building_id = int(sim_dir.name[4:])
+        nested_dpouts.append(postprocessing.read_simulation_outputs(
+            fs, reporting_measures, str(sim_dir), upgrade_id, building_id
+        ))
+        # how the simulations were flattened one at a time before
+        dpout = postprocessing.read_data_point_out_json(
+            fs, reporting_measures, str(sim_dir / 'run' / 'data_point_out.json')
+        )
+        flat_dpout = postprocessing.flatten_datapoint_json(reporting_measures, dpout) if dpout else {}
+        flat_dpout.update(postprocessing.read_out_osw(fs, str(sim_dir / 'out.osw'), read_building_id=False))
+        flat_dpout['building_id'] = building_id
+        flat_dpout['upgrade'] = upgrade_id
+        flat_dpouts.append(flat_dpout)
+    assert any(isinstance(x.get('SimulationOutputReport'), dict) for x in nested_dpouts)
+    # a simulation that failed before writing anything
+    nested_dpouts.append({'completed_status': 'Fail', 'upgrade': 1, 'building_id': 5})
+    flat_dpouts.append(dict(nested_dpouts[-1]))
+
+    expected_df = pd.DataFrame(flat_dpouts).rename(columns=postprocessing.to_camelcase)
+    for dpouts in (nested_dpouts, flat_dpouts):
+        df = postprocessing.flatten_datapoint_jsons(reporting_measures, dpouts)
+        assert sorted(df.columns) == sorted(expected_df.columns)
+        pd.testing.assert_frame_equal(df[expected_df.columns], expected_df, check_dtype=False)
+    df = postprocessing.flatten_datapoint_jsons(reporting_measures, nested_dpouts, camelcase=False)
+    assert 'BuildExistingModel.units_represented' in df.columns
+    assert 'BuildExistingModel.building_id' not in df.columns
+    assert df['building_id'].tolist() == [x['building_id'] for x in nested_dpouts]
+
+
+def test_results_columns(basic_residential_project_file):
+    columns_cfg = {
+        'include': ['build_existing_model.county', 'simulation_output_report.total_site_*'],
+        'exclude': ['*_natural_gas_*'],
+    }
+    keep_column = postprocessing.results_column_selector(columns_cfg)
+    assert keep_column('SimulationOutputReport.total_site_energy_mbtu')
+    assert keep_column('simulation_output_report.total_site_electricity_kwh')
+    assert not keep_column('simulation_output_report.total_site_natural_gas_therm')
+    assert not keep_column('simulation_output_report.electricity_heating_kwh')
+    assert keep_column('BuildExistingModel.units_represented')
+    assert keep_column('completed_status')
+    assert postprocessing.results_column_selector(None)('anything')
+
+    sim_dir = pathlib.Path(__file__).resolve().parent / 'test_results' / 'simulations_job0' / 'up00' / 'bldg0000001'
+    fs = LocalFileSystem()
+    dpout = postprocessing.read_simulation_outputs(fs, [], str(sim_dir), 0, 1)
+    dpout_selected = postprocessing.read_simulation_outputs(fs, [], str(sim_dir), 0, 1, columns=columns_cfg)
+    df = postprocessing.flatten_datapoint_jsons([], [dpout], camelcase=False)
+    df_selected = postprocessing.flatten_datapoint_jsons([], [dpout_selected], camelcase=False)
+    assert df_selected.columns.tolist() == [x for x in df.columns if keep_column(x)]
+    assert 'total_site_energy_mbtu' in dpout_selected['SimulationOutputReport']
+    assert 'total_site_natural_gas_therm' not in dpout_selected['SimulationOutputReport']
+
+    project_filename, results_dir = basic_residential_project_file({
+        'postprocessing': {
+            'columns': columns_cfg
+        }
+    })
+    with patch.object(BuildStockBatchBase, 'weather_dir', None), \
+            patch.object(BuildStockBatchBase, 'get_dask_client'), \
+            patch.object(BuildStockBatchBase, 'results_dir', results_dir):
+        bsb = BuildStockBatchBase(project_filename)
+        bsb.process_results()
+
+    df = pd.read_parquet(pathlib.Path(results_dir) / 'parquet' / 'baseline' / 'results_up00.parquet')
+    assert all(keep_column(x) for x in df.columns if x != 'apply_upgrade.reference_scenario')
+    assert 'build_existing_model.county' in df.columns
+    assert 'simulation_output_report.total_site_energy_mbtu' in df.columns
+    assert 'simulation_output_report.electricity_heating_kwh' not in df.columns
+
+
+def test_find_missing_simulations(basic_residential_project_file):
+    project_filename, results_dir = basic_residential_project_file()
+    fs = LocalFileSystem()
+    results_dir = pathlib.Path(results_dir)
+    sim_out_dir = results_dir / 'simulation_output'
+
+    with gzip.open(sim_out_dir / 'results_job0.json.gz', 'rt', encoding='utf-8') as f:
+        dpouts = json.load(f)
+    statuses = {(2, 1): 'Fail', (3, 1): 'Invalid'}
+    for dpout in dpouts:
+        dpout['completed_status'] = statuses.get((dpout['building_id'], dpout['upgrade']), 'Success')
+    with gzip.open(sim_out_dir / 'results_job0.json.gz', 'wt', encoding='utf-8') as f:
+        json.dump(dpouts, f)
+    (sim_out_dir / 'timeseries' / 'up01' / 'bldg0000004.parquet').unlink()
+
+    sims = list(itertools.product(range(1, 6), [None, 0]))
+    missing = postprocessing.find_missing_simulations(fs, str(sim_out_dir), sims)
+    assert missing == [(2, 0), (4, 0), (5, None), (5, 0)]
+
+    # The rerun's results replace the failed ones
+    rerun_dpout = next(dict(x) for x in dpouts if (x['building_id'], x['upgrade']) == (2, 1))
+    rerun_dpout['completed_status'] = 'Success'
+    with gzip.open(sim_out_dir / 'results_job1.json.gz', 'wt', encoding='utf-8') as f:
+        json.dump([rerun_dpout], f)
+    assert postprocessing.find_missing_simulations(fs, str(sim_out_dir), sims) == [(4, 0), (5, None), (5, 0)]
+
+    cfg = get_project_configuration(project_filename)
+    postprocessing.combine_results(fs, results_dir, cfg, do_timeseries=False)
+    df = pd.read_csv(results_dir / 'results_csvs' / 'results_up01.csv.gz', index_col='building_id')
+    assert len(df) == 4
+    assert df.loc[2, 'completed_status'] == 'Success'
+    assert df.loc[2, 'job_id'] == 1
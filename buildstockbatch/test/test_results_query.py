@@ -0,0 +1,56 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from buildstockbatch.results import BuildStockResults, characteristic_column_name
+
+here = os.path.dirname(os.path.abspath(__file__))
+results_dir = os.path.join(here, 'test_results')
+
+
+def test_characteristic_column_name():
+    assert characteristic_column_name('Geometry Building Type RECS') == \
+        'build_existing_model.geometry_building_type_recs'
+    assert characteristic_column_name('county') == 'build_existing_model.county'
+    assert characteristic_column_name('build_existing_model.county') == 'build_existing_model.county'
+
+
+def test_results_query():
+    res = BuildStockResults(results_dir)
+    assert res.upgrades == [0, 1]
+
+    df = res.results(upgrade=0)
+    reference_df = pd.read_parquet(os.path.join(results_dir, 'parquet', 'baseline', 'results_up00.parquet'))
+    pd.testing.assert_frame_equal(df, reference_df)
+
+    df = res.results(upgrade=1, building_ids=[2, 4], columns=['completed_status'])
+    assert df.columns.tolist() == ['building_id', 'completed_status']
+    assert sorted(df['building_id'].tolist()) == [2, 4]
+
+    tbl = res.results(characteristics={'County': ['TX, Harris County', 'IL, Cook County']}, as_pandas=False)
+    assert isinstance(tbl, pa.Table)
+    assert sorted(tbl.column('building_id').to_pylist()) == [1, 3]
+    assert res.building_ids({'County': 'TX, Dallas County'}) == [2]
+
+    with pytest.raises(KeyError, match='not_a_column'):
+        res.results(columns=['not_a_column'])
+
+
+def test_timeseries_query():
+    res = BuildStockResults(results_dir)
+    cols = ['Time', 'total_site_energy_mbtu']
+    df = res.timeseries(upgrade=1, building_ids=[1, 3], start='2007-02-01', end='2007-03-01', columns=cols)
+    df = df.reset_index()
+    assert set(df['building_id']) == {1, 3}
+    assert df['Time'].min() >= pd.Timestamp('2007-02-01')
+    assert df['Time'].max() < pd.Timestamp('2007-03-01')
+    assert set(df.columns) == {'building_id', 'Time', 'total_site_energy_mbtu'}
+
+    batches = list(res.iter_timeseries(
+        upgrade=1, characteristics={'County': 'IL, Cook County'}, columns=cols, batch_size=1000
+    ))
+    assert all(len(batch) <= 1000 for batch in batches)
+    ts_df = pd.concat(batches).reset_index()
+    assert set(ts_df['building_id']) == {3}
+    assert len(ts_df) == len(res.timeseries(upgrade=1, building_ids=[3], columns=cols))
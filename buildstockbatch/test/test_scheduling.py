@@ -0,0 +1,281 @@
+import concurrent.futures
+import itertools
+import os
+import pandas as pd
+import subprocess
+import sys
+import threading
+import time
+
+from buildstockbatch.scheduling import batch_simulations, order_longest_first, PeakMemorySampler, predict_makespan, \
+    run_admitted, RuntimeModel, RuntimeWatchdog, select_pilot_sims, WorkQueue
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_sims(n_buildings, n_upgrades):
+    building_ids = list(range(1, n_buildings + 1))
+    baseline_sims = zip(building_ids, itertools.repeat(None))
+    upgrade_sims = itertools.product(building_ids, range(n_upgrades))
+    return list(itertools.chain(baseline_sims, upgrade_sims))
+
+
+def test_batch_simulations_by_weather():
+    sims = make_sims(60, 2)
+    epws_by_building = {bldg_id: f'weather{bldg_id % 6}.epw' for bldg_id in range(1, 61)}
+    batches = batch_simulations(sims, 6, epws_by_building=epws_by_building)
+
+    assert len(batches) == 6
+    assert sorted(itertools.chain(*batches), key=str) == sorted(sims, key=str)
+    for batch in batches:
+        assert len(batch) == 30
+        assert len(set(epws_by_building[bldg_id] for bldg_id, _ in batch)) == 1
+
+    # More batches than weather files, each weather file is split over as few batches as possible
+    batches = batch_simulations(sims, 9, epws_by_building=epws_by_building)
+    assert len(batches) == 9
+    assert all(len(batch) == 20 for batch in batches)
+    assert sum(len(set(epws_by_building[bldg_id] for bldg_id, _ in batch)) for batch in batches) <= 6 + 9 - 1
+
+
+def test_batch_simulations_keep_buildings_together():
+    sims = make_sims(10, 3)
+    batches = batch_simulations(sims, 3, keep_buildings_together=True)
+    assert len(batches) == 3
+    assert sorted(itertools.chain(*batches), key=str) == sorted(sims, key=str)
+    for batch in batches:
+        for bldg_id in set(bldg_id for bldg_id, _ in batch):
+            assert sum(1 for x, _ in batch if x == bldg_id) == 4
+
+    # Not enough buildings for the batches
+    assert len(batch_simulations(sims, 20, keep_buildings_together=True)) == 10
+    assert batch_simulations([], 3) == []
+
+
+def test_batch_simulations_cost():
+    sims = make_sims(20, 1)
+
+    def sim_cost(sim):
+        return 5 if sim[1] is None else 1
+
+    batches = batch_simulations(sims, 4, sim_cost=sim_cost)
+    loads = [sum(map(sim_cost, batch)) for batch in batches]
+    assert len(batches) == 4
+    assert max(loads) - min(loads) <= 5
+
+
+def test_predict_makespan():
+    assert predict_makespan([10, 10, 10, 10], 2) == 20
+    assert predict_makespan([7, 5, 4, 3, 3], 2) == 12
+    assert predict_makespan([5], 4) == 5
+    assert order_longest_first([(1, None), (1, 0)], lambda sim: 1 if sim[1] is None else 2) == [(1, 0), (1, None)]
+
+
+def test_runtime_model(tmp_path):
+    results_df = pd.DataFrame({
+        'building_id': [1, 2, 3, 1, 2, 3],
+        'upgrade': [0, 0, 0, 1, 1, 1],
+        'started_at': ['20200101T000000Z'] * 6,
+        'completed_at': ['20200101T000100Z', '20200101T000300Z', '20200101T000500Z',
+                         '20200101T001000Z', '20200101T001000Z', '20200101T002000Z'],
+        'completed_status': ['Success'] * 5 + ['Fail'],
+    })
+    buildings_df = pd.DataFrame({'Geometry Building Type': ['SFD', 'MF', 'SFD']}, index=[1, 2, 3])
+    model = RuntimeModel.fit(results_df, buildings_df, ['Geometry Building Type'])
+    assert model.predict(0, ('SFD',)) == 180
+    assert model.predict(0, ('MF',)) == 180
+    assert model.predict(1, ('SFD',)) == 600
+    assert model.predict(0, ('Mobile Home',)) == 180
+    assert model.predict(2, ('SFD',)) == 300
+
+    model_filename = tmp_path / 'runtime_model.json'
+    model.save(model_filename)
+    model = RuntimeModel.load(model_filename)
+    assert model.features == ['Geometry Building Type']
+    sim_cost = model.sim_cost(buildings_df)
+    assert sim_cost((1, None)) == 180
+    assert sim_cost((2, 0)) == 600
+    assert sim_cost((4, 0)) == 600
+
+
+def test_runtime_model_memory(tmp_path):
+    results_df = pd.DataFrame({
+        'building_id': [1, 2, 1, 2],
+        'upgrade': [0, 0, 1, 1],
+        'completed_status': ['Success'] * 4,
+        'runtime_s': [60, 120, 60, 120],
+        'peak_memory_mb': [500, 1500, 800, 700],
+    })
+    buildings_df = pd.DataFrame({'Geometry Building Type': ['SFD', 'MF']}, index=[1, 2])
+    model = RuntimeModel.fit(results_df, buildings_df, ['Geometry Building Type'])
+    assert model.peak_memory_mb == 1500
+    assert model.predict_memory(0, ('SFD',)) == 500
+    assert model.predict_memory(0, ('Mobile Home',)) == 1500
+    assert model.predict_memory(1) == 800
+    assert model.predict_memory(2) == 1500
+
+    model_filename = tmp_path / 'runtime_model.json'
+    model.save(model_filename)
+    sim_memory = RuntimeModel.load(model_filename).sim_memory(buildings_df)
+    assert sim_memory((2, None)) == 1500
+    assert sim_memory((2, 0)) == 700
+
+    # Not measured
+    del results_df['peak_memory_mb']
+    assert RuntimeModel.fit(results_df).sim_memory(buildings_df) is None
+
+
+def test_runtime_model_from_results_dir():
+    model = RuntimeModel.load(
+        os.path.join(here, 'test_results'),
+        features=['Geometry Foundation Type']
+    )
+    assert model.features == ['Geometry Foundation Type']
+    assert () in model.runtimes
+    assert (0,) in model.runtimes
+    assert any(len(key) == 2 for key in model.runtimes.keys())
+    buildstock_df = pd.read_csv(os.path.join(here, 'buildstock.csv'), index_col=0)
+    sim_cost = model.sim_cost(buildstock_df)
+    assert all(sim_cost((bldg_id, None)) > 0 for bldg_id in buildstock_df.index)
+
+
+def test_select_pilot_sims():
+    buildstock_df = pd.DataFrame({
+        'Geometry Building Type': ['SFD'] * 6 + ['MF'] * 3 + ['Mobile Home'],
+    }, index=range(1, 11))
+    sims = select_pilot_sims(buildstock_df, 9, 2, features=['Geometry Building Type'])
+    assert len(sims) == len(set(sims)) == 9
+    # Every kind of building with every upgrade
+    kinds = set((buildstock_df.loc[bldg_id, 'Geometry Building Type'], upgrade_idx) for bldg_id, upgrade_idx in sims)
+    assert kinds == set(itertools.product(['SFD', 'MF', 'Mobile Home'], [None, 0, 1]))
+
+    # Runs out of simulations
+    sims = select_pilot_sims(buildstock_df, 100, 1, features=['Geometry Building Type'], skip_baseline=True)
+    assert sorted(sims) == [(bldg_id, 0) for bldg_id in range(1, 11)]
+    assert select_pilot_sims(buildstock_df, 4, 0) == select_pilot_sims(buildstock_df, 4, 0)
+
+
+def test_work_queue(tmp_path):
+    queue = WorkQueue(tmp_path / 'work_queue')
+    assert queue.put(1, make_sims(5, 0), 2) == 3
+    assert queue.put(2, make_sims(10, 0)[5:], 2) == 3
+
+    # A job claims its own chunks first, in order
+    name, sims = queue.claim(1)
+    assert name == WorkQueue.chunk_name(1, 0)
+    assert sims == [(1, None), (2, None)]
+
+    # Another job takes over the end of the job with the most chunks left
+    queue2 = WorkQueue(tmp_path / 'work_queue')
+    for _ in range(3):
+        queue2.claim(2)
+    name, sims = queue2.claim(2)
+    assert name == WorkQueue.chunk_name(1, 2)
+    assert sims == [(5, None)]
+
+    # The first job skips the chunk that was taken over
+    assert queue.claim(1)[0] == WorkQueue.chunk_name(1, 1)
+    assert queue.claim(1) is None
+
+    queue.done([WorkQueue.chunk_name(1, 0), WorkQueue.chunk_name(1, 1)])
+    assert sorted(os.listdir(queue.done_dir)) == [WorkQueue.chunk_name(1, 0), WorkQueue.chunk_name(1, 1)]
+    assert len(os.listdir(queue.claimed_dir)) == 4
+
+
+def test_work_queue_concurrent_claims(tmp_path):
+    sims = make_sims(200, 0)
+    WorkQueue(tmp_path).put(1, sims, 3)
+
+    def claim_all(job_num):
+        queue = WorkQueue(tmp_path)
+        claimed = []
+        while True:
+            chunk = queue.claim(job_num)
+            if chunk is None:
+                return claimed
+            claimed.extend(chunk[1])
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        claimed = list(itertools.chain(*executor.map(claim_all, [1, 2, 3, 4])))
+    assert sorted(claimed, key=str) == sorted(sims, key=str)
+
+
+def test_run_admitted():
+    sims = make_sims(10, 2)
+    lock = threading.Lock()
+    running = []
+    peaks = []
+
+    def sim_memory(sim):
+        return 2000 if sim == (10, 1) else 600 if sim[1] is None else 300
+
+    def run_sim(building_id, upgrade_idx):
+        with lock:
+            running.append((building_id, upgrade_idx))
+            peaks.append((len(running), sum(map(sim_memory, running)), list(running)))
+        time.sleep(0.01)
+        with lock:
+            running.remove((building_id, upgrade_idx))
+        return building_id, upgrade_idx
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(run_admitted(executor, run_sim, iter(sims), 4, memory_mb=1000, sim_memory=sim_memory))
+    assert sorted(results, key=str) == sorted(sims, key=str)
+    for n_running, memory_used, running_sims in peaks:
+        # A simulation that needs more than there is runs on its own
+        assert n_running <= 4
+        assert memory_used <= 1000 or running_sims == [(10, 1)]
+
+    # No memory limit
+    peaks.clear()
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(run_admitted(executor, run_sim, sims, 3))
+    assert len(results) == len(sims)
+    assert max(n_running for n_running, _, _ in peaks) <= 3
+
+
+def test_runtime_watchdog():
+    watchdog = RuntimeWatchdog(factor=2, min_samples=10, min_timeout_s=60, max_timeout_s=3600)
+    assert watchdog.timeout(0) == 3600
+    for runtime in range(1, 101):
+        watchdog.record(0, runtime * 10)
+    assert watchdog.timeout(0) == 990 * 2
+
+    # Other upgrades use all the runtimes until they have enough of their own
+    assert watchdog.timeout(1) == 990 * 2
+    for _ in range(10):
+        watchdog.record(1, 5)
+    assert watchdog.timeout(1) == 60
+    for _ in range(10):
+        watchdog.record(2, 5000)
+    assert watchdog.timeout(2) == 3600
+
+    # It's only on when it's configured
+    assert RuntimeWatchdog.from_cfg(None) is None
+    assert RuntimeWatchdog.from_cfg({'enabled': False}) is None
+    assert RuntimeWatchdog.from_cfg({}).min_samples == 20
+    watchdog = RuntimeWatchdog.from_cfg({'factor': 4, 'max_minutes': 60}, max_running=72)
+    assert watchdog.factor == 4
+    assert watchdog.min_samples == 144
+    assert watchdog.min_timeout_s == 600
+    assert watchdog.max_timeout_s == 3600
+
+    # The pilot's runtimes keep it from killing the long simulations
+    runtime_model = RuntimeModel([], {(): 300, (0,): 300, (0, 'MF'): 900, (1,): 100})
+    watchdog = RuntimeWatchdog(factor=2, min_samples=10, min_timeout_s=60, runtime_model=runtime_model)
+    for upgrade in (0, 1, 2):
+        for _ in range(10):
+            watchdog.record(upgrade, 50)
+    assert watchdog.timeout(0) == 1800
+    assert watchdog.timeout(1) == 200
+    assert watchdog.timeout(2) == 1800
+
+
+def test_peak_memory_sampler():
+    # Two processes that each hold 100 MiB at the same time, the largest one alone is about half of it
+    args = [sys.executable, '-c', 'import time; x = bytearray(100 * 2 ** 20); time.sleep(2)']
+    with PeakMemorySampler(interval=0.1) as sampler:
+        procs = [subprocess.Popen(args) for _ in range(2)]
+        for proc in procs:
+            proc.wait()
+    assert sampler.peak_mb > 200
@@ -1,5 +1,6 @@
 import tempfile
-from buildstockbatch.utils import log_error_details, _str_repr
+import threading
+from buildstockbatch.utils import log_error_details, _str_repr, run_pipelined
 import pytest
 import os
 
@@ -49,3 +50,24 @@ def test_get_error_details():
     assert "'level_2_string':'string2_my_arg2'" in error_log
     assert "'level_2_list':['level_2_str1','level_2_str2']" in error_log
     os.remove(tf.name)
+
+
+def test_run_pipelined():
+    postprocessing_started = threading.Event()
+    main_thread = threading.current_thread()
+    postprocess_threads = set()
+
+    def simulations():
+        for i in range(5):
+            if i == 1:
+                # The first simulation is postprocessed while the second one runs
+                assert postprocessing_started.wait(5)
+            yield i
+
+    def postprocess(i):
+        postprocess_threads.add(threading.current_thread())
+        postprocessing_started.set()
+        return i * 10
+
+    assert run_pipelined(simulations(), postprocess) == [0, 10, 20, 30, 40]
+    assert main_thread not in postprocess_threads
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import enum
 import inspect
 import os
@@ -20,6 +21,28 @@ def path_rel_to_file(startfile, x):
         return os.path.abspath(os.path.join(os.path.dirname(startfile), x))
 
 
+def run_pipelined(sim_results, postprocess, n_workers=None):
+    """Postprocess simulation results in a background thread pool as they arrive
+
+    ``sim_results`` is usually :func:`~buildstockbatch.scheduling.run_admitted` running the simulations. Each result
+    is handed to ``postprocess`` in a background thread as soon as it arrives so the next simulation can start right
+    away.
+
+    :param sim_results: results of the simulations in order
+    :type sim_results: iterable
+    :param postprocess: function that takes one simulation result and returns its final result
+    :type postprocess: callable
+    :param n_workers: number of background threads, size it like the number of simulations running at once so the
+        postprocessing keeps up with them, one per cpu if None, defaults to None
+    :type n_workers: int, optional
+    :return: the return values of ``postprocess`` in the same order as ``sim_results``
+    :rtype: list
+    """
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as pool:
+        futures = [pool.submit(postprocess, x) for x in sim_results]
+        return [f.result() for f in futures]
+
+
 def get_project_configuration(project_file):
     try:
         with open(project_file) as f: